@@ -0,0 +1,143 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Benchmarks copying pipelines.
+
+Copies generated pipelines of increasing size and changes one parameter
+in the copy, as parameter explorations do, using the full copy and the
+structurally shared copy. Reports the time per copy-plus-edit and the
+number of objects each copy allocates.
+
+Usage: python scripts/benchmarks/pipeline_copy.py [size ...]
+"""
+
+from __future__ import division
+
+import copy
+import gc
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from vistrails.core.db.action import create_action
+from vistrails.core.vistrail.connection import Connection
+from vistrails.core.vistrail.location import Location
+from vistrails.core.vistrail.module import Module
+from vistrails.core.vistrail.module_function import ModuleFunction
+from vistrails.core.vistrail.module_param import ModuleParam
+from vistrails.core.vistrail.pipeline import Pipeline
+from vistrails.core.vistrail.port import Port
+from vistrails.db.domain import IdScope
+
+
+def make_pipeline(size, functions=3, seed=0):
+    """Makes a pipeline where each module has a few functions and gets an
+    input from one of the previous modules.
+    """
+    rng = random.Random(seed)
+    id_scope = IdScope()
+    ops = []
+    for i in xrange(size):
+        module = Module(id=id_scope.getNewId(Module.vtType),
+                        name='Module%d' % i,
+                        package='org.example.benchmark',
+                        version='1.0')
+        module.location = Location(id=id_scope.getNewId(Location.vtType),
+                                   x=0.0, y=i * 50.0)
+        for j in xrange(functions):
+            param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                                pos=0, type='Float', val=str(rng.random()))
+            function = ModuleFunction(
+                    id=id_scope.getNewId(ModuleFunction.vtType),
+                    pos=j, name='input%d' % j, parameters=[param])
+            module.add_function(function)
+        ops.append(('add', module))
+        if i > 0:
+            source = rng.randint(0, i - 1)
+            ports = [Port(id=id_scope.getNewId(Port.vtType), type='source',
+                          moduleId=source, moduleName='Module%d' % source,
+                          name='output'),
+                     Port(id=id_scope.getNewId(Port.vtType),
+                          type='destination', moduleId=module.id,
+                          moduleName=module.name, name='input')]
+            ops.append(('add', Connection(
+                    id=id_scope.getNewId(Connection.vtType), ports=ports)))
+    pipeline = Pipeline()
+    pipeline.perform_action(create_action(ops))
+    return pipeline, id_scope
+
+
+def edit(pipeline, id_scope, module_id):
+    """Changes the first parameter of a module, as a parameter exploration
+    step does.
+    """
+    function = pipeline.modules[module_id].functions[0]
+    old_param = function.params[0]
+    new_param = copy.copy(old_param)
+    new_param.real_id = id_scope.getNewId(ModuleParam.vtType)
+    new_param.strValue = '0.5'
+    pipeline.perform_action(create_action([('change', old_param, new_param,
+                                            ModuleFunction.vtType,
+                                            function.real_id)]))
+
+
+def run(size, repeat=10):
+    pipeline, id_scope = make_pipeline(size)
+    module_ids = pipeline.modules.keys()
+    for name, copy_f in [('full', copy.copy),
+                         ('shared', Pipeline.shared_copy)]:
+        def step():
+            cp = copy_f(pipeline)
+            edit(cp, id_scope, module_ids[size // 2])
+            return cp
+        t = min(timeit.repeat(step, number=1, repeat=repeat))
+
+        gc.collect()
+        before = len(gc.get_objects())
+        copies = [step() for i in xrange(10)]
+        allocated = (len(gc.get_objects()) - before) / len(copies)
+        del copies
+        print "%6d modules, %6s copy + edit: %8.2f ms, %8d objects" % (
+                size, name, t * 1000, allocated)
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 5000]
+    for size in sizes:
+        run(size)
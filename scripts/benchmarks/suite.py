@@ -0,0 +1,375 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Runs the benchmarks of the core hot paths.
+
+Times a few operations (interpreter execution, signatures, pipeline copy,
+version materialization, .vt save and load, layouts) on generated
+workflows and vistrails of several sizes, reusing the generators of the
+other scripts in this directory.
+
+Results can be saved as JSON and compared with the results of another
+commit, to catch performance regressions before a release. Only results
+taken on the same machine are comparable.
+
+Usage:
+    python scripts/benchmarks/suite.py [-b pattern ...] [-o results.json]
+    python scripts/benchmarks/suite.py --compare old.json new.json
+"""
+
+from __future__ import division
+
+import argparse
+import atexit
+import fnmatch
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, this_dir)
+sys.path.insert(0, os.path.join(this_dir, '..', '..'))
+
+from vistrails.core.layout.version_tree_layout import VistrailsTreeLayoutLW
+from vistrails.core.layout.workflow_layout import WorkflowLayout
+from vistrails.core.vistrail.controller import VistrailController
+from vistrails.core.vistrail.vistrail import Vistrail
+from vistrails.db.services.io import SaveBundle, close_zip_xml, \
+    open_vistrail_bundle_from_zip_xml, save_vistrail_bundle_to_zip_xml
+
+from pipeline_copy import make_pipeline
+from terse_graph import make_vistrail
+from version_tree_layout import text_width
+from vistrail_merge import add_actions
+from workflow_layout import make_workflow, module_size
+
+
+benchmarks = []
+
+
+def benchmark(name, sizes, needs_app=False):
+    """Registers a benchmark, run for each of the given sizes.
+
+    The decorated function is called with the size and returns the function
+    to time, or a (function, setup) pair if setup() has to be called before
+    each run of the function, outside of the timing.
+    """
+    def wrapper(func):
+        benchmarks.append((name, sizes, needs_app, func))
+        return func
+    return wrapper
+
+
+def make_executable_pipeline(size, window=50, seed=0):
+    """Makes a pipeline of ConcatenateString modules, each getting its
+    first input from one of the previous 'window' modules.
+    """
+    from vistrails.core.modules.module_registry import get_module_registry
+    from vistrails.core.system import get_vistrails_basic_pkg_id
+    from vistrails.core.vistrail.connection import Connection
+    from vistrails.core.vistrail.module import Module
+    from vistrails.core.vistrail.module_function import ModuleFunction
+    from vistrails.core.vistrail.module_param import ModuleParam
+    from vistrails.core.vistrail.pipeline import Pipeline
+    from vistrails.core.vistrail.port import Port
+
+    rng = random.Random(seed)
+    basic_pkg = get_vistrails_basic_pkg_id()
+    version = get_module_registry().get_package_by_name(basic_pkg).version
+    signature = '(%s:String)' % basic_pkg
+    pipeline = Pipeline()
+    for i in xrange(size):
+        param = ModuleParam(id=i, pos=0, type='String', val='m%d' % i)
+        function = ModuleFunction(id=i, pos=0, name='str2',
+                                  parameters=[param])
+        pipeline.add_module(Module(id=i, name='ConcatenateString',
+                                   package=basic_pkg, version=version,
+                                   functions=[function]))
+        if i > 0:
+            source = rng.randint(max(0, i - window), i - 1)
+            ports = [Port(id=i * 2, type='source', moduleId=source,
+                          name='value', signature=signature),
+                     Port(id=i * 2 + 1, type='destination', moduleId=i,
+                          name='str1', signature=signature)]
+            pipeline.add_connection(Connection(id=i, ports=ports))
+    return pipeline
+
+
+def make_module_vistrail(size, seed=0):
+    """Makes a vistrail where each action adds a module.
+    """
+    vistrail = Vistrail()
+    add_actions(vistrail, size, 'benchmark', random.Random(seed))
+    return vistrail
+
+
+def execute(interpreter, pipeline):
+    from vistrails.core.db.locator import XMLFileLocator
+    from vistrails.core.utils import DummyView
+
+    result = interpreter.execute(pipeline,
+                                 locator=XMLFileLocator('benchmark.xml'),
+                                 current_version=1,
+                                 view=DummyView())
+    if result.errors:
+        raise RuntimeError("Benchmark pipeline failed: %r" % result.errors)
+
+
+@benchmark('interpreter.execute', [100, 1000], needs_app=True)
+def bench_execute(size):
+    from vistrails.core.interpreter.cached import CachedInterpreter
+
+    pipeline = make_executable_pipeline(size)
+    return (lambda: execute(CachedInterpreter.get(), pipeline),
+            CachedInterpreter.flush)
+
+
+@benchmark('interpreter.execute_cached', [100, 1000], needs_app=True)
+def bench_execute_cached(size):
+    from vistrails.core.interpreter.cached import CachedInterpreter
+
+    pipeline = make_executable_pipeline(size)
+    CachedInterpreter.flush()
+    execute(CachedInterpreter.get(), pipeline)
+    return lambda: execute(CachedInterpreter.get(), pipeline)
+
+
+@benchmark('pipeline.signatures', [100, 1000], needs_app=True)
+def bench_signatures(size):
+    pipeline = make_executable_pipeline(size)
+    return pipeline.refresh_signatures
+
+
+@benchmark('pipeline.do_copy', [100, 1000])
+def bench_do_copy(size):
+    pipeline, id_scope = make_pipeline(size)
+    return pipeline.do_copy
+
+
+@benchmark('vistrail.materialize', [1000, 10000])
+def bench_materialize(size):
+    vistrail = make_module_vistrail(size)
+    version = max(vistrail.actionMap)
+    return lambda: vistrail.getPipeline(version)
+
+
+def temp_file(name):
+    temp_dir = tempfile.mkdtemp(prefix='vt_bench')
+    atexit.register(shutil.rmtree, temp_dir, True)
+    return os.path.join(temp_dir, name)
+
+
+def save(vistrail, filename):
+    _, save_dir = save_vistrail_bundle_to_zip_xml(
+            SaveBundle(Vistrail.vtType, vistrail), filename)
+    close_zip_xml(save_dir)
+
+
+@benchmark('vistrail.save_xml', [1000, 5000])
+def bench_save(size):
+    vistrail = make_module_vistrail(size)
+    filename = temp_file('benchmark.vt')
+    return lambda: save(vistrail, filename)
+
+
+@benchmark('vistrail.load_xml', [1000, 5000])
+def bench_load(size):
+    filename = temp_file('benchmark.vt')
+    save(make_module_vistrail(size), filename)
+    def load():
+        save_bundle, save_dir = open_vistrail_bundle_from_zip_xml(filename)
+        close_zip_xml(save_dir)
+    return load
+
+
+@benchmark('layout.version_tree', [1000, 10000])
+def bench_version_tree_layout(size):
+    vistrail = make_vistrail(size)
+    controller = VistrailController(vistrail, None, auto_save=False)
+    controller.recompute_terse_graph()
+    def layout():
+        VistrailsTreeLayoutLW(text_width, 12, 10, 5).layout_from(
+                vistrail, controller._current_terse_graph)
+    return layout
+
+
+@benchmark('layout.workflow', [1000, 3000])
+def bench_workflow_layout(size):
+    wf = make_workflow(size)
+    def layout():
+        WorkflowLayout(wf, module_size, (5, 5), (10, 10), 3).run_all()
+    return layout
+
+
+def measure(func, setup=None, repeat=5, min_time=0.1):
+    """Returns the times of repeat runs of func, in seconds.
+
+    Fast functions are run several times in a row so that each sample
+    takes at least min_time, and the sample is divided by the number of
+    calls. With a setup function, each sample is a single call.
+    """
+    if setup is not None:
+        times = []
+        for i in xrange(repeat):
+            setup()
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+        return times
+    number = 1
+    while True:
+        t = timeit.timeit(func, number=number)
+        if t >= min_time or number >= 1000:
+            break
+        number = min(1000, max(number * 2,
+                               int(number * min_time / max(t, 1e-6))))
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    return [t / number for t in times]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=this_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(patterns, repeat):
+    """Runs the benchmarks matching one of the patterns.
+    """
+    results = []
+    app_initialized = False
+    for name, sizes, needs_app, func in benchmarks:
+        if not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        if needs_app and not app_initialized:
+            import vistrails.core.api
+            vistrails.core.api.initialize()
+            app_initialized = True
+        for size in sizes:
+            setup = None
+            timed = func(size)
+            if isinstance(timed, tuple):
+                timed, setup = timed
+            times = sorted(measure(timed, setup, repeat))
+            result = {'name': name, 'size': size,
+                      'min': times[0], 'median': times[len(times) // 2]}
+            print "%-28s %6d: min %10.2f ms, median %10.2f ms" % (
+                    name, size, result['min'] * 1000,
+                    result['median'] * 1000)
+            sys.stdout.flush()
+            results.append(result)
+    return results
+
+
+def compare(old_file, new_file, threshold):
+    """Compares two result files, returns the number of regressions.
+
+    A benchmark regressed if its minimum time grew by more than threshold
+    (a ratio).
+    """
+    with open(old_file) as fp:
+        old = json.load(fp)
+    with open(new_file) as fp:
+        new = json.load(fp)
+    print "old: %s\nnew: %s" % (old['commit'], new['commit'])
+    old_results = dict(((r['name'], r['size']), r) for r in old['results'])
+    regressions = 0
+    for result in new['results']:
+        key = result['name'], result['size']
+        if key not in old_results:
+            continue
+        ratio = result['min'] / old_results[key]['min']
+        if ratio > threshold:
+            marker = 'slower'
+            regressions += 1
+        elif ratio < 1 / threshold:
+            marker = 'faster'
+        else:
+            marker = ''
+        print "%-28s %6d: %10.2f ms -> %10.2f ms  %5.2fx %s" % (
+                key[0], key[1], old_results[key]['min'] * 1000,
+                result['min'] * 1000, ratio, marker)
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+            description="Runs the benchmarks of the core hot paths.")
+    parser.add_argument('-b', '--bench', action='append',
+                        help="only run the benchmarks matching this pattern "
+                             "(e.g. 'layout.*'), can be repeated")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="number of samples for each benchmark")
+    parser.add_argument('-o', '--output',
+                        help="write the results to this JSON file")
+    parser.add_argument('-l', '--list', action='store_true',
+                        help="list the benchmarks and exit")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files instead of running, "
+                             "exits with status 1 if there are regressions")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="slowdown ratio reported as a regression by "
+                             "--compare (default: 1.2)")
+    args = parser.parse_args(args)
+
+    if args.list:
+        for name, sizes, needs_app, func in benchmarks:
+            print "%-28s %s" % (name, ', '.join(str(s) for s in sizes))
+        return 0
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1],
+                            args.threshold) else 0
+
+    results = run(args.bench or ['*'], args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results},
+                      fp, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
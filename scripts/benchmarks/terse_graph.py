@@ -0,0 +1,118 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Benchmarks the maintenance of the terse version tree.
+
+Builds synthetic vistrails of increasing size and times a few typical
+interactions (new action, tag, version selection, prune), both with the
+incremental update of the terse graph and with a full recomputation.
+
+Usage: python scripts/benchmarks/terse_graph.py [size ...]
+"""
+
+from __future__ import division
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from vistrails.core.vistrail.action import Action
+from vistrails.core.vistrail.controller import VistrailController
+from vistrails.core.vistrail.vistrail import Vistrail
+
+
+def make_vistrail(size, seed=0):
+    """Makes a vistrail with long branches, a few tags and upgrades.
+    """
+    rng = random.Random(seed)
+    vistrail = Vistrail()
+    versions = [0]
+    for i in xrange(size):
+        if rng.random() < 0.9:
+            parent = versions[-1]
+        else:
+            parent = rng.choice(versions)
+        action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+        vistrail.add_action(action, parent)
+        versions.append(action.id)
+        if rng.random() < 0.02:
+            vistrail.set_tag(action.id, 'tag %d' % action.id)
+        elif rng.random() < 0.01:
+            upgrade = Action(id=vistrail.idScope.getNewId(Action.vtType))
+            vistrail.add_action(upgrade, action.id)
+            vistrail.set_upgrade(action.id, str(upgrade.id))
+    return vistrail
+
+
+def run(size):
+    vistrail = make_vistrail(size)
+    controller = VistrailController(vistrail, None, auto_save=False)
+    rng = random.Random(1)
+
+    def new_action():
+        action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+        vistrail.add_action(action, max(vistrail.actionMap))
+        controller.current_version = action.id
+
+    def tag():
+        version = max(vistrail.actionMap) - rng.randrange(50)
+        vistrail.set_tag(version, 'bench %d' % rng.randrange(size))
+
+    def select():
+        controller.current_version = rng.choice(vistrail.actionMap.keys())
+
+    def prune():
+        vistrail.set_prune(max(vistrail.actionMap), str(True))
+
+    print "%d versions:" % size
+    full = timeit.timeit(controller._build_terse_graph, number=3) / 3
+    print "  full recomputation: %8.2f ms" % (full * 1000)
+    for name, change in [('new action', new_action), ('tag', tag),
+                         ('select version', select), ('prune', prune)]:
+        def update():
+            change()
+            controller.recompute_terse_graph()
+        incremental = timeit.timeit(update, number=20) / 20
+        print "  %-18s  %8.2f ms" % (name + ':', incremental * 1000)
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    for size in sizes:
+        run(size)
@@ -0,0 +1,112 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Benchmarks the layout of the version tree.
+
+Lays out the full and the terse version tree of synthetic vistrails of
+increasing size, once from scratch and then after a few typical interactions (new action,
+tag, pruned subtree), with a pure-Python stand-in for the font metrics.
+
+Usage: python scripts/benchmarks/version_tree_layout.py [size ...]
+"""
+
+from __future__ import division
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from vistrails.core.layout.version_tree_layout import VistrailsTreeLayoutLW
+from vistrails.core.vistrail.action import Action
+from vistrails.core.vistrail.controller import VistrailController
+
+from terse_graph import make_vistrail
+
+
+def text_width(text):
+    return 7 * len(text)
+
+
+def run(size, full_tree):
+    vistrail = make_vistrail(size)
+    controller = VistrailController(vistrail, None, auto_save=False)
+    controller.full_tree = full_tree
+    controller.recompute_terse_graph()
+    rng = random.Random(1)
+
+    def layout(layout=None):
+        if layout is None:
+            layout = VistrailsTreeLayoutLW(text_width, 12, 10, 5)
+        layout.layout_from(vistrail, controller._current_terse_graph)
+
+    def new_action():
+        action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+        vistrail.add_action(action, rng.choice(vistrail.actionMap.keys()))
+
+    def tag():
+        version = rng.choice(vistrail.actionMap.keys())
+        vistrail.set_tag(version, 'bench %d' % rng.randrange(size))
+
+    def prune():
+        version = rng.choice(vistrail.actionMap.keys())
+        vistrail.set_prune(version, str(True))
+
+    print "%d versions, %s tree (%d nodes):" % (
+            size, 'full' if full_tree else 'terse',
+            len(controller._current_terse_graph.vertices))
+    full = timeit.timeit(layout, number=3) / 3
+    print "  full layout:        %8.2f ms" % (full * 1000)
+    incremental_layout = VistrailsTreeLayoutLW(text_width, 12, 10, 5)
+    layout(incremental_layout)
+    for name, change in [('new action', new_action), ('tag', tag),
+                         ('prune', prune)]:
+        def update():
+            change()
+            controller.recompute_terse_graph()
+            layout(incremental_layout)
+        incremental = timeit.timeit(update, number=5) / 5
+        print "  %-18s  %8.2f ms" % (name + ':', incremental * 1000)
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    for size in sizes:
+        run(size, True)
+        run(size, False)
@@ -0,0 +1,117 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Benchmarks merging vistrails.
+
+Makes a vistrail of generated actions, then two copies that diverge with
+their own new actions, tags and notes, as two users working from the same
+checkout would. Reports the time to merge the second copy into the first.
+Many actions share the same date, as happens with scripted changes.
+
+Usage: python scripts/benchmarks/vistrail_merge.py [actions ...]
+"""
+
+from __future__ import division
+
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from vistrails.core.db.action import create_action
+from vistrails.core.vistrail.module import Module
+from vistrails.core.vistrail.vistrail import Vistrail
+from vistrails.db.services.io import SaveBundle
+from vistrails.db.services.vistrail import merge
+
+
+def add_actions(vistrail, count, user, rng, per_second=50):
+    """Adds count actions that each add a module, on random parents.
+    """
+    start = datetime.datetime(2016, 1, 1)
+    versions = [a.id for a in vistrail.actions] or [0]
+    for i in xrange(count):
+        module = Module(id=vistrail.idScope.getNewId(Module.vtType),
+                        name='Module%d' % i,
+                        package='org.example.benchmark',
+                        version='1.0')
+        action = create_action([('add', module)])
+        vistrail.add_action(action, rng.choice(versions[-20:]))
+        action.user = user
+        action.date = start + datetime.timedelta(
+                seconds=len(versions) // per_second)
+        versions.append(action.id)
+        if rng.random() < 0.05:
+            vistrail.set_tag(action.id, '%s tag %d' % (user, i))
+
+
+def make_vistrails(size, seed=0):
+    """Makes the two diverged vistrails, each with a tenth of their actions
+    not in the other.
+    """
+    rng = random.Random(seed)
+    base = Vistrail()
+    add_actions(base, size, 'base', rng)
+    mine = base.do_copy()
+    theirs = base.do_copy()
+    add_actions(mine, size // 10, 'me', rng)
+    add_actions(theirs, size // 10, 'them', rng)
+    for action in rng.sample(theirs.actions, size // 20):
+        theirs.set_notes(action.id, 'notes on %d' % action.id)
+    return mine, theirs
+
+
+def run(size, repeat=3):
+    mine, theirs = make_vistrails(size)
+    times = []
+    for i in xrange(repeat):
+        # merge() changes the first vistrail
+        sb = SaveBundle(Vistrail.vtType, mine.do_copy())
+        start = timeit.default_timer()
+        merge(sb, SaveBundle(Vistrail.vtType, theirs))
+        times.append(timeit.default_timer() - start)
+    t = min(times)
+    print "%6d actions: merge %8.2f ms" % (
+            len(mine.actions) + len(theirs.actions) - size, t * 1000)
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 20000]
+    for size in sizes:
+        run(size)
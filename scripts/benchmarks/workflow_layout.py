@@ -0,0 +1,105 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Benchmarks the automatic layout of workflows.
+
+Lays out generated DAGs of increasing size and reports the time taken by
+each step of WorkflowLayout, and the number of crossings before and after
+the barycenter sweeps.
+
+Usage: python scripts/benchmarks/workflow_layout.py [size ...]
+"""
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from vistrails.core.layout.workflow_layout import Pipeline, WorkflowLayout
+
+
+def make_workflow(size, window=50, seed=0):
+    """Makes a DAG where each module gets its inputs from one to three of
+    the previous 'window' modules.
+    """
+    rng = random.Random(seed)
+    wf = Pipeline()
+    modules = []
+    for i in xrange(size):
+        module = wf.createModule(i, 'Module%d' % i, 3, 2)
+        if modules:
+            for port in xrange(rng.randint(1, 3)):
+                source = modules[rng.randint(max(0, i - window), i - 1)]
+                wf.createConnection(source, rng.randint(0, 1), module, port)
+        modules.append(module)
+    return wf
+
+
+def module_size(module):
+    return (len(module.name) * 6 + 20, 50)
+
+
+def run(size, window):
+    wf = make_workflow(size, window)
+    layout = WorkflowLayout(wf, module_size, (5, 5), (10, 10), 3)
+    times = []
+    for step in [layout.compute_module_sizes,
+                 layout.assign_modules_to_layers,
+                 layout.count_crossings,
+                 layout.assign_module_permutation_to_each_layer,
+                 lambda: layout.compute_layout(50, 50)]:
+        start = time.time()
+        result = step()
+        times.append(time.time() - start)
+        if step == layout.count_crossings:
+            crossings = result
+    print "%6d modules, window %6d: %8.2f ms, crossings %d -> %d" % (
+            size, window, (sum(times) - times[2]) * 1000,
+            crossings, layout.count_crossings())
+    print "    sizes %.2f ms, layers %.2f ms, sweeps %.2f ms, " \
+          "positions %.2f ms" % tuple(t * 1000
+                                      for t in times[:2] + times[3:])
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 3000, 10000, 30000]
+    for size in sizes:
+        for window in [50, size]:
+            run(size, window)
@@ -38,6 +38,7 @@ from __future__ import division
 import copy
 from itertools import imap, chain
 import math
+import numpy
 import operator
 import scipy
 import tempfile
@@ -82,21 +83,35 @@ class EigenBase(object):
     def init_vertex_similarity(self):
         num_verts_p1 = len(self._p1.graph.vertices)
         num_verts_p2 = len(self._p2.graph.vertices)
-        m_i = mzeros((num_verts_p1, num_verts_p2))
-        m_o = mzeros((num_verts_p1, num_verts_p2))
         def get_vertex_map(g):
             return Bidict([(v, k) for (k, v)
                            in enumerate(g.iter_vertices())])
         # vertex_maps: vertex_id to matrix index
         self._g1_vertex_map = get_vertex_map(self._p1.graph)
         self._g2_vertex_map = get_vertex_map(self._p2.graph)
-        for i in xrange(num_verts_p1):
-            for j in xrange(num_verts_p2):
-                v1_id = self._g1_vertex_map.inverse[i]
-                v2_id = self._g2_vertex_map.inverse[j]
-                (in_s8y, out_s8y) = self.compare_modules(v1_id, v2_id)
-                m_i[i,j] = in_s8y
-                m_o[i,j] = out_s8y
+        modules1 = [self._p1.modules[self._g1_vertex_map.inverse[i]]
+                    for i in xrange(num_verts_p1)]
+        modules2 = [self._p2.modules[self._g2_vertex_map.inverse[j]]
+                    for j in xrange(num_verts_p2)]
+        ports1 = [self.get_ports(m) for m in modules1]
+        ports2 = [self.get_ports(m) for m in modules2]
+        m_i = self.port_similarity([p[0] for p in ports1],
+                                   [p[0] for p in ports2],
+                                   exact_match=lambda descs: 1)
+        m_o = self.port_similarity([p[1] for p in ports1],
+                                   [p[1] for p in ports2],
+                                   exact_match=len)
+        # modules with different names are slightly less similar
+        names = {}
+        names1 = numpy.array([names.setdefault(m.name, len(names))
+                              for m in modules1], dtype=int)
+        names2 = numpy.array([names.setdefault(m.name, len(names))
+                              for m in modules2], dtype=int)
+        different = names1[:, None] != names2[None, :]
+        m_i[different] *= 0.99
+        m_o[different] *= 0.99
+        m_i = scipy.matrix(m_i)
+        m_o = scipy.matrix(m_o)
         # print m_i
         # print m_o
         self._input_vertex_s8y = m_i
@@ -113,17 +128,114 @@ class EigenBase(object):
         self._g1_edge_map = get_edge_map(self._p1.graph)
         self._g2_edge_map = get_edge_map(self._p2.graph)
 
+        def get_endpoints(pipeline, edge_map, vertex_map, port_names):
+            connections = [pipeline.connections[edge_map.inverse[i]]
+                           for i in xrange(len(edge_map))]
+            return (numpy.array([vertex_map[c.sourceId]
+                                 for c in connections], dtype=int),
+                    numpy.array([vertex_map[c.destinationId]
+                                 for c in connections], dtype=int),
+                    numpy.array([port_names.setdefault(
+                                         (c.source.name, c.destination.name),
+                                         len(port_names))
+                                 for c in connections], dtype=int))
+        port_names = {}
+        (sources1, destinations1, names1) = get_endpoints(
+                self._p1, self._g1_edge_map, self._g1_vertex_map, port_names)
+        (sources2, destinations2, names2) = get_endpoints(
+                self._p2, self._g2_edge_map, self._g2_vertex_map, port_names)
+
+        # same as compare_connections() on all the pairs at once
         m_e = mzeros((len(self._g1_edge_map),
                       len(self._g2_edge_map)))
-
-        for i in xrange(len(self._g1_edge_map)):
-            for j in xrange(len(self._g2_edge_map)):
-                c1_id = self._g1_edge_map.inverse[i]
-                c2_id = self._g2_edge_map.inverse[j]
-                s8y = self.compare_connections(c1_id, c2_id)
-                m_e[i, j] = s8y
+        rows, cols = numpy.nonzero(names1[:, None] == names2[None, :])
+        if len(rows):
+            output_s8y = numpy.asarray(self._output_vertex_s8y)
+            input_s8y = numpy.asarray(self._input_vertex_s8y)
+            m_e[rows, cols] = (
+                    output_s8y[sources1[rows], sources2[cols]] +
+                    input_s8y[destinations1[rows], destinations2[cols]]) / 2.0
         self._edge_s8y = m_e
 
+    @staticmethod
+    def port_similarity(ports1, ports2, exact_match):
+        """port_similarity(ports1: list, ports2: list, exact_match: callable
+                           ) -> array
+
+        Computes the similarity of compare_modules() for one kind of port
+        between all the modules of both pipelines, without the penalty on
+        different names. ports1 and ports2 list the ports of each module,
+        as returned by get_ports(). A port of the first module that also
+        exists in the second with the same descriptors scores
+        exact_match(descriptors), the others score one per descriptor the
+        second module has on any port.
+
+        The ports are turned into sparse feature vectors so that every pair
+        is scored by two matrix products.
+        """
+        from scipy import sparse
+
+        descs = {}
+        keys = {}
+        def index(d, key):
+            return d.setdefault(key, len(d))
+
+        # descriptors of each module of p1, with repetitions
+        count_rows, count_cols = [], []
+        # ports of p1, weighted by what an exact match adds over the count
+        exact_rows, exact_cols, exact_data = [], [], []
+        totals = numpy.zeros(len(ports1))
+        for i, ports in enumerate(ports1):
+            for port_name, port_descs in ports.iteritems():
+                for port_desc in port_descs:
+                    count_rows.append(i)
+                    count_cols.append(index(descs, port_desc))
+                totals[i] += len(port_descs)
+                weight = exact_match(port_descs) - len(port_descs)
+                if weight:
+                    exact_rows.append(i)
+                    exact_cols.append(index(keys, (port_name,
+                                                   tuple(port_descs))))
+                    exact_data.append(weight)
+        # descriptors and ports present on each module of p2
+        has_descs = set()
+        has_keys = set()
+        for j, ports in enumerate(ports2):
+            for port_name, port_descs in ports.iteritems():
+                has_descs.update((j, descs[port_desc])
+                                 for port_desc in port_descs
+                                 if port_desc in descs)
+                key = (port_name, tuple(port_descs))
+                if key in keys:
+                    has_keys.add((j, keys[key]))
+
+        def matrix(entries, shape, data=None):
+            if data is None:
+                rows = [e[0] for e in entries]
+                cols = [e[1] for e in entries]
+                data = numpy.ones(len(rows))
+            else:
+                rows, cols = entries
+            return sparse.coo_matrix((data, (rows, cols)), shape=shape,
+                                     dtype=float).tocsr()
+        n1 = len(ports1)
+        n2 = len(ports2)
+        counts = matrix((count_rows, count_cols), (n1, len(descs)),
+                        numpy.ones(len(count_rows)))
+        present = matrix(has_descs, (n2, len(descs)))
+        matches = (counts * present.T).toarray()
+        if exact_data:
+            exact = matrix((exact_rows, exact_cols), (n1, len(keys)),
+                           exact_data)
+            present = matrix(has_keys, (n2, len(keys)))
+            matches += (exact * present.T).toarray()
+
+        no_ports = totals == 0
+        totals[no_ports] = 1
+        s8y = matches / totals[:, None]
+        s8y[no_ports, :] = 0.2
+        return s8y
+
     ##########################################################################
     # Atomic comparisons for modules and connections
 
@@ -477,3 +589,73 @@ class EigenPipelineSimilarity2(EigenBase):
 
 
     
+
+##############################################################################
+
+import unittest
+
+class TestEigenBase(unittest.TestCase):
+    @staticmethod
+    def make_pipeline(rng, size):
+        from vistrails.core.modules.basic_modules import identifier as basic
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.packages.pythonCalc import identifier as calc
+
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+        sources = []
+        for i in xrange(size):
+            name = rng.choice(['Integer', 'Float', 'String', 'List',
+                               'PythonCalc', 'StandardOutput'])
+            module = controller.add_module(
+                    calc if name == 'PythonCalc' else basic, name)
+            if name == 'PythonCalc':
+                for port in ('value1', 'value2'):
+                    if sources and rng.random() < 0.8:
+                        controller.add_connection(rng.choice(sources).id,
+                                                  'value', module.id, port)
+            elif name == 'StandardOutput' and sources:
+                controller.add_connection(rng.choice(sources).id, 'value',
+                                          module.id, 'value')
+            if name in ('Integer', 'Float', 'PythonCalc'):
+                sources.append(module)
+        return controller.current_pipeline
+
+    def test_vectorized_similarity(self):
+        """Similarities are the same as comparing every pair"""
+        import random
+
+        rng = random.Random(4)
+        p1 = self.make_pipeline(rng, 25)
+        p2 = self.make_pipeline(rng, 30)
+        e = EigenBase(p1, p2)
+
+        (n1, n2) = e._vertex_s8y.shape
+        self.assertEqual((n1, n2), (25, 30))
+        for i in xrange(n1):
+            for j in xrange(n2):
+                (in_s8y, out_s8y) = e.compare_modules(
+                        e._g1_vertex_map.inverse[i],
+                        e._g2_vertex_map.inverse[j])
+                self.assertEqual(e._input_vertex_s8y[i, j], in_s8y)
+                self.assertEqual(e._output_vertex_s8y[i, j], out_s8y)
+
+        (n1, n2) = e._edge_s8y.shape
+        self.assertEqual((n1, n2), (len(p1.connections),
+                                    len(p2.connections)))
+        nonzero = 0
+        for i in xrange(n1):
+            for j in xrange(n2):
+                s8y = e.compare_connections(e._g1_edge_map.inverse[i],
+                                            e._g2_edge_map.inverse[j])
+                self.assertEqual(e._edge_s8y[i, j], s8y)
+                nonzero += s8y != 0.0
+        self.assertTrue(0 < nonzero < n1 * n2)
+
+    def test_empty(self):
+        from vistrails.core.vistrail.pipeline import Pipeline
+
+        e = EigenBase(Pipeline(), Pipeline())
+        self.assertEqual(e._vertex_s8y.shape, (0, 0))
+        self.assertEqual(e._edge_s8y.shape, (0, 0))
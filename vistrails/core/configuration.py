@@ -78,6 +78,7 @@ enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 NoExecute: Do not execute specified workflows
 executionLog: Track execution provenance when running workflows
+executionLogStore: Database where module executions are also recorded
 fileDir: Default vistrail directory
 fixedCustomVersionColorSaturation: Don't vary custom color with age
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
@@ -222,6 +223,13 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+executionLogStore: Path
+
+    A SQLite database where module executions are also recorded, one row
+    each, so that their times and failures can be queried across the
+    whole log (see vistrails.core.log.store). Relative paths are in the
+    .vistrails directory.
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -700,6 +708,7 @@ base_config = {
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
+     ConfigField('executionLogStore', None, ConfigPath),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
                  widget_type="combo",
@@ -127,14 +127,25 @@ def run_and_get_results(w_list, parameters='',
                 current_workflow = JobWorkflow(version)
                 jobMonitor.startWorkflow(current_workflow)
 
+        conf = get_vistrails_configuration()
+        if conf.jobCheckInterval and not conf.jobAutorun:
+            # wait for all the jobs at once instead of one module at a time
+            jobMonitor.enablePolling()
         try:
-            (results, _) = \
-            controller.execute_current_workflow(custom_aliases=aliases,
-                                                custom_params=params,
-                                                extra_info=extra_info,
-                                                reason=reason)
+            while True:
+                (results, _) = \
+                controller.execute_current_workflow(custom_aliases=aliases,
+                                                    custom_params=params,
+                                                    extra_info=extra_info,
+                                                    reason=reason)
+                if not jobMonitor.waitForJobs():
+                    break
+                # the jobs are done: resume the workflow
+                jobMonitor.finishWorkflow()
+                jobMonitor.startWorkflow(current_workflow)
         finally:
             jobMonitor.finishWorkflow()
+            jobMonitor.disablePolling()
         new_version = controller.current_version
         if new_version != version:
             debug.log("Version '%s' (%s) was upgraded. The actual "
@@ -272,12 +283,16 @@ def run(w_list, parameters='', update_vistrail=True,
     return all_errors
 
 def run_parameter_exploration(locator, pe_id, extra_info = {},
-                              reason="Console Mode Parameter Exploration Execution"):
+                              reason="Console Mode Parameter Exploration Execution",
+                              sampler=None, objective=None):
     """run_parameter_exploration(w_list: (locator, version),
                                  pe_id: str/int,
-                                 reason: str) -> (pe_id, [error msg])
+                                 reason: str, sampler: Sampler,
+                                 objective: (int, str)) -> (pe_id, [error msg])
     Run parameter exploration in w, and returns an interpreter result object.
     version can be a tag name or a version id.
+    sampler and objective select the executed combinations, see
+    VistrailController.executeParameterExploration().
     
     """
     if is_running_gui():
@@ -294,7 +309,9 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
                 pe = controller.vistrail.get_named_paramexp(pe_id)
             controller.change_selected_version(pe.action_id)
             controller.executeParameterExploration(pe, extra_info=extra_info,
-                                                   showProgress=False)
+                                                   showProgress=False,
+                                                   sampler=sampler,
+                                                   objective=objective)
         except Exception, e:
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
@@ -40,7 +40,7 @@ import base64
 import copy
 import gc
 import cPickle as pickle
-
+import threading
 import time
 
 from vistrails.core.common import InstanceObject, VistrailsInternalError
@@ -49,12 +49,11 @@ from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
 from vistrails.core.log.controller import DummyLogController
-from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
-                                                 Generator
+from vistrails.core.modules.basic_modules import identifier as basic_pkg
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.modules.vistrails_module import ModuleBreakpoint, \
-    ModuleConnector, ModuleError, ModuleErrors, ModuleHadError, \
-    ModuleSuspended, ModuleWasSuspended
+from vistrails.core.modules.vistrails_module import ExecutionContext, \
+    ModuleBreakpoint, ModuleConnector, ModuleError, ModuleErrors, \
+    ModuleHadError, ModuleSuspended, ModuleWasSuspended
 from vistrails.core.reportusage import record_usage
 from vistrails.core.utils import DummyView
 import vistrails.core.system
@@ -163,8 +162,8 @@ class ViewUpdatingLogController(object):
         if i in self.ids:
             self.ids.remove(i)
             self.view.set_execution_progress(
-                    1.0 - ((len(self.ids) + len(Generator.generators)) * 1.0 /
-                           (self.nb_modules + len(Generator.generators))))
+                    1.0 - ((len(self.ids) + len(obj.streams)) * 1.0 /
+                           (self.nb_modules + len(obj.streams))))
 
         msg = '' if error is None else error.msg
         self.log.finish_execution(obj, msg, errorTrace,
@@ -214,7 +213,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._persistent_pipeline = vistrails.core.vistrail.pipeline.Pipeline()
         self._objects = {}
         self.filePool = self._file_pool
-        self._streams = []
+        # Guards the persistent pipeline, so that pipelines can be executed
+        # from several threads
+        self._lock = threading.RLock()
 
     def clear(self):
         self._file_pool.cleanup()
@@ -233,13 +234,15 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         depend on them."""
         if not modules_to_clean:
             return
-        g = self._persistent_pipeline.graph
-        modules_to_clean = (set(modules_to_clean) &
-                            set(self._persistent_pipeline.modules.iterkeys()))
-        dependencies = g.vertices_topological_sort(modules_to_clean)
-        for v in dependencies:
-            self._persistent_pipeline.delete_module(v)
-            del self._objects[v]
+        with self._lock:
+            g = self._persistent_pipeline.graph
+            modules_to_clean = (
+                    set(modules_to_clean) &
+                    set(self._persistent_pipeline.modules.iterkeys()))
+            dependencies = g.vertices_topological_sort(modules_to_clean)
+            for v in dependencies:
+                self._persistent_pipeline.delete_module(v)
+                del self._objects[v]
 
     def clean_non_cacheable_modules(self):
         """clean_non_cacheable_modules() -> None
@@ -247,10 +250,11 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         Removes all modules that are not cacheable from the persistent
         pipeline, and the modules that depend on them.
         """
-        non_cacheable_modules = [i for
-                                 (i, mod) in self._objects.iteritems()
-                                 if not mod.is_cacheable()]
-        self.clean_modules(non_cacheable_modules)
+        with self._lock:
+            non_cacheable_modules = [i for
+                                     (i, mod) in self._objects.iteritems()
+                                     if not mod.is_cacheable()]
+            self.clean_modules(non_cacheable_modules)
 
     def _clear_package(self, identifier):
         """clear_package(identifier: str) -> None
@@ -352,93 +356,102 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
 
         self.update_params(pipeline, params)
         
-        (tmp_to_persistent_module_map,
-         conn_map,
-         module_added_set,
-         conn_added_set) = self.add_to_persistent_pipeline(pipeline)
-
-        # Create the new objects
-        for i in module_added_set:
-            persistent_id = tmp_to_persistent_module_map[i]
-            module = self._persistent_pipeline.modules[persistent_id]
-            obj = self._objects[persistent_id] = module.summon()
-            obj.interpreter = self
-            obj.id = persistent_id
-            obj.signature = module._signature
+        with self._lock:
+            (tmp_to_persistent_module_map,
+             conn_map,
+             module_added_set,
+             conn_added_set) = self.add_to_persistent_pipeline(pipeline)
+
+            # Create the new objects
+            for i in module_added_set:
+                persistent_id = tmp_to_persistent_module_map[i]
+                module = self._persistent_pipeline.modules[persistent_id]
+                obj = self._objects[persistent_id] = module.summon()
+                obj.interpreter = self
+                obj.id = persistent_id
+                obj.signature = module._signature
             
-            # Checking if output should be stored
-            if module.has_annotation_with_key('annotate_output'):
-                annotate_output = module.get_annotation_by_key('annotate_output')
-                #print annotate_output
-                if annotate_output:
-                    obj.annotate_output = True
-
-            for f in module.functions:
-                connector = None
-                if len(f.params) == 0:
-                    connector = ModuleConnector(create_null(), 'value',
-                                                f.get_spec('output'))
-                elif len(f.params) == 1:
-                    p = f.params[0]
-                    try:
-                        constant = create_constant(p, module)
-                        connector = ModuleConnector(constant, 'value',
+                # Checking if output should be stored
+                if module.has_annotation_with_key('annotate_output'):
+                    annotate_output = module.get_annotation_by_key('annotate_output')
+                    #print annotate_output
+                    if annotate_output:
+                        obj.annotate_output = True
+
+                for f in module.functions:
+                    connector = None
+                    if len(f.params) == 0:
+                        connector = ModuleConnector(create_null(), 'value',
                                                     f.get_spec('output'))
-                    except Exception, e:
-                        debug.unexpected_exception(e)
-                        err = ModuleError(
-                                module,
-                                "Uncaught exception creating Constant from "
-                                "%r: %s" % (
-                                p.strValue,
-                                debug.format_exception(e)))
-                        errors[i] = err
-                        to_delete.append(obj.id)
-                else:
-                    tupleModule = vistrails.core.interpreter.base.InternalTuple()
-                    tupleModule.length = len(f.params)
-                    for (j,p) in enumerate(f.params):
+                    elif len(f.params) == 1:
+                        p = f.params[0]
                         try:
                             constant = create_constant(p, module)
-                            constant.update()
                             connector = ModuleConnector(constant, 'value',
                                                         f.get_spec('output'))
-                            tupleModule.set_input_port(j, connector)
                         except Exception, e:
                             debug.unexpected_exception(e)
                             err = ModuleError(
                                     module,
-                                    "Uncaught exception creating Constant "
-                                    "from %r: %s" % (
+                                    "Uncaught exception creating Constant from "
+                                    "%r: %s" % (
                                     p.strValue,
                                     debug.format_exception(e)))
                             errors[i] = err
                             to_delete.append(obj.id)
-                    connector = ModuleConnector(tupleModule, 'value',
-                                                f.get_spec('output'))
-                if connector:
-                    obj.set_input_port(f.name, connector, is_method=True)
-
-        # Create the new connections
-        for i in conn_added_set:
-            persistent_id = conn_map[i]
-            conn = self._persistent_pipeline.connections[persistent_id]
-            src = self._objects[conn.sourceId]
-            dst = self._objects[conn.destinationId]
-            self.make_connection(conn, src, dst)
-
-        if self.done_summon_hook:
-            self.done_summon_hook(self._persistent_pipeline, self._objects)
-        for callable_ in done_summon_hooks:
-            callable_(self._persistent_pipeline, self._objects)
-
-        tmp_id_to_module_map = {}
-        for i, j in tmp_to_persistent_module_map.iteritems():
-            tmp_id_to_module_map[i] = self._objects[j]
-        return (tmp_id_to_module_map, tmp_to_persistent_module_map.inverse,
-                module_added_set, conn_added_set, to_delete, errors)
-
-    def execute_pipeline(self, pipeline, tmp_id_to_module_map, 
+                    else:
+                        tupleModule = vistrails.core.interpreter.base.InternalTuple()
+                        tupleModule.length = len(f.params)
+                        for (j,p) in enumerate(f.params):
+                            try:
+                                constant = create_constant(p, module)
+                                constant.update()
+                                connector = ModuleConnector(constant, 'value',
+                                                            f.get_spec('output'))
+                                tupleModule.set_input_port(j, connector)
+                            except Exception, e:
+                                debug.unexpected_exception(e)
+                                err = ModuleError(
+                                        module,
+                                        "Uncaught exception creating Constant "
+                                        "from %r: %s" % (
+                                        p.strValue,
+                                        debug.format_exception(e)))
+                                errors[i] = err
+                                to_delete.append(obj.id)
+                        connector = ModuleConnector(tupleModule, 'value',
+                                                    f.get_spec('output'))
+                    if connector:
+                        obj.set_input_port(f.name, connector, is_method=True)
+
+            # Create the new connections
+            for i in conn_added_set:
+                persistent_id = conn_map[i]
+                conn = self._persistent_pipeline.connections[persistent_id]
+                src = self._objects[conn.sourceId]
+                dst = self._objects[conn.destinationId]
+                self.make_connection(conn, src, dst)
+
+            if self.done_summon_hook:
+                self.done_summon_hook(self._persistent_pipeline, self._objects)
+            for callable_ in done_summon_hooks:
+                callable_(self._persistent_pipeline, self._objects)
+
+            tmp_id_to_module_map = {}
+            for i, j in tmp_to_persistent_module_map.iteritems():
+                tmp_id_to_module_map[i] = self._objects[j]
+            return (tmp_id_to_module_map, tmp_to_persistent_module_map.inverse,
+                    module_added_set, conn_added_set, to_delete, errors)
+
+    def execute_pipeline(self, pipeline, tmp_id_to_module_map,
+                         persistent_to_tmp_id_map, **kwargs):
+        # The attributes the execution sets on the modules are kept in its
+        # own context, as the modules might be in use by other executions
+        with ExecutionContext():
+            return self._execute_pipeline(pipeline, tmp_id_to_module_map,
+                                          persistent_to_tmp_id_map, **kwargs)
+
+    def _execute_pipeline(self, pipeline, tmp_id_to_module_map, 
                          persistent_to_tmp_id_map, **kwargs):
         def fetch(name, default):
             return kwargs.pop(name, default)
@@ -484,30 +497,39 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         def make_change_parameter(obj):
             return lambda *args: change_parameter(obj, *args)
 
+        # Streaming modules of this execution
+        streams = []
+
         # Update **all** modules in the current pipeline
+        # These attributes are specific to this execution, as the module
+        # might be in use by other executions in other threads
         for i, obj in tmp_id_to_module_map.iteritems():
             obj.in_pipeline = True # set flag to indicate in pipeline
             obj.logging = logging_obj
+            obj.streams = streams
             obj.change_parameter = make_change_parameter(obj)
-            
+            obj.computed = False
+
             # Update object pipeline information
-            obj.moduleInfo['locator'] = locator
-            obj.moduleInfo['version'] = current_version
-            obj.moduleInfo['moduleId'] = i
-            obj.moduleInfo['pipeline'] = pipeline
-            obj.moduleInfo['controller'] = controller
+            module_info = dict(obj.moduleInfo)
+            module_info['locator'] = locator
+            module_info['version'] = current_version
+            module_info['moduleId'] = i
+            module_info['pipeline'] = pipeline
+            module_info['controller'] = controller
             # extract job monitor from controller if this is the top level
             if controller:
-                obj.moduleInfo['job_monitor'] = controller.jobMonitor
+                module_info['job_monitor'] = controller.jobMonitor
             else:
-                obj.moduleInfo['job_monitor'] = job_monitor
+                module_info['job_monitor'] = job_monitor
 
             if extra_info is not None:
-                obj.moduleInfo['extra_info'] = extra_info
+                module_info['extra_info'] = extra_info
             if reason is not None:
-                obj.moduleInfo['reason'] = reason
+                module_info['reason'] = reason
             if actions is not None:
-                obj.moduleInfo['actions'] = actions
+                module_info['actions'] = actions
+            obj.moduleInfo = module_info
 
         ## Checking 'sinks' from kwargs to resolve only requested sinks
         # Note that we accept any module in 'sinks', even if it's not actually
@@ -520,9 +542,6 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             persistent_sinks = [tmp_id_to_module_map[sink]
                                 for sink in pipeline.graph.sinks()]
 
-        self._streams.append(Generator.generators)
-        Generator.generators = []
-
         # Update new sinks
         for obj in persistent_sinks:
             abort = False
@@ -555,17 +574,16 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             if stop_on_error or abort:
                 break
 
-        if Generator.generators:
-            record_usage(generators=len(Generator.generators))
+        if streams:
+            record_usage(generators=len(streams))
         # execute all generators until inputs are exhausted
         # this makes sure branching and multiple sinks are executed correctly
-        if not logging_obj.errors and not logging_obj.suspended and \
-                                                          Generator.generators:
+        if not logging_obj.errors and not logging_obj.suspended and streams:
             result = True
             abort = False
             while result is not None:
                 try:
-                    for m in Generator.generators:
+                    for m in streams:
                         result = m.generator.next()
                     continue
                 except AbortExecution:
@@ -591,11 +609,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 if stop_on_error or abort:
                     break
 
-        Generator.generators = self._streams.pop()
-
         if self.done_update_hook:
             self.done_update_hook(self._persistent_pipeline, self._objects)
-                
+            
         # objs, errs, and execs are mappings that use the local ids as keys,
         # as opposed to the persistent ids.
         # They are thus ideal to external consumption.
@@ -881,10 +897,13 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         return (object_map, module_id_map, connection_id_map)
 
     __instance = None
+    __instance_lock = threading.Lock()
     @staticmethod
     def get():
         if not CachedInterpreter.__instance:
-            CachedInterpreter.__instance = CachedInterpreter()
+            with CachedInterpreter.__instance_lock:
+                if not CachedInterpreter.__instance:
+                    CachedInterpreter.__instance = CachedInterpreter()
         return CachedInterpreter.__instance
 
     @staticmethod
@@ -958,6 +977,78 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_concurrent_executions(self):
+        """Executes pipelines sharing a module from several threads."""
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.modules.basic_modules import ConcatenateString
+        from vistrails.core.vistrail.connection import Connection
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.core.vistrail.port import Port
+
+        def make_pipeline(suffix):
+            def concatenate(mod_id, functions):
+                return Module(
+                        name='ConcatenateString', package=basic_pkg,
+                        version=basic_version, id=mod_id,
+                        functions=[ModuleFunction(
+                                name=port, parameters=[ModuleParam(
+                                        pos=0, type='String', val=value)])
+                                   for port, value in functions])
+            pipeline = Pipeline()
+            pipeline.add_module(concatenate(0, [('str1', 'shared')]))
+            pipeline.add_module(concatenate(1, [('str2', suffix)]))
+            pipeline.add_connection(Connection(id=0, ports=[
+                    Port(id=0, type='source', moduleId=0, name='value',
+                         signature='(%s:String)' % basic_pkg),
+                    Port(id=1, type='destination', moduleId=1, name='str1',
+                         signature='(%s:String)' % basic_pkg)]))
+            return pipeline
+
+        from vistrails.core.packagemanager import get_package_manager
+        basic_version = get_package_manager().get_package(basic_pkg).version
+
+        computes = []
+        old_compute = ConcatenateString.compute
+        def slow_compute(module):
+            computes.append(module.id)
+            time.sleep(0.1)
+            old_compute(module)
+        ConcatenateString.compute = slow_compute
+
+        interpreter = CachedInterpreter.get()
+        interpreter.flush()
+        results = {}
+        def run(i):
+            results[i] = interpreter.execute(
+                    make_pipeline('-%d' % i),
+                    locator=XMLFileLocator('foo.xml'),
+                    current_version=1)
+        try:
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in xrange(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            ConcatenateString.compute = old_compute
+
+            self.assertEqual(len(results), 4)
+            shared = set()
+            for i, result in results.iteritems():
+                self.assertFalse(result.errors)
+                self.assertEqual(result.objects[1].get_output('value'),
+                                 'shared-%d' % i)
+                shared.add(result.objects[0])
+            # The upstream module is cached and computed once
+            self.assertEqual(len(shared), 1)
+            self.assertEqual(len(computes), 5)
+        finally:
+            ConcatenateString.compute = old_compute
+            interpreter.flush()
+
 
 if __name__ == '__main__':
     unittest.main()
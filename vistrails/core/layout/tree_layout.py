@@ -51,10 +51,21 @@ The original paper is:
     A node-positioning algorithm for general trees.
     Softw., Pract. Exper., 20(7):685-705, 1990.
 
+The walks are iterative, so very deep trees do not hit the recursion
+limit. Nodes can also be reused from one layout to the next (see
+TreeLW.reuseNode): subtrees that did not change keep the relative
+positions computed by the previous layout and are not walked again.
+
 """
 
 from __future__ import division
 
+import itertools
+
+# each layout gets a new generation number; the "ancestor" pointers
+# set by previous layouts are ignored instead of being reset
+_generations = itertools.count(1)
+
 class TreeLW(object):
     """
     The input to the algorithm must be a tree
@@ -91,21 +102,77 @@ class TreeLW(object):
         self.maxLevel = max(self.maxLevel, maxLevel)
 
     def __dfsUpdateLevel(self, node):
-        if node.parent is None:
-            node.level = 0
-        else:
-            node.level = node.parent.level + 1
-        maxLevel = node.level
-        for child in node.children:
-            maxLevel = max(maxLevel, self.__dfsUpdateLevel(child))
+        maxLevel = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.parent is None:
+                node.level = 0
+            else:
+                node.level = node.parent.level + 1
+            maxLevel = max(maxLevel, node.level)
+            stack.extend(node.children)
         return maxLevel
 
+    def updateLevels(self):
+        """updateLevels() -> None
+        Recomputes the level of all nodes, for trees built with
+        NodeLW.addChild() in any order.
+
+        """
+        self.maxLevel = 0
+        for v in self.nodes:
+            if v.parent is None:
+                self.maxLevel = max(self.maxLevel, self.__dfsUpdateLevel(v))
+
+    def reuseNode(self, node, width, height, object = None):
+        """reuseNode(node: NodeLW, width, height, object) -> NodeLW
+        Adds a node of a previous tree to this one, without parent or
+        children. Call updateDirty() once all the edges are added: the
+        nodes whose subtree is unchanged are not walked again.
+
+        """
+        if node.width != width or node.height != height:
+            node.dirty = True
+        node.width = width
+        node.height = height
+        node.object = object
+        node.previousChildren = node.children
+        node.children = []
+        node.parent = None
+        node.index = 0
+        node.level = 0
+        self.nodes.append(node)
+        return node
+
+    def updateDirty(self):
+        """updateDirty() -> None
+        Marks as dirty the nodes whose children changed since the
+        previous layout, and all the ancestors of dirty nodes.
+
+        """
+        changed = []
+        for v in self.nodes:
+            if v.previousChildren is not None:
+                if v.previousChildren != v.children:
+                    v.dirty = True
+                v.previousChildren = None
+            if v.dirty:
+                changed.append(v)
+        seen = set()
+        for v in changed:
+            v = v.parent
+            while v is not None and v not in seen:
+                seen.add(v)
+                v.dirty = True
+                v = v.parent
+
     def boundingBox(self):
-        kbb = KeepBoundingBox()
-        for w in self.nodes:
-            kbb.addPoint(w.x-w.width/2.0, w.y-w.height/2.0)
-            kbb.addPoint(w.x+w.width/2.0, w.y+w.height/2.0)
-        return kbb.getBoundingBox()            
+        minx = min(w.x-w.width/2.0 for w in self.nodes)
+        miny = min(w.y-w.height/2.0 for w in self.nodes)
+        maxx = max(w.x+w.width/2.0 for w in self.nodes)
+        maxy = max(w.y+w.height/2.0 for w in self.nodes)
+        return [minx, miny, maxx-minx, maxy-miny]
 
     def getMaxNodeHeightPerLevel(self):
         result = [0] * (self.maxLevel+1)
@@ -184,10 +251,22 @@ class NodeLW(object):
         self.mod = 0
         self.prelim = 0
         self.ancestor = None
+        self.ancestorGeneration = 0
         self.thread = None
         self.change = 0
         self.shift = 0
 
+        # layout of the subtree relative to this node, kept from
+        # one layout to the next while the subtree does not change
+        self.dirty = True
+        self.previousChildren = None
+        self.midpoint = 0
+        self.depth = 0
+        self.leftEnd = None
+        self.rightEnd = None
+        self.leftEndState = None
+        self.rightEndState = None
+
         # final center position
         self.x = 0
         self.y = 0
@@ -264,12 +343,9 @@ class TreeLayoutLW(object):
         self.treeLayout()
 
     def treeLayout(self):
-        for v in self.tree.nodes:
-            v.mod = 0
-            v.thread = None
-            v.ancestor = v
-            
+        self.generation = next(_generations)
         r = self.tree.root()
+        r.mod = 0
         self.firstWalk(r)
         self.secondWalk(r, -r.prelim)
         self.setVerticalPositions()
@@ -302,31 +378,90 @@ class TreeLayoutLW(object):
         return self.xdistance + (v1.width + v2.width)/2.0        
 
 
-    def firstWalk(self, v):
-        
-        if v.isLeaf():
-            v.prelim = 0
-            w = v.leftSibling()
-            if w is not None:
-                v.prelim = w.prelim + self.gap(w,v)
+    def firstWalk(self, r):
+        # children are walked before their parent; unchanged
+        # subtrees are restored instead of being walked again
+        order = []
+        stack = [r]
+        while stack:
+            v = stack.pop()
+            order.append(v)
+            if v.dirty:
+                stack.extend(v.children)
+        for v in reversed(order):
+            if v.dirty:
+                self.walkSubtree(v)
+            else:
+                self.restoreSubtree(v)
+        self.placeNode(r)
 
+    def walkSubtree(self, v):
+        """walkSubtree(v: NodeLW) -> None
+        Lays out the subtree of v relative to v, assuming the
+        subtrees of its children are already laid out. This is the
+        part of the original firstWalk that does not depend on the
+        siblings of v.
+
+        """
+        if v.isLeaf():
+            v.thread = None
+            v.depth = 0
+            v.leftEnd = v.rightEnd = v
+            v.leftEndState = v.rightEndState = (None, 0)
         else:
-            
+            for w in v.children:
+                w.mod = 0
+                w.change = 0
+                w.shift = 0
+
             defaultAncestor = v.leftChild()
             for w in v.children:
-                self.firstWalk(w)
+                self.placeNode(w)
                 defaultAncestor = self.apportion(w, defaultAncestor)
             self.executeShifts(v)
-            
-            midpoint = (v.leftChild().prelim + v.rightChild().prelim) / 2.0
 
-            w = v.leftSibling()
+            v.midpoint = (v.leftChild().prelim + v.rightChild().prelim) / 2.0
+
+            # the ends of the contours of this subtree are the only
+            # nodes that the layout of its ancestors modifies
+            left = right = v.leftChild()
+            for w in v.children:
+                if w.depth > left.depth:
+                    left = w
+                if w.depth >= right.depth:
+                    right = w
+            v.depth = left.depth + 1
+            v.leftEnd = left.leftEnd
+            v.rightEnd = right.rightEnd
+            v.leftEndState = (v.leftEnd.thread, v.leftEnd.mod)
+            v.rightEndState = (v.rightEnd.thread, v.rightEnd.mod)
+        v.dirty = False
+
+    def restoreSubtree(self, v):
+        """restoreSubtree(v: NodeLW) -> None
+        Restores the layout of an unchanged subtree as it was right
+        after walkSubtree(v).
+
+        """
+        v.leftEnd.thread, v.leftEnd.mod = v.leftEndState
+        v.rightEnd.thread, v.rightEnd.mod = v.rightEndState
+
+    def placeNode(self, v):
+        """placeNode(v: NodeLW) -> None
+        Places v next to its left sibling.
+
+        """
+        w = v.leftSibling()
+        if v.isLeaf():
+            v.prelim = 0
             if w is not None:
                 v.prelim = w.prelim + self.gap(w,v)
-                v.mod = v.prelim - midpoint
+        else:
+            if w is not None:
+                v.prelim = w.prelim + self.gap(w,v)
+                v.mod = v.prelim - v.midpoint
             else:
-                v.prelim = midpoint
-
+                v.prelim = v.midpoint
 
     def apportion(self,  v,  defaultAncestor):
 
@@ -369,6 +504,7 @@ class TreeLayoutLW(object):
                 vop = self.nextRight(vop)
 
                 vop.ancestor = v
+                vop.ancestorGeneration = self.generation
                 
                 shift = (vim.prelim + sim) - (vip.prelim + sip) + self.gap(vim,vip)
                 
@@ -424,15 +560,20 @@ class TreeLayoutLW(object):
             shift += w.shift + change
 
     def ancestor(self, vim, v, defaultAncestor):
-        if vim.ancestor.isSiblingOf(v):
+        if (vim.ancestorGeneration == self.generation and
+                vim.ancestor.isSiblingOf(v)):
             return vim.ancestor
         else:
             return defaultAncestor
 
     def secondWalk(self,  v, m):
-        v.x = v.prelim + m
-        for w in v.children:
-            self.secondWalk(w, m + v.mod)
+        stack = [(v, m)]
+        while stack:
+            v, m = stack.pop()
+            v.x = v.prelim + m
+            m += v.mod
+            for w in v.children:
+                stack.append((w, m))
 
 # graph
 if __name__ == "__main__":
@@ -89,6 +89,31 @@ class VistrailsTreeLayoutLW(object):
         self.scale = 0.0
         self.width = 0.0
 
+        # measured text widths, and the tree nodes of the last layout
+        # so that unchanged subtrees are not laid out again
+        self._text_widths = {}
+        self._tree_nodes = {}
+
+    def text_width(self, text):
+        """ text_width(text: str) -> float
+        Returns the width of text, measuring it only the first time
+
+        """
+        try:
+            return self._text_widths[text]
+        except KeyError:
+            width = self._text_widths[text] = self.text_width_f(text)
+            return width
+
+    def reset(self):
+        """ reset() -> None
+        Forgets the measured widths and the previous layout, when the
+        font or the vistrail changes
+
+        """
+        self._text_widths = {}
+        self._tree_nodes = {}
+
     def generateTreeLW(self, vistrail, graph):
         """ output_vistrail_graph(f: str) -> None
         Using vistrail and graph to generate layout
@@ -127,7 +152,7 @@ class VistrailsTreeLayoutLW(object):
                     X.add(first)
 
         # get widths and heights for the nodes
-        empty_width = self.text_horizontal_margin + self.text_width_f(" " * 5)
+        empty_width = self.text_horizontal_margin + self.text_width(" " * 5)
         
         # default height for all nodes
         height = self.text_height + self.text_vertical_margin
@@ -138,12 +163,18 @@ class VistrailsTreeLayoutLW(object):
         # create map from id to tree node
         mapTreeNodes = {}
 
-        # add the remaining nodes
+        # add the remaining nodes, reusing the ones from the previous
+        # layout
+        previousNodes = self._tree_nodes
         for id, tag in nodes:
-            width = self.text_horizontal_margin + self.text_width_f(tag)
+            width = self.text_horizontal_margin + self.text_width(tag)
             width = max(width, empty_width)
             # print "add node to the tree %d %s" % (id, tag)
-            mapTreeNodes[id] = tree.addNode(None,width,height,(id,tag))
+            node = previousNodes.get(id)
+            if node is not None:
+                mapTreeNodes[id] = tree.reuseNode(node,width,height,(id,tag))
+            else:
+                mapTreeNodes[id] = tree.addNode(None,width,height,(id,tag))
 
         # preserve the order of the edges
         # to add the children to their parents
@@ -151,10 +182,12 @@ class VistrailsTreeLayoutLW(object):
             # print "add arc into tree %d -> %d" % (parentId, childId)
             parent = mapTreeNodes[parentId]
             child = mapTreeNodes[childId]
-#             if child.parent is not None:
-#                 print "child already has a parent!!! %d -> %d" % (parentId, childId)
-#                 raise ValueError("Node already has a parent")
-            tree.changeParentOfNodeWithNoParent(parent, child)
+            if child.parent is not None:
+                raise ValueError("Node already has a parent")
+            parent.addChild(child)
+        tree.updateLevels()
+        tree.updateDirty()
+        self._tree_nodes = mapTreeNodes
 
         # return the tree
         return tree
@@ -174,15 +207,19 @@ class VistrailsTreeLayoutLW(object):
                               min_horizontal_separation,
                               min_vertical_separation)
 
-        # prepare the result
+        # prepare the result, updating the nodes of the previous one
+        previousNodes = self.nodes
         self.nodes = {}
         for v in tree.nodes:
             id, tag = v.object
-            newNode = NodeVistrailsTreeLayoutLW()
-            newNode.p = Point(v.x, v.y)
+            newNode = previousNodes.get(id)
+            if newNode is None:
+                newNode = NodeVistrailsTreeLayoutLW()
+                newNode.id = id
+            newNode.p.x = v.x
+            newNode.p.y = v.y
             newNode.width = v.width
             newNode.height = v.height
-            newNode.id = id
             # newNode.label = tag 
             self.nodes[id] = newNode
 
@@ -204,3 +241,92 @@ class VistrailsTreeLayoutLW(object):
         
         """
         self.nodes[id] = node
+
+################################################################################
+
+import unittest
+
+class TestVistrailsTreeLayoutLW(unittest.TestCase):
+    class FakeVistrail(object):
+        def __init__(self):
+            self.tags = {}
+            self.descriptions = {}
+
+        def get_tagMap(self):
+            return self.tags
+
+        def get_description(self, version):
+            return self.descriptions.get(version, "")
+
+    @staticmethod
+    def text_width(text):
+        return 7 * len(text)
+
+    def assert_same_layout(self, vistrail, graph, layout):
+        layout.layout_from(vistrail, graph)
+        fresh = VistrailsTreeLayoutLW(self.text_width, 12, 10, 5)
+        fresh.layout_from(vistrail, graph)
+        self.assertEqual(sorted(layout.nodes), sorted(fresh.nodes))
+        for id, node in fresh.nodes.iteritems():
+            self.assertAlmostEqual(layout.nodes[id].p.x, node.p.x)
+            self.assertAlmostEqual(layout.nodes[id].p.y, node.p.y)
+            self.assertEqual(layout.nodes[id].width, node.width)
+        self.assertAlmostEqual(layout.width, fresh.width)
+        self.assertAlmostEqual(layout.height, fresh.height)
+
+    def test_incremental(self):
+        """Changing the tree gives the same layout as starting over"""
+        import random
+        from vistrails.core.data_structures.graph import Graph
+
+        rng = random.Random(42)
+        vistrail = self.FakeVistrail()
+        graph = Graph()
+        graph.add_vertex(0)
+        widths = []
+        def text_width(text):
+            widths.append(text)
+            return self.text_width(text)
+        layout = VistrailsTreeLayoutLW(text_width, 12, 10, 5)
+        for version in xrange(1, 300):
+            choice = rng.random()
+            if choice < 0.7 or len(graph.vertices) < 3:
+                # add a version
+                graph.add_edge(rng.choice(graph.vertices.keys()), version)
+                if rng.random() < 0.3:
+                    vistrail.tags[version] = 'tag %d' % version
+            elif choice < 0.85:
+                # collapse a version into its parent
+                v = rng.choice(graph.vertices.keys())
+                if v == 0:
+                    continue
+                parent = graph.parent(v)
+                children = [c for c, _ in graph.edges_from(v)]
+                graph.delete_vertex(v)
+                vistrail.tags.pop(v, None)
+                for c in children:
+                    graph.add_edge(parent, c)
+            else:
+                # retag a version
+                v = rng.choice(graph.vertices.keys())
+                if v == 0:
+                    continue
+                vistrail.tags[v] = 'x' * rng.randint(0, 20)
+            if version % 10 == 0:
+                self.assert_same_layout(vistrail, graph, layout)
+        self.assertEqual(len(widths), len(set(widths)))
+
+    def test_deep_tree(self):
+        """Deep trees do not hit the recursion limit"""
+        import sys
+        from vistrails.core.data_structures.graph import Graph
+
+        graph = Graph()
+        depth = sys.getrecursionlimit() * 2
+        for version in xrange(1, depth):
+            graph.add_edge(version - 1, version)
+        layout = VistrailsTreeLayoutLW(self.text_width, 12, 10, 5)
+        layout.layout_from(self.FakeVistrail(), graph)
+        self.assertEqual(len(layout.nodes), depth)
+        self.assertEqual(len(set(n.p.x for n in layout.nodes.itervalues())),
+                         1)
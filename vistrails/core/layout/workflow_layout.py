@@ -59,6 +59,32 @@ def uniquify(seq, idfun=None):
     return result
 
 
+def count_inversions(seq):
+    """count_inversions(seq: list) -> int
+    Counts the pairs i < j with seq[i] > seq[j], in O(n log n).
+
+    """
+    # rank the values, then count with a binary indexed tree
+    ranks = dict((v, i + 1) for i, v in enumerate(sorted(set(seq))))
+    size = len(ranks)
+    tree = [0] * (size + 1)
+    inversions = 0
+    for n, v in enumerate(seq):
+        r = ranks[v]
+        # number of previous values <= v
+        smaller = 0
+        i = r
+        while i > 0:
+            smaller += tree[i]
+            i -= i & -i
+        inversions += n - smaller
+        i = r
+        while i <= size:
+            tree[i] += 1
+            i += i & -i
+    return inversions
+
+
 class Defaults(object):
     u            = 10.0
     label_margin = 20.0 
@@ -183,7 +209,7 @@ class Module(object):
             p.collectOppositeModules(self.cached_succ)
             self.cached_connections_succ.extend([c for c in p.connections])
 
-        uniquify(self.cached_succ)
+        self.cached_succ = uniquify(self.cached_succ)
         # print "%s's of cached_succ: " % (self.shortname),
         # print [m.name for m in self.cached_succ]
 
@@ -193,7 +219,7 @@ class Module(object):
         for p in self.input_ports:
             p.collectOppositeModules(self.cached_pred)
             self.cached_connections_pred.extend([c for c in p.connections])
-        uniquify(self.cached_pred)
+        self.cached_pred = uniquify(self.cached_pred)
 
         self.cached_num_succ     = len(self.cached_succ)
         self.cached_num_pred     = len(self.cached_pred)
@@ -513,29 +539,39 @@ class WorkflowLayout(object):
         if len(self.wf.modules) == 0:
             return
         
-        visited = set()
-        min_layer = [0]
-        def set_module_layer_number(module, layer_number):
-            module.layout_layer_number = layer_number
-            visited.add(module)
-            min_layer[0] = min(min_layer[0], layer_number)
+        # depth-first, without recursion so that long chains of
+        # modules do not hit the recursion limit
+        def neighbors(module, layer_number):
             for port in module.input_ports:
                 for conn in port.connections:
-                    if conn.source_port.module not in visited:
-                        set_module_layer_number(conn.source_port.module, layer_number-1)
+                    yield conn.source_port.module, layer_number-1
             for port in module.output_ports:
                 for conn in port.connections:
-                    if conn.target_port.module not in visited:
-                        set_module_layer_number(conn.target_port.module, layer_number+1)
-               
-        set_module_layer_number(self.wf.modules[0], 0)
+                    yield conn.target_port.module, layer_number+1
+
+        module = self.wf.modules[0]
+        module.layout_layer_number = 0
+        visited = set([module])
+        min_layer = [0]
+        stack = [neighbors(module, 0)]
+        while stack:
+            for module, layer_number in stack[-1]:
+                if module not in visited:
+                    module.layout_layer_number = layer_number
+                    visited.add(module)
+                    min_layer[0] = min(min_layer[0], layer_number)
+                    stack.append(neighbors(module, layer_number))
+                    break
+            else:
+                stack.pop()
                         
         #adjust all layers numbers so that the min is 0
         if min_layer[0] < 0:
             for module in self.wf.modules:
                 module.layout_layer_number -= min_layer[0]
 
-    def assign_module_permutation_to_each_layer(self, preserve_order=False):
+    def assign_module_permutation_to_each_layer(self, preserve_order=False,
+                                                max_sweeps=8):
         wf = self.wf
 
         # create layers
@@ -545,7 +581,7 @@ class WorkflowLayout(object):
 
         # sort modules by the current value of layout_layer_index
         for layer in layers.layers:
-            layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
+            layer.modules.sort(key=lambda m: m.layout_layer_index)
             for i in xrange(len(layer.modules)):
                 layer.modules[i].layout_layer_index = i
 
@@ -554,41 +590,60 @@ class WorkflowLayout(object):
 
         lastModified = [-1 for i in xrange(num_layers)]
 
+        # position of the modules in their layer, indexed by module key,
+        # and the (key, port offset) of their neighbors on the layers
+        # right above and below, so that the sweeps don't go through the
+        # connection and port objects
+        position = [0] * len(wf.modules)
+        neighbors_pred = [None] * len(wf.modules)
+        neighbors_succ = [None] * len(wf.modules)
+        for module in wf.modules:
+            position[module.key] = module.layout_layer_index
+            layer_number = module.layout_layer_number
+            neighbors_pred[module.key] = [
+                    (c.source_port.module.key, c.source_port.index/100.0)
+                    for c in module.cached_connections_pred
+                    if (c.source_port.module.layout_layer_number ==
+                            layer_number - 1)]
+            neighbors_succ[module.key] = [
+                    (c.target_port.module.key, c.target_port.index/100.0)
+                    for c in module.cached_connections_succ
+                    if (c.target_port.module.layout_layer_number ==
+                            layer_number + 1)]
+
         #
         # sweep down and up reducing the number of crossings
-        # using the barycentric method (heuristic)
+        # using the barycentric method (heuristic), for at most
+        # max_sweeps iterations and while the crossings decrease
         #
+        best_crossings = self.count_crossings()
+        best_position = list(position)
         iteration = 0
         updates = len(wf.modules)
-        while updates > 0 and iteration < 100:
-
-            # print "iteration: ", iteration
+        while updates > 0 and best_crossings > 0 and iteration < max_sweeps:
 
             updates = 0
 
             DOWN, UP = 1, -1
             for direction in [DOWN, UP]:
 
-                # print "   direction:", direction
-
                 delta = 1 if direction == DOWN else -1
 
                 i0, i1 = (0,num_layers) if direction == DOWN else (num_layers-1,-1)
 
+                neighbors = neighbors_pred if direction == DOWN \
+                            else neighbors_succ
+
                 # sweep "direction"
                 for i in xrange(i0+delta,i1,direction):
-                # for i in xrange(2,4):
-
 
                     i_prev = i-delta
-                    # print "      layer:"        , i
-                    # print "         layer_prev:", i_prev
 
                     layer = layers.layers[i]
 
                     # if one module on layer then continue
                     num_modules = len(layer.modules)
-                    if num_modules == 1:
+                    if num_modules <= 1:
                         continue
 
                     # if nothing chaged on this layer and the "previous" layer (in the sweep direction)
@@ -600,61 +655,46 @@ class WorkflowLayout(object):
                     # apply barycentric permutation to layer "i" using neighbors on layer "i + delta"
                     barycenters = [-1] * num_modules
                     for j in xrange(num_modules):
-
-                        module      = layer.modules[j]
-                        connections = \
-                            module.cached_connections_pred  \
-                            if direction == DOWN else       \
-                            module.cached_connections_succ
-
-                        value = 0.0
-                        for c in connections:
-                            opposite_port = c.source_port if direction == DOWN else c.target_port
-                            value += opposite_port.module.layout_layer_index + opposite_port.index/100.0
-                        if len(connections) > 0:
-                            value /= 1.0 * len(connections)
-                            barycenters[j] = value
+                        adjacent = neighbors[layer.modules[j].key]
+                        if adjacent:
+                            barycenters[j] = sum(position[k] + offset
+                                                 for k, offset in adjacent) \
+                                             / len(adjacent)
 
                     for j in xrange(1,num_modules):
                         if barycenters[j] < 0:
                             barycenters[j] = barycenters[j-1] + 1e-5
 
-                    # print "         barycenters: ", barycenters
-
-
-                    new_order = [(barycenters[j], layer.modules[j]) for j in xrange(num_modules)]
-                    new_order.sort()
-
-                    # print "            indices before: ", [u.layout_layer_index for u in layer.modules]
-                    # print "            indices after:  ", [aux[0] for aux in new_order]
-                    # print "            names before =  ",[mod.name for mod in layer.modules]
-
-                    for j in xrange(num_modules):
-                        module = new_order[j][1]
-                        if module.layout_layer_index != j:
-                            # print "            module indexed %d goes to index %d" % (module.layout_layer_index,j)
-                            lastModified[i] = iteration
-                            updates += 1
-
-                    if lastModified[i] == iteration:
+                    # stable sort: ties keep their current order
+                    new_order = sorted(xrange(num_modules),
+                                       key=barycenters.__getitem__)
+                    if new_order != range(num_modules):
+                        lastModified[i] = iteration
+                        updates += sum(1 for j in xrange(num_modules)
+                                       if new_order[j] != j)
+                        layer.modules = [layer.modules[j] for j in new_order]
                         for j in xrange(num_modules):
-                            module = new_order[j][1]
+                            module = layer.modules[j]
                             module.layout_layer_index = j
-
-
-                    # sort using the last layout_layer_index
-                    layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
-                    # print "            names after =",[mod.name for mod in layer.modules]
-
-
-                # print "      updates: ", updates
+                            position[module.key] = j
 
             # iteration
             iteration += 1
 
-            # break
-            break
-        
+            if updates > 0:
+                # early exit once the crossings stop decreasing
+                crossings = self.count_crossings()
+                if crossings >= best_crossings:
+                    break
+                best_crossings = crossings
+                best_position = list(position)
+
+        # keep the permutation with the fewest crossings
+        for module in wf.modules:
+            module.layout_layer_index = best_position[module.key]
+        for layer in layers.layers:
+            layer.modules.sort(key=lambda m: m.layout_layer_index)
+
         if preserve_order:
             for layer in layers.layers:                
 
@@ -678,6 +718,32 @@ class WorkflowLayout(object):
                 for i in range(len(layer.modules)):
                     layer.modules[i].layout_layer_index = i
             
+    def count_crossings(self):
+        """count_crossings() -> int
+        Counts the pairs of connections that cross each other, among the
+        connections between the same two layers, using the current
+        permutation of the modules in each layer.
+
+        """
+        # group connections by the layers they join
+        layer_pairs = {}
+        for conn in self.wf.connections:
+            source = conn.source_port
+            target = conn.target_port
+            key = (source.module.layout_layer_number,
+                   target.module.layout_layer_number)
+            layer_pairs.setdefault(key, []).append(
+                    ((source.module.layout_layer_index, source.index),
+                     (target.module.layout_layer_index, target.index)))
+
+        # two connections cross if their ends are in opposite orders
+        crossings = 0
+        for pairs in layer_pairs.itervalues():
+            if len(pairs) > 1:
+                pairs.sort()
+                crossings += count_inversions([t for s, t in pairs])
+        return crossings
+
     #
     # this method is "friend" of the classes above in the C++ sense:
     # it can access and modify
@@ -691,7 +757,7 @@ class WorkflowLayout(object):
             layers.addModule(module, module.layout_layer_number)
 
         for layer in layers.layers:# sort using the last layout_layer_index
-            layer.modules.sort(lambda a,b: a.layout_layer_index - b.layout_layer_index)
+            layer.modules.sort(key=lambda m: m.layout_layer_index)
 
         # spread layers
         min_x = max_x = 0.0
@@ -767,11 +833,72 @@ class WorkflowLayout(object):
 
         return page
 
-    def run_all(self, layer_x_separation=50, layer_y_separation=50, preserve_order=False, no_gaps=False):
+    def run_all(self, layer_x_separation=50, layer_y_separation=50, preserve_order=False, no_gaps=False,
+                max_sweeps=8):
         self.compute_module_sizes()
         if no_gaps:
             self.assign_module_to_layers_no_gaps()
         else:
             self.assign_modules_to_layers()
-        self.assign_module_permutation_to_each_layer(preserve_order)
-        self.compute_layout(layer_x_separation, layer_y_separation)
\ No newline at end of file
+        self.assign_module_permutation_to_each_layer(preserve_order,
+                                                     max_sweeps)
+        self.compute_layout(layer_x_separation, layer_y_separation)
+
+####################################################
+
+import unittest
+
+class TestWorkflowLayout(unittest.TestCase):
+    @staticmethod
+    def module_size(module):
+        return (len(module.name) * 6 + 20, 50)
+
+    def make_layout(self, wf):
+        return WorkflowLayout(wf, self.module_size, (5, 5), (10, 10), 3)
+
+    def test_count_inversions(self):
+        import itertools
+        import random
+        rng = random.Random(1)
+        for n in xrange(12):
+            seq = [rng.randint(0, 5) for i in xrange(n)]
+            expected = sum(1 for i, j in itertools.combinations(xrange(n), 2)
+                           if seq[i] > seq[j])
+            self.assertEqual(count_inversions(seq), expected)
+
+    def test_crossings(self):
+        """The sweeps remove the crossings of a crossed pipeline"""
+        wf = Pipeline()
+        sources = [wf.createModule(i, 'src%d' % i, 0, 1)
+                   for i in xrange(3)]
+        sinks = [wf.createModule(i + 3, 'dst%d' % i, 1, 0)
+                 for i in xrange(3)]
+        for i in xrange(3):
+            wf.createConnection(sources[i], 0, sinks[2 - i], 0)
+        layout = self.make_layout(wf)
+        layout.compute_module_sizes()
+        layout.assign_modules_to_layers()
+        for i in xrange(3):
+            sources[i].layout_layer_index = i
+            sinks[i].layout_layer_index = i
+        self.assertEqual(layout.count_crossings(), 3)
+        layout.assign_module_permutation_to_each_layer()
+        self.assertEqual(layout.count_crossings(), 0)
+        layout.compute_layout(50, 50)
+        for i in xrange(3):
+            self.assertEqual(sources[i].layout_pos.x,
+                             sinks[2 - i].layout_pos.x)
+
+    def test_long_chain_no_gaps(self):
+        import sys
+        wf = Pipeline()
+        n = sys.getrecursionlimit() * 2
+        prev = wf.createModule(0, 'module', 1, 1)
+        for i in xrange(1, n):
+            module = wf.createModule(i, 'module', 1, 1)
+            wf.createConnection(prev, 0, module, 0)
+            prev = module
+        layout = self.make_layout(wf)
+        layout.run_all(no_gaps=True)
+        self.assertEqual([m.layout_layer_number for m in wf.modules],
+                         range(n))
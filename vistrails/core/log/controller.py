@@ -44,6 +44,7 @@ from vistrails.core.log.module_exec import ModuleExec
 from vistrails.core.log.loop_exec import LoopExec, LoopIteration
 from vistrails.core.log.group_exec import GroupExec
 from vistrails.core.log.machine import Machine
+from vistrails.core.log.store import get_execution_store
 from vistrails.core.modules.sub_module import Group, Abstraction
 from vistrails.core.vistrail.annotation import Annotation
 from vistrails.core.vistrail.pipeline import Pipeline
@@ -367,6 +368,11 @@ class LogWorkflowExecController(LogWorkflowController):
             session = vistrail.current_session
         else:
             session = None
+        locator = getattr(vistrail, 'locator', None)
+        if locator is not None:
+            self.vistrail_name = locator.name
+        else:
+            self.vistrail_name = None
         workflow_exec = WorkflowExec(
                 id=wf_exec_id,
                 user=vistrails.core.system.current_user(),
@@ -393,3 +399,12 @@ class LogWorkflowExecController(LogWorkflowController):
             self.workflow_exec.completed = -1
         else:
             self.workflow_exec.completed = 1
+
+        store = get_execution_store()
+        if store is not None:
+            try:
+                store.add_workflow_exec(self.workflow_exec,
+                                        self.vistrail_name)
+            except Exception, e:
+                debug.warning("Couldn't add the execution to %s" %
+                              store.filename, e)
@@ -0,0 +1,419 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""An optional store of module executions, for aggregate queries.
+
+The log in the bundle keeps executions as nested XML, so that answering
+"which module was the slowest over the last month" means parsing all of
+it. ExecutionStore keeps one row per module execution in a SQLite
+database instead, indexed by vistrail, version, module name and time.
+
+The store is filled as workflows finish executing when the
+executionLogStore configuration option is set, or from existing logs
+with ExecutionStore.add_log(). It does not replace the log.
+
+"""
+from __future__ import division, with_statement
+
+import datetime
+import math
+import os
+import sqlite3
+import threading
+
+from vistrails.db.domain import DBGroupExec, DBLoopExec, DBModuleExec
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workflow_exec (
+    id INTEGER PRIMARY KEY,
+    log_id INTEGER,
+    vistrail TEXT NOT NULL DEFAULT '',
+    version INTEGER,
+    user TEXT,
+    ts_start REAL,
+    ts_end REAL,
+    completed INTEGER,
+    -- ts_start or 0, NULLs are distinct in UNIQUE constraints
+    start_key REAL NOT NULL,
+    UNIQUE (vistrail, log_id, start_key));
+CREATE TABLE IF NOT EXISTS module_exec (
+    workflow_exec INTEGER REFERENCES workflow_exec(id),
+    vistrail TEXT,
+    version INTEGER,
+    module_id INTEGER,
+    module_name TEXT,
+    ts_start REAL,
+    ts_end REAL,
+    duration REAL,
+    cached INTEGER,
+    completed INTEGER,
+    error TEXT);
+CREATE INDEX IF NOT EXISTS module_exec_version
+    ON module_exec (vistrail, version);
+CREATE INDEX IF NOT EXISTS module_exec_name
+    ON module_exec (module_name, ts_start);
+CREATE INDEX IF NOT EXISTS module_exec_time
+    ON module_exec (ts_start);
+"""
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_timestamp(dt):
+    """to_timestamp(dt: datetime) -> float
+    Returns the seconds between the epoch and dt, which is taken as is
+    (log times have no time zone)
+
+    """
+    if dt is None:
+        return None
+    return (dt - _EPOCH).total_seconds()
+
+class Percentile(object):
+    """SQLite aggregate percentile(value, p), using the nearest rank.
+
+    Null values are ignored.
+    """
+    def __init__(self):
+        self.values = []
+        self.p = None
+
+    def step(self, value, p):
+        if value is not None:
+            self.values.append(value)
+            self.p = p
+
+    def finalize(self):
+        if not self.values:
+            return None
+        self.values.sort()
+        rank = int(math.ceil(self.p / 100 * len(self.values)))
+        return self.values[max(rank - 1, 0)]
+
+class ExecutionStore(object):
+    """A SQLite database holding a row per module execution.
+
+    It can be shared between threads.
+    """
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.create_aggregate('percentile', 2, Percentile)
+        with self.lock:
+            self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add_workflow_exec(self, workflow_exec, vistrail=None):
+        """add_workflow_exec(workflow_exec: WorkflowExec,
+                             vistrail: str) -> bool
+        Stores the module executions of workflow_exec, as executions of
+        the given vistrail (usually its filename). Returns False if this
+        execution was already stored.
+
+        Executions are identified by their id in the log and their start
+        time, since each new log numbers its executions from 1 again.
+
+        """
+        with self.lock:
+            with self.conn:
+                return self._add_workflow_exec(workflow_exec, vistrail)
+
+    def add_log(self, log, vistrail=None):
+        """add_log(log: Log, vistrail: str) -> int
+        Stores the executions from log that are not yet in the store.
+        Returns how many were added.
+
+        """
+        added = 0
+        with self.lock:
+            with self.conn:
+                for workflow_exec in log.db_workflow_execs:
+                    if self._add_workflow_exec(workflow_exec, vistrail):
+                        added += 1
+        return added
+
+    def _add_workflow_exec(self, workflow_exec, vistrail):
+        # NULLs are distinct in UNIQUE constraints, use '' for no vistrail
+        if vistrail is None:
+            vistrail = ''
+        version = workflow_exec.db_parent_version
+        ts_start = to_timestamp(workflow_exec.db_ts_start)
+        cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO workflow_exec (log_id, vistrail, "
+                "version, user, ts_start, ts_end, completed, start_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (workflow_exec.db_id, vistrail, version,
+                 workflow_exec.db_user, ts_start,
+                 to_timestamp(workflow_exec.db_ts_end),
+                 workflow_exec.db_completed,
+                 ts_start if ts_start is not None else 0))
+        if not cursor.rowcount:
+            return False
+        wf_id = cursor.lastrowid
+
+        def rows(item_execs):
+            for item_exec in item_execs:
+                if item_exec.vtType == DBLoopExec.vtType:
+                    for iteration in item_exec.db_loop_iterations:
+                        for row in rows(iteration.db_item_execs):
+                            yield row
+                    continue
+                if item_exec.vtType == DBGroupExec.vtType:
+                    name = item_exec.db_group_name
+                else:
+                    name = item_exec.db_module_name
+                ts_start = to_timestamp(item_exec.db_ts_start)
+                ts_end = to_timestamp(item_exec.db_ts_end)
+                if ts_start is not None and ts_end is not None:
+                    duration = ts_end - ts_start
+                else:
+                    duration = None
+                yield (wf_id, vistrail, version, item_exec.db_module_id,
+                       name, ts_start, ts_end, duration,
+                       item_exec.db_cached, item_exec.db_completed,
+                       item_exec.db_error)
+                if item_exec.vtType == DBGroupExec.vtType:
+                    children = item_exec.db_item_execs
+                else:
+                    children = item_exec.db_loop_execs
+                for row in rows(children):
+                    yield row
+
+        self.conn.executemany(
+                "INSERT INTO module_exec VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                "?, ?)",
+                rows(workflow_exec.db_item_execs))
+        return True
+
+    def module_stats(self, vistrail=None, version=None, module_name=None,
+                     since=None, until=None, include_cached=False):
+        """module_stats(vistrail: str, version: int, module_name: str,
+                        since: datetime, until: datetime,
+                        include_cached: bool) -> list(dict)
+        Returns, for each module name, the number of executions, how
+        many failed and the failure rate, and the mean, median, 95th
+        percentile and maximum compute times of the successful ones, in
+        seconds. Only executions matching the given arguments are
+        counted; cached ones are left out unless include_cached is set.
+
+        """
+        conditions = []
+        params = []
+        for column, value in [('vistrail', vistrail),
+                              ('version', version),
+                              ('module_name', module_name)]:
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if since is not None:
+            conditions.append('ts_start >= ?')
+            params.append(to_timestamp(since))
+        if until is not None:
+            conditions.append('ts_start < ?')
+            params.append(to_timestamp(until))
+        if not include_cached:
+            conditions.append('NOT cached')
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+        else:
+            where = ''
+        query = ("SELECT module_name, COUNT(*), SUM(completed = -1), "
+                 "AVG(CASE WHEN completed = 1 THEN duration END), "
+                 "percentile(CASE WHEN completed = 1 THEN duration END, 50), "
+                 "percentile(CASE WHEN completed = 1 THEN duration END, 95), "
+                 "MAX(CASE WHEN completed = 1 THEN duration END) "
+                 "FROM module_exec %s GROUP BY module_name "
+                 "ORDER BY module_name" % where)
+        stats = []
+        with self.lock:
+            for (name, count, failures, mean, p50, p95,
+                     max_) in self.conn.execute(query, params):
+                stats.append({'module_name': name,
+                              'count': count,
+                              'failures': failures,
+                              'failure_rate': failures / count,
+                              'mean': mean,
+                              'p50': p50,
+                              'p95': p95,
+                              'max': max_})
+        return stats
+
+    def slowest_modules(self, limit=10, **kwargs):
+        """slowest_modules(limit: int, **kwargs) -> list(dict)
+        Returns the stats of the limit modules with the highest 95th
+        percentile compute time. kwargs are passed to module_stats()
+
+        """
+        stats = [s for s in self.module_stats(**kwargs)
+                 if s['p95'] is not None]
+        stats.sort(key=lambda s: s['p95'], reverse=True)
+        return stats[:limit]
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_execution_store():
+    """get_execution_store() -> ExecutionStore
+    Returns the store set with the executionLogStore configuration
+    option, or None. Relative paths are in the .vistrails directory.
+
+    """
+    from vistrails.core.configuration import get_vistrails_configuration
+    configuration = get_vistrails_configuration()
+    if configuration is None:
+        return None
+    filename = configuration.check('executionLogStore')
+    if not filename:
+        return None
+    if (not os.path.isabs(filename) and
+            configuration.check('dotVistrails')):
+        filename = os.path.join(configuration.dotVistrails, filename)
+    with _stores_lock:
+        try:
+            return _stores[filename]
+        except KeyError:
+            store = _stores[filename] = ExecutionStore(filename)
+            return store
+
+##############################################################################
+
+import unittest
+
+class TestExecutionStore(unittest.TestCase):
+    def create_log(self):
+        from vistrails.db.domain import DBLog, DBWorkflowExec, \
+            DBLoopIteration
+
+        start = datetime.datetime(2016, 1, 1)
+        def module_exec(id, name, seconds, completed=1, cached=0, **kwargs):
+            return DBModuleExec(
+                    id=id, module_id=id, module_name=name, cached=cached,
+                    completed=completed,
+                    ts_start=start + datetime.timedelta(days=id),
+                    ts_end=start + datetime.timedelta(days=id,
+                                                      seconds=seconds),
+                    **kwargs)
+        iterations = [DBLoopIteration(id=i, iteration=i, item_execs=[
+                    module_exec(100 + i, 'Inner', 1)]) for i in xrange(3)]
+        loop = DBLoopExec(id=1, loop_iterations=iterations)
+        item_execs = [module_exec(i, 'Fast', 1) for i in xrange(1, 20)]
+        item_execs.extend(module_exec(i, 'Slow', i) for i in xrange(20, 40))
+        item_execs.append(module_exec(40, 'Slow', 0, completed=-1,
+                                      error='failed'))
+        item_execs.append(module_exec(41, 'Slow', 0, cached=1))
+        item_execs.append(module_exec(42, 'Map', 5, loop_execs=[loop]))
+        group = DBGroupExec(id=43, module_id=43, group_name='Group',
+                            completed=1, cached=0,
+                            ts_start=start, ts_end=start,
+                            item_execs=[module_exec(44, 'Fast', 1)])
+        item_execs.append(group)
+        workflow_exec = DBWorkflowExec(id=1, user='user', parent_version=5,
+                                       completed=1, item_execs=item_execs)
+        return DBLog(id=1, workflow_execs=[workflow_exec])
+
+    def test_module_stats(self):
+        store = ExecutionStore()
+        self.assertEqual(store.add_log(self.create_log(), 'test.vt'), 1)
+        stats = dict((s['module_name'], s) for s in store.module_stats())
+        self.assertEqual(sorted(stats),
+                         ['Fast', 'Group', 'Inner', 'Map', 'Slow'])
+        self.assertEqual(stats['Fast']['count'], 20)
+        self.assertEqual(stats['Inner']['count'], 3)
+        slow = stats['Slow']
+        self.assertEqual((slow['count'], slow['failures']), (21, 1))
+        self.assertAlmostEqual(slow['failure_rate'], 1 / 21)
+        self.assertAlmostEqual(slow['mean'], 29.5)
+        self.assertEqual((slow['p50'], slow['p95'], slow['max']),
+                         (29, 38, 39))
+        self.assertEqual(store.slowest_modules(1)[0]['module_name'], 'Slow')
+
+        # filters
+        self.assertEqual(store.module_stats(version=4), [])
+        cached = store.module_stats(module_name='Slow', include_cached=True)
+        self.assertEqual(cached[0]['count'], 22)
+        since = datetime.datetime(2016, 1, 1) + datetime.timedelta(days=30)
+        recent = store.module_stats(vistrail='test.vt', module_name='Slow',
+                                    since=since)
+        self.assertEqual(recent[0]['count'], 11)
+        store.close()
+
+    def test_add_once(self):
+        """Adding a log again only adds the new executions"""
+        from vistrails.db.domain import DBWorkflowExec
+
+        store = ExecutionStore()
+        log = self.create_log()
+        store.add_log(log, 'test.vt')
+        log.db_add_workflow_exec(DBWorkflowExec(id=2, parent_version=6,
+                                                item_execs=[]))
+        self.assertEqual(store.add_log(log, 'test.vt'), 1)
+        self.assertEqual(store.add_log(log, 'other.vt'), 2)
+        self.assertFalse(store.add_workflow_exec(log.db_workflow_execs[0],
+                                                 'test.vt'))
+        store.close()
+
+    def test_add_once_no_vistrail(self):
+        """Adding a log again without a vistrail adds nothing"""
+        store = ExecutionStore()
+        log = self.create_log()
+        self.assertEqual(store.add_log(log), 1)
+        self.assertEqual(store.add_log(log), 0)
+        self.assertFalse(store.add_workflow_exec(log.db_workflow_execs[0]))
+        stats = dict((s['module_name'], s) for s in store.module_stats())
+        self.assertEqual(stats['Fast']['count'], 20)
+        self.assertEqual(stats['Slow']['count'], 21)
+        store.close()
+
+    def test_sessions_no_vistrail(self):
+        """Executions with the same id from different logs are all kept"""
+        from vistrails.db.domain import DBWorkflowExec
+
+        store = ExecutionStore()
+        start = datetime.datetime(2016, 1, 1)
+        for day in xrange(2):
+            ts_start = start + datetime.timedelta(days=day)
+            workflow_exec = DBWorkflowExec(
+                    id=1, parent_version=5, completed=1,
+                    ts_start=ts_start, ts_end=ts_start,
+                    item_execs=[DBModuleExec(id=1, module_id=1,
+                                             module_name='Fast', cached=0,
+                                             completed=1, ts_start=ts_start,
+                                             ts_end=ts_start)])
+            self.assertTrue(store.add_workflow_exec(workflow_exec))
+        self.assertEqual(store.module_stats()[0]['count'], 2)
+        store.close()
@@ -51,6 +51,7 @@ from vistrails.core import debug
 
 from abc import ABCMeta
 from ast import literal_eval
+import copy
 from itertools import izip
 import mimetypes
 import os
@@ -1009,6 +1010,27 @@ class Unpickle(Module):
 
 ##############################################################################
 
+_compiled_code = {}
+_MAX_COMPILED_CODE = 256
+
+def compile_code(code_str):
+    """Compiles a piece of source code for exec, caching the code object.
+
+    The same source is typically run many times, e.g. when a PythonSource
+    gets executed once per element of a list or in a While loop.
+    """
+    try:
+        return _compiled_code[code_str]
+    except KeyError:
+        pass
+    # Python 2.6 needs code to end with newline
+    code = compile(code_str + '\n', '<string>', 'exec')
+    if len(_compiled_code) >= _MAX_COMPILED_CODE:
+        _compiled_code.clear()
+    _compiled_code[code_str] = code
+    return code
+
+
 class CodeRunnerMixin(object):
     def __init__(self):
         self.output_ports_order = []
@@ -1049,8 +1071,7 @@ class CodeRunnerMixin(object):
                         'self': self})
         if 'source' in locals_:
             del locals_['source']
-        # Python 2.6 needs code to end with newline
-        exec code_str + '\n' in locals_, locals_
+        exec compile_code(code_str) in locals_, locals_
         if use_output:
             for k in self.output_ports_order:
                 if locals_.get(k) is not None:
@@ -1070,6 +1091,11 @@ class PythonSource(CodeRunnerMixin, NotCacheable, Module):
 
     If you want a PythonSource execution to be cached, call
     cache_this().
+
+    When the module is looped over lists, the magic comment
+    '# pragma: vectorized' makes it run once with the whole input lists
+    instead of once per element; the code should then set lists on the
+    output ports.
     """
     _settings = ModuleSettings(
         configure_widget=("vistrails.gui.modules.python_source_configure:"
@@ -1081,6 +1107,28 @@ class PythonSource(CodeRunnerMixin, NotCacheable, Module):
         s = urllib.unquote(str(self.get_input('source')))
         self.run_code(s, use_input=True, use_output=True)
 
+    def has_pragma(self, pragma):
+        """Checks for a magic '# pragma: <pragma>' comment in the source.
+        """
+        tag = '%%23%%20pragma%%3A%%20%s' % pragma
+        # Not using get_input(), which wraps values in lists when looping
+        return any(tag in connector()
+                   for connector in self.inputPorts.get('source', []))
+
+    def compute_all(self):
+        if not self.has_pragma('vectorized'):
+            super(PythonSource, self).compute_all()
+            return
+
+        # Magic tag: "# pragma: vectorized"
+        # Run the code once, on a copy that sees the lists as plain values
+        module = copy.copy(self)
+        module.list_depth = 0
+        module.compute()
+        for name, value in module.outputPorts.iteritems():
+            if name != 'self':
+                self.set_output(name, value)
+
 ##############################################################################
 
 def zip_extract_file(archive, filename_in_archive, output_filename):
@@ -1194,54 +1242,60 @@ class Generator(object):
     """
     Used to keep track of list iteration, it will execute a module once for
     each input in the list/generator.
+
+    If `batched` is True, each value is a batch of elements (a list or a
+    NumPy array) instead of a single element.
     """
     _settings = ModuleSettings(abstract=True)
 
-    generators = []
     def __init__(self, size=None, module=None, generator=None, port=None,
-                 accumulated=False):
+                 accumulated=False, batched=False):
         self.module = module
         self.generator = generator
         self.port = port
         self.size = size
         self.accumulated = accumulated
-        if generator and module not in Generator.generators:
-            # add to global list of generators
+        self.batched = batched
+        if generator and module not in module.streams:
+            # add to the list of generators of this execution
             # they will be topologically ordered
             module.generator = generator
-            Generator.generators.append(module)
-            
+            module.streams.append(module)
+
     def next(self):
         """ return next value - the generator """
         value = self.module.get_output(self.port)
         if isinstance(value, Generator):
             value = value.all()
         return value
-    
+
     def all(self):
         """ exhausts next() for Streams
-        
+
         """
         items = []
         item = self.next()
         while item is not None:
-            items.append(item)
+            if self.batched:
+                items.extend(item)
+            else:
+                items.append(item)
             item = self.next()
         return items
 
     @staticmethod
-    def stream():
+    def stream(generators):
         """ executes all generators until inputs are exhausted
             this makes sure branching and multiple sinks are executed correctly
 
         """
         result = True
-        if not Generator.generators:
+        if not generators:
             return
         while result is not None:
-            for g in Generator.generators:
-                result = g.next()
-        Generator.generators = []
+            for g in generators:
+                result = g.generator.next()
+        del generators[:]
 
 ##############################################################################
 
@@ -1658,6 +1712,49 @@ class TestPythonSource(unittest.TestCase):
                 ]))
         self.assertEqual(results[-1], "nb is 42")
 
+    def test_compiled_code_cache(self):
+        """The same source is only compiled once"""
+        code = compile_code('a = 1')
+        self.assertIs(compile_code('a = 1'), code)
+        self.assertIsNot(compile_code('a = 2'), code)
+
+    def run_looped(self, source):
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_result
+        source = urllib2.quote(source)
+        with intercept_result(PythonSource, 'out') as results:
+            self.assertFalse(execute([
+                    ('List', 'org.vistrails.vistrails.basic', [
+                        ('value', [('List', '[1, 2, 3]')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', source)]),
+                    ]),
+                ],
+                [
+                    (0, 'value', 1, 'in'),
+                ],
+                add_port_specs=[
+                    (1, 'input', 'in',
+                     'org.vistrails.vistrails.basic:Integer'),
+                    (1, 'output', 'out',
+                     'org.vistrails.vistrails.basic:Integer'),
+                ]))
+        return results
+
+    def test_looped(self):
+        """A PythonSource looped over a list runs once per element"""
+        self.assertEqual(self.run_looped('out = 2 * self.get_input("in")'),
+                         [2, 4, 6, [2, 4, 6]])
+
+    def test_vectorized(self):
+        """A vectorized PythonSource gets the whole list in one call"""
+        results = self.run_looped('# pragma: vectorized\n'
+                                  'out = [2 * i for i in '
+                                  'self.get_input("in")]')
+        # Set once by the code, then passed on by the looped module
+        self.assertEqual(results, [[2, 4, 6], [2, 4, 6]])
+
 
 class TestNumericConversions(unittest.TestCase):
     def test_full(self):
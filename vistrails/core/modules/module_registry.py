@@ -545,6 +545,10 @@ class ModuleRegistry(DBRegistry):
 
     def setup_indices(self):
         self.descriptors_by_id = {}
+        # _upgrade_plans caches the upgrades computed by
+        # UpgradeWorkflowHandler; they depend on the registered modules
+        # and ports so they are dropped whenever those change
+        self._upgrade_plans = {}
         self.package_versions = self.db_packages_identifier_index
         self.packages = {}
         self._module_key_map = {}
@@ -625,6 +629,7 @@ class ModuleRegistry(DBRegistry):
         # self.descriptors[(desc.package, desc.name, desc.namespace)] = desc
         self.descriptors_by_id[desc.id] = desc
         package.add_descriptor(desc)
+        self._upgrade_plans = {}
     def delete_descriptor(self, desc, package=None):
         if package is None:
             try:
@@ -636,6 +641,7 @@ class ModuleRegistry(DBRegistry):
         # del self.descriptors[(desc.package, desc.name, desc.namespace)]
         del self.descriptors_by_id[desc.id]
         package.delete_descriptor(desc)
+        self._upgrade_plans = {}
     def add_package(self, package):
         DBRegistry.db_add_package(self, package)
         for key in chain(package.old_identifiers, [package.identifier]):
@@ -645,6 +651,7 @@ class ModuleRegistry(DBRegistry):
                     self.packages[key] = package
             else:
                 self.packages[key] = package
+        self._upgrade_plans = {}
 
     def delete_package(self, package):
         DBRegistry.db_delete_package(self, package)
@@ -1377,6 +1384,7 @@ class ModuleRegistry(DBRegistry):
                                "a new version." % (info_exc._module_name,
                                                    info_exc._package_name))
             package.add_abs_upgrade(descriptor, name, namespace, str(version))
+            self._upgrade_plans = {}
             self.auto_add_ports(descriptor.module)
         return descriptor
 
@@ -1492,6 +1500,7 @@ class ModuleRegistry(DBRegistry):
             raise InvalidPortSpec(descriptor, spec.name, spec.type, e)
 
         descriptor.add_port_spec(spec)
+        self._upgrade_plans = {}
         if spec.type == 'input':
             self.signals.emit_new_input_port(descriptor.identifier,
                                              descriptor.name, spec.name, spec)
@@ -1734,11 +1743,13 @@ class ModuleRegistry(DBRegistry):
         """Remove an input port by name.
         """
         descriptor.delete_input_port(port_name)
+        self._upgrade_plans = {}
 
     def delete_output_port(self, descriptor, port_name):
         """Removes an output port by name.
         """
         descriptor.delete_output_port(port_name)
+        self._upgrade_plans = {}
 
     def source_ports_from_descriptor(self, descriptor, sorted=True):
         ports = [p[1] for p in self.module_ports('output', descriptor)]
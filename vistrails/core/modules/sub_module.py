@@ -156,6 +156,90 @@ def group_signature(pipeline, module, chm):
         sig_list.append(module.pipeline.subpipeline_signature(m_id))
     return Hasher.compound_signature(sig_list)
 
+def _downstream(graph, vertices):
+    """_downstream(graph: Graph, vertices: list) -> set
+    Returns the given vertices and all the ones reachable from them
+
+    """
+    if not vertices:
+        # dfs() would walk the whole graph
+        return set()
+    return set(graph.vertices_topological_sort(vertices))
+
+def _same_value(a, b):
+    """_same_value(a: object, b: object) -> bool
+    Tells whether a Group input port received the same value as before,
+    without failing on values that don't compare to a bool (e.g. arrays)
+
+    """
+    if a is b:
+        return True
+    try:
+        return type(a) is type(b) and bool(a == b)
+    except Exception:
+        return False
+
+class InnerPipeline(object):
+    """Prepared execution state of the pipeline inside a Group.
+
+    Holds the module instances of the inner pipeline, which are kept
+    between invocations of the Group so that only the modules downstream
+    of the changed input ports, or of non-cacheable modules, run again.
+
+    """
+    def __init__(self, pipeline, tmp_id_to_module_map,
+                 persistent_to_tmp_id_map):
+        self.pipeline = pipeline
+        self.tmp_id_to_module_map = tmp_id_to_module_map
+        self.persistent_to_tmp_id_map = persistent_to_tmp_id_map
+        self.input_values = {}
+        self.volatile = _downstream(
+                pipeline.graph,
+                [i for i, obj in tmp_id_to_module_map.iteritems()
+                 if not obj.is_cacheable()])
+
+    def modules(self):
+        return self.tmp_id_to_module_map.values()
+
+    def set_inputs(self, inputs, input_remap):
+        """set_inputs(inputs: dict, input_remap: dict) -> None
+        Connects the Group's input values, given as (value, spec) by port
+        name, to the InputPort modules, and invalidates the modules that
+        need to run again
+
+        """
+        from vistrails.core.modules.basic_modules import create_constant
+
+        changed = []
+        for iport_name in set(inputs) | set(self.input_values):
+            if iport_name in inputs and iport_name in self.input_values and \
+                    _same_value(inputs[iport_name][0],
+                                self.input_values[iport_name]):
+                continue
+            iport_id = input_remap[iport_name].id
+            iport_obj = self.tmp_id_to_module_map[iport_id]
+            iport_obj.inputPorts.pop('ExternalPipe', None)
+            if iport_name in inputs:
+                value, spec = inputs[iport_name]
+                # The type information is lost when passing as Variant,
+                # so we need to use the the final normalized value
+                temp_conn = ModuleConnector(create_constant(value),
+                                            'value', spec)
+                iport_obj.set_input_port('ExternalPipe', temp_conn)
+                self.input_values[iport_name] = value
+            else:
+                del self.input_values[iport_name]
+            changed.append(iport_id)
+
+        stale = self.volatile | _downstream(self.pipeline.graph, changed)
+        for i in stale:
+            self.tmp_id_to_module_map[i].upToDate = False
+
+    def clear(self):
+        for obj in self.tmp_id_to_module_map.itervalues():
+            obj.clear()
+        self.tmp_id_to_module_map = {}
+
 class Group(Module):
     _settings = ModuleSettings(signature=group_signature,
                                hide_descriptor=True)
@@ -165,6 +249,23 @@ class Group(Module):
         Module.__init__(self)
         self.is_group = True
         self.persistent_modules = []
+        # Prepared inner pipelines that are not in use; shared with the
+        # copies made by looping modules, each running with its own
+        self._inner_pipelines = []
+
+    def setup_inner_pipeline(self):
+        """setup_inner_pipeline() -> InnerPipeline
+        Creates the module instances of the inner pipeline
+
+        """
+        res = self.interpreter.setup_pipeline(self.pipeline)
+        if len(res[5]) > 0:
+            raise ModuleError(self, "Error(s) inside group:\n" +
+                              "\n".join(me.msg for me in res[5].itervalues()))
+        # The instances now belong to this Group, take them out of the
+        # interpreter's cache
+        self.interpreter.clean_modules(res[1].keys())
+        return InnerPipeline(self.pipeline, res[0], res[1])
 
     def compute(self):
         # Check required attributes
@@ -178,29 +279,22 @@ class Group(Module):
                     "%s cannot execute -- remap dictionaries don't exist" %
                     self.__class__.__name__)
 
-        # Setup pipeline for execution
-        res = self.interpreter.setup_pipeline(self.pipeline)
-        self.persistent_modules = res[0].values()
-        if len(res[5]) > 0:
-            raise ModuleError(self, "Error(s) inside group:\n" +
-                              "\n".join(me.msg for me in res[5].itervalues()))
-        tmp_id_to_module_map = res[0]
+        # Reuse a prepared pipeline if one is available
+        try:
+            inner = self._inner_pipelines.pop()
+        except IndexError:
+            inner = self.setup_inner_pipeline()
+        self.persistent_modules = inner.modules()
+        tmp_id_to_module_map = inner.tmp_id_to_module_map
 
         # Connect Group's external input ports to internal InputPort modules
-        for iport_name, conn in self.inputPorts.iteritems():
-            from vistrails.core.modules.basic_modules import create_constant
-            # The type information is lost when passing as Variant,
-            # so we need to use the the final normalized value
-            value = self.get_input(iport_name)
-            temp_conn = ModuleConnector(create_constant(value),
-                                        'value', self.input_specs[iport_name])
-            iport_module = self.input_remap[iport_name]
-            iport_obj = tmp_id_to_module_map[iport_module.id]
-            iport_obj.set_input_port('ExternalPipe', temp_conn)
+        inner.set_inputs(dict((iport_name, (self.get_input(iport_name),
+                                            self.input_specs[iport_name]))
+                              for iport_name in self.inputPorts),
+                         self.input_remap)
 
         # Execute pipeline
         kwargs = {'logger': self.logging.log.recursing(self),
-                  'clean_pipeline': True,
                   'current_version': self.moduleInfo['version']}
         module_info_args = set(['locator', 'reason', 'extra_info', 'actions', 'job_monitor'])
         for arg in module_info_args:
@@ -208,11 +302,13 @@ class Group(Module):
                 kwargs[arg] = self.moduleInfo[arg]
 
         res = self.interpreter.execute_pipeline(self.pipeline,
-                                                *res[:2],
+                                                tmp_id_to_module_map,
+                                                inner.persistent_to_tmp_id_map,
                                                 **kwargs)
 
         # Check and propagate errors
         if len(res[2]) > 0:
+            inner.clear()
             raise ModuleError(self, "Error(s) inside group:\n" +
                               "\n".join("%s: %s" % (
                                       me.module.__class__.__name__, me.msg)
@@ -220,6 +316,7 @@ class Group(Module):
 
         # Check and propagate ModuleSuspended exceptions
         if res[4]:
+            inner.clear()
             message = "\n".join([ms.msg for ms in res[4].itervalues()])
             children = list(res[4].values())
             raise ModuleSuspended(self, message, children=children)
@@ -233,10 +330,17 @@ class Group(Module):
 
         self.interpreter.finalize_pipeline(self.pipeline, *res[:-1],
                                            reset_computed=False)
+        self._inner_pipelines.append(inner)
 
     def is_cacheable(self):
         return all(m.is_cacheable() for m in self.persistent_modules)
 
+    def clear(self):
+        for inner in self._inner_pipelines:
+            inner.clear()
+        del self._inner_pipelines[:]
+        Module.clear(self)
+
     def transfer_attrs(self, module):
         self.pipeline = module.pipeline
         if module._port_specs is None:
@@ -538,3 +642,69 @@ def parse_abstraction_name(filename, get_all_parts=False):
 ###############################################################################
 
 _modules = [InputPort, OutputPort, Group, Abstraction]
+
+###############################################################################
+
+import unittest
+
+class TestGroup(unittest.TestCase):
+    def test_inner_pipeline_reuse(self):
+        """Only the modules affected by a changed input run again"""
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.interpreter.cached import CachedInterpreter
+        from vistrails.core.modules.basic_modules import create_constant
+        from vistrails.core.utils import DummyView
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.packages.pythonCalc.init import PythonCalc
+        from vistrails.packages.pythonCalc import identifier
+
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+        integer = controller.add_module(basic_pkg, 'Integer')
+        controller.update_function(integer, 'value', ['2'])
+        calcs = []
+        for value1, value2, op in [(None, '3', '+'),
+                                   ('5', '7', '*'),
+                                   (None, None, '+')]:
+            calc = controller.add_module(identifier, 'PythonCalc')
+            for port, value in [('value1', value1), ('value2', value2),
+                                ('op', op)]:
+                if value is not None:
+                    controller.update_function(calc, port, [value])
+            calcs.append(calc)
+        controller.add_connection(integer.id, 'value', calcs[0].id, 'value1')
+        controller.add_connection(calcs[0].id, 'value', calcs[2].id, 'value1')
+        controller.add_connection(calcs[1].id, 'value', calcs[2].id, 'value2')
+        controller.create_group([c.id for c in calcs],
+                                controller.current_pipeline.connections.keys())
+
+        result = CachedInterpreter.get().execute(
+                controller.current_pipeline,
+                locator=XMLFileLocator('foo.xml'),
+                current_version=controller.current_version,
+                view=DummyView())
+        self.assertFalse(result.errors)
+        group, = [obj for obj in result.objects.itervalues()
+                  if isinstance(obj, Group)]
+        self.assertEqual(len(group._inner_pipelines), 1)
+
+        calls = []
+        def compute(calc):
+            calls.append(calc.get_input('value1'))
+            orig_compute(calc)
+        orig_compute = PythonCalc.compute
+        PythonCalc.compute = compute
+        try:
+            for value, expected in [(2, []), (10, [10, 13.0]), (10, [])]:
+                del calls[:]
+                group.inputPorts['value1'] = [
+                        ModuleConnector(create_constant(value), 'value')]
+                group.compute()
+                self.assertEqual(calls, expected)
+        finally:
+            PythonCalc.compute = orig_compute
+        self.assertEqual(len(group._inner_pipelines), 1)
+
+        group.clear()
+        self.assertEqual(group._inner_pipelines, [])
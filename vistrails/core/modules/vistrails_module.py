@@ -37,12 +37,15 @@ from __future__ import division
 
 import ast
 from base64 import b16encode, b16decode
+import contextlib
 import copy
-from itertools import izip, product, chain
+from itertools import izip, islice, product, chain
 import json
+import threading
 import time
 import traceback
 import warnings
+import weakref
 
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
@@ -197,6 +200,109 @@ class DummyModuleLogging(object):
 
 _dummy_logging = DummyModuleLogging()
 
+################################################################################
+# ExecutionContext
+
+class ExecutionContext(object):
+    """The state of one pipeline execution.
+
+    Cached modules are shared between all the executions that use them, but
+    the attributes the interpreter sets up for an execution (logging,
+    moduleInfo, ...) are specific to it. While a context is entered, these
+    attributes are read from and written to the context, so that several
+    pipelines can run at the same time from different threads.
+
+    Contexts nest (a Group executes its pipeline from inside the outer
+    execution). When a nested context exits, its values are handed to the
+    enclosing context, without replacing the values that context set
+    itself. When the outermost context exits, the values are kept as the
+    modules' attributes, so that they can still be read after the
+    execution like before.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.modules = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def current_stack():
+        """Returns the contexts entered in the current thread.
+        """
+        try:
+            return ExecutionContext._local.stack
+        except AttributeError:
+            stack = ExecutionContext._local.stack = []
+            return stack
+
+    @staticmethod
+    @contextlib.contextmanager
+    def adopted(stack):
+        """Runs the current thread in the given contexts.
+
+        This is used by worker threads that execute modules for another
+        thread, with the contexts from that thread's current_stack().
+        """
+        previous = ExecutionContext.current_stack()
+        ExecutionContext._local.stack = list(stack)
+        try:
+            yield
+        finally:
+            ExecutionContext._local.stack = previous
+
+    def values(self, module):
+        """Returns the dict of this execution's attributes for a module.
+        """
+        # setdefault() is atomic, worker threads may share this context
+        return self.modules.setdefault(module, {})
+
+    def __enter__(self):
+        ExecutionContext.current_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stack = ExecutionContext.current_stack()
+        stack.remove(self)
+        if stack:
+            outer = stack[-1]
+            for module, values in self.modules.items():
+                outer_values = outer.values(module)
+                for name, value in values.iteritems():
+                    outer_values.setdefault(name, value)
+        else:
+            for module, values in self.modules.items():
+                module.__dict__.update(values)
+        self.modules.clear()
+
+
+class ExecutionAttribute(object):
+    """A Module attribute whose value depends on the current execution.
+
+    See :class:`ExecutionContext`.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        for context in reversed(ExecutionContext.current_stack()):
+            values = context.modules.get(obj)
+            if values is not None and self.name in values:
+                return values[self.name]
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, obj, value):
+        stack = ExecutionContext.current_stack()
+        if stack:
+            stack[-1].values(obj)[self.name] = value
+            # Modules created during an execution need a value outside of it
+            obj.__dict__.setdefault(self.name, value)
+        else:
+            obj.__dict__[self.name] = value
+
 ################################################################################
 # Module
 
@@ -270,7 +376,18 @@ class Module(object):
     _settings = ModuleSettings(is_root=True, abstract=True)
     _output_ports = [OPort("self", "Module", optional=True)]
 
+    # Set up by the interpreter for each execution
+    logging = ExecutionAttribute('logging')
+    moduleInfo = ExecutionAttribute('moduleInfo')
+    streams = ExecutionAttribute('streams')
+    in_pipeline = ExecutionAttribute('in_pipeline')
+    change_parameter = ExecutionAttribute('change_parameter')
+    computed = ExecutionAttribute('computed')
+
     def __init__(self):
+        # serializes update() when the module is shared by concurrent
+        # executions
+        self._update_lock = threading.RLock()
         self.inputPorts = {}
         self.outputPorts = {}
         self.upToDate = False
@@ -293,6 +410,9 @@ class Module(object):
         self.output_specs_order = []
         self.iterated_ports = []
         self.streamed_ports = {}
+        # the streaming modules of the current execution, that the
+        # interpreter drives once the sinks are updated
+        self.streams = []
         self.in_pipeline = False
         self.set_output("self", self) # every object can return itself
 
@@ -354,6 +474,10 @@ class Module(object):
         clone.output_specs = self.output_specs
         clone.input_specs_order = self.input_specs_order
         clone.output_specs_order = self.output_specs_order
+        clone._update_lock = threading.RLock()
+        for context in ExecutionContext.current_stack():
+            if self in context.modules:
+                context.modules[clone] = dict(context.modules[self])
 
         return clone
 
@@ -546,6 +670,10 @@ class Module(object):
         upstream and the compute() method, reporting everything to the logger.
 
         """
+        with self._update_lock:
+            self._update()
+
+    def _update(self):
         if self.had_error:
             raise ModuleHadError(self)
         elif self.was_suspended:
@@ -742,7 +870,7 @@ class Module(object):
             self.compute_streaming()
         elif isinstance(self, Streaming) or\
              (isinstance(self, PythonSource) and
-              '%23%20pragma%3A%20streaming' in self.get_input('source')):
+              self.has_pragma('streaming')):
             # Magic tag: "# pragma: streaming"
 
             # the module creates its own generator object
@@ -755,6 +883,10 @@ class Module(object):
         """This method creates a generator object and sets the outputs as
         generators.
 
+        If the input streams are batched, the outputs are batched too. A
+        module that is not :py:class:`BatchStreaming` is still computed once
+        per element, but the results of a batch are passed on together.
+
         """
         from vistrails.core.modules.basic_modules import Generator
         type = self.control_params.get(ModuleControlParam.LOOP_KEY, 'pairwise')
@@ -767,12 +899,47 @@ class Module(object):
         ports = [port for port, depth, value in self.iterated_ports
                  if depth == self.list_depth]
         num_inputs = self.iterated_ports[0][2].size
+        batched = set(value.batched for port, depth, value
+                      in self.iterated_ports if depth == self.list_depth)
+        if len(batched) > 1:
+            raise ModuleError(self,
+                              'Cannot combine batched and unbatched streams!')
+        batched = batched.pop()
+        from vistrails.core.modules.basic_modules import PythonSource
+        per_element = batched and not (
+                isinstance(self, BatchStreaming) or
+                (isinstance(self, PythonSource) and
+                 self.has_pragma('vectorized')))
         # the generator will read next from each iterated input port and
         # compute the module again
         module = copy.copy(self)
         module.list_depth = self.list_depth - 1
         if num_inputs:
             milestones = [i*num_inputs//10 for i in xrange(1, 11)]
+
+        def compute(elements, i):
+            module.had_error = False
+            ## Type checking
+            if i == 0:
+                if batched and not per_element:
+                    self.typeChecking(module, ports,
+                                      [[e[0] for e in elements]])
+                else:
+                    self.typeChecking(module, ports, [elements])
+
+            module.upToDate = False
+            module.computed = False
+
+            self.setInputValues(module, ports, elements, i)
+
+            try:
+                module.compute()
+            except ModuleSuspended, e:
+                e.loop_iteration = i
+                suspended.append(e)
+            except Exception, e:
+                raise ModuleError(module, str(e))
+
         def generator(self):
             self.logging.begin_compute(module)
             i = 0
@@ -795,29 +962,27 @@ class Module(object):
                     self.logging.update_progress(module, 1.0)
                     self.logging.end_update(module)
                     yield None
-                if num_inputs:
+                if batched and num_inputs:
+                    self.logging.update_progress(module, float(i)/num_inputs)
+                elif num_inputs:
                     if i in milestones:
                         self.logging.update_progress(module, float(i)/num_inputs)
                 else:
                     self.logging.update_progress(module, 0.5)
-                module.had_error = False
-                ## Type checking
-                if i == 0:
-                    self.typeChecking(module, ports, [elements])
-
-                module.upToDate = False
-                module.computed = False
-
-                self.setInputValues(module, ports, elements, i)
-
-                try:
-                    module.compute()
-                except ModuleSuspended, e:
-                    e.loop_iteration = i
-                    suspended.append(e)
-                except Exception, e:
-                    raise ModuleError(module, str(e))
-                i += 1
+                if per_element:
+                    results = {}
+                    for element in izip(*elements):
+                        compute(element, i)
+                        for name_output in module.outputPorts:
+                            if name_output != 'self':
+                                results.setdefault(name_output, []).append(
+                                        module.get_output(name_output))
+                        i += 1
+                    for name_output, values in results.iteritems():
+                        module.set_output(name_output, values)
+                else:
+                    compute(elements, i)
+                    i += len(elements[0]) if batched else 1
                 yield True
 
         _generator = generator(self)
@@ -826,7 +991,8 @@ class Module(object):
             iterator = Generator(size=num_inputs,
                                  module=module,
                                  generator=_generator,
-                                 port=name_output)
+                                 port=name_output,
+                                 batched=batched)
             self.set_output(name_output, iterator)
 
     def compute_accumulate(self):
@@ -875,7 +1041,10 @@ class Module(object):
                     yield None
 
                 for port, value in zip(ports, elements):
-                    inputs[port].append(value)
+                    if self.streamed_ports[port].batched:
+                        inputs[port].extend(value)
+                    else:
+                        inputs[port].append(value)
                 for name_output in module.outputPorts:
                     module.set_output(name_output, None)
                 i += 1
@@ -1503,18 +1672,32 @@ class Module(object):
 
             self.set_output(name_output, iterator)
 
-    def set_streaming_output(self, port, generator, size=0):
+    def set_streaming_output(self, port, generator, size=0, chunk_size=None,
+                             batches=False):
         """This method is used to set a streaming output port.
 
+        The stream is batched if `chunk_size` is set, in which case the
+        values are grouped in lists of that many elements, or if `batches` is
+        True, in which case the generator already produces batches (lists or
+        NumPy arrays). Batches go through downstream modules in a single step.
+
         :param port: the name of the output port to be set
         :type port: str
         :param generator: An iterator object supporting .next()
         :param size: The number of values if known (default=0)
         :type size: int
+        :param chunk_size: The number of values in each batch
+        :type chunk_size: int
+        :param batches: Whether the generator produces batches
+        :type batches: bool
         """
         from vistrails.core.modules.basic_modules import Generator
         module = copy.copy(self)
 
+        if chunk_size:
+            generator = iter_chunks(generator, chunk_size)
+            batches = True
+
         if size:
             milestones = [i*size//10 for i in xrange(1, 11)]
         def _Generator():
@@ -1535,18 +1718,20 @@ class Module(object):
                     self.logging.update_progress(self, 1.0)
                     yield None
                 module.set_output(port, value)
-                if size:
-                    if i in milestones:
-                        self.logging.update_progress(self, float(i)/size)
-                else:
+                if not size:
                     self.logging.update_progress(self, 0.5)
-                i += 1
+                elif batches:
+                    self.logging.update_progress(self, float(i)/size)
+                elif i in milestones:
+                    self.logging.update_progress(self, float(i)/size)
+                i += len(value) if batches else 1
                 yield True
         _generator = _Generator()
         self.set_output(port, Generator(size=size,
                                         module=module,
                                         generator=_generator,
-                                        port=port))
+                                        port=port,
+                                        batched=batches))
 
     def job_monitor(self):
         """Returns the JobMonitor for the associated controller if it exists.
@@ -1636,6 +1821,27 @@ class Streaming(object):
 
     """
 
+class BatchStreaming(object):
+    """ A mixin indicating that compute() handles a whole batch of streamed
+    values at once
+
+    When fed batched streams, the module gets a batch (list or NumPy array)
+    on each streamed input port and should set batches on its output ports.
+
+    """
+
+def iter_chunks(iterable, chunk_size):
+    """Groups the values of an iterable in lists of chunk_size elements.
+
+    The last list might be shorter.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
 ################################################################################
 
 class Converter(Module):
@@ -1863,3 +2069,62 @@ class TestImplicitLooping(unittest.TestCase):
 
     def test_list_custom(self):
         self.run_vt("test-list-custom.vt")
+
+    def test_batched_streaming(self):
+        import urllib2
+        from vistrails.core.modules.basic_modules import PythonSource
+        from vistrails.tests.utils import execute, intercept_result
+        sources = [
+            # stream 0..9 in batches of 4
+            "self.set_streaming_output('y', iter(xrange(10)), 10, "
+            "chunk_size=4)",
+            # computed for each element
+            "y = x * 2",
+            # computed for each batch
+            "# pragma: vectorized\n"
+            "assert len(x) in (4, 2)\n"
+            "y = [i + 1 for i in x]",
+            # accumulates the stream
+            "y = x",
+        ]
+        types = [(None, 'List'), ('Integer', 'Integer'),
+                 ('Integer', 'Integer'), ('List', 'List')]
+        basic = 'org.vistrails.vistrails.basic'
+        add_port_specs = []
+        for i, (in_sig, out_sig) in enumerate(types):
+            if in_sig is not None:
+                add_port_specs.append((i, 'input', 'x',
+                                       '%s:%s' % (basic, in_sig)))
+            add_port_specs.append((i, 'output', 'y',
+                                   '%s:%s' % (basic, out_sig)))
+        with intercept_result(PythonSource, 'y') as results:
+            self.assertFalse(execute(
+                    [('PythonSource', basic, [
+                        ('source', [('String', urllib2.quote(source))]),
+                     ])
+                     for source in sources],
+                    [(i, 'y', i + 1, 'x') for i in xrange(3)],
+                    add_port_specs=add_port_specs))
+        self.assertEqual(results[-1], [i * 2 + 1 for i in xrange(10)])
+
+
+class TestExecutionContext(unittest.TestCase):
+    def test_nested(self):
+        """Values are only kept on the module when the outermost context
+        exits"""
+        module = Module()
+        module.computed = False
+        with ExecutionContext():
+            module.computed = True
+            module.in_pipeline = True
+            with ExecutionContext():
+                module.computed = False
+                module.logging = 'inner'
+                self.assertEqual(module.logging, 'inner')
+            self.assertNotEqual(module.__dict__['logging'], 'inner')
+            self.assertEqual(module.logging, 'inner')
+            self.assertEqual(module.computed, True)
+            self.assertEqual(module.__dict__['computed'], False)
+        self.assertEqual(module.computed, True)
+        self.assertEqual(module.logging, 'inner')
+        self.assertEqual(module.in_pipeline, True)
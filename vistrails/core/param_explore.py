@@ -42,6 +42,8 @@ from vistrails.core import debug
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 import copy
+import itertools
+import random
 
 import unittest
 
@@ -205,42 +207,301 @@ class ActionBasedParameterExploration(object):
         pipeline and a set of actions leading to that interpolated
         pipeline. This is useful for update the parameter exploration
         back to the builder.
+
+        This builds all the pipelines at once, see iter_explore() to get
+        them one at a time.
         
         """
         results = []
         resultActions = []
-        
-        def exploreDimension(pipeline, performedActions, dim):
-            """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
-            Start applying actions to the pipeline at dimension
-            dim. 'pipeline' will not be modified in the function
-            
-            """
-            if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
-                return
-            currentActions = actions[dim]
-            if len(currentActions)==0:
-                # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
-                return
-            for actionSet in currentActions:
-                currentPipeline = copy.copy(pipeline)
-                currentPeformedActions = copy.copy(performedActions)
-                for action in actionSet:
-                    currentPipeline.perform_action(action)
-                    currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
-        
+        for pipeline, performedActions in self.iter_explore(pipeline,
+                                                            actions,
+                                                            pre_actions):
+            results.append(pipeline)
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def iter_explore(self, pipeline, actions, pre_actions=[], sampler=None):
+        """ iter_explore(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set], sampler: Sampler)
+          -> iterator over (pipeline, actions)
+        Lazy version of explore(): the pipelines are built one at a time
+        as the iterator is consumed, in the same order, so that the first
+        one can be executed right away and only one is kept in memory.
+        Any number of dimensions can be used; the first dimension varies
+        the fastest.
+
+        sampler chooses which combinations of steps are explored; by
+        default all of them are (see CartesianSampler).
+
+        """
+        if sampler is None:
+            sampler = CartesianSampler()
+
         # perform pre_actions
-        currentPipeline = copy.copy(pipeline)
+        basePipeline = copy.copy(pipeline)
         for action in pre_actions:
-            currentPipeline.perform_action(action)
-        
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+            basePipeline.perform_action(action)
+
+        sizes = [max(1, len(dim_actions)) for dim_actions in actions]
+        for sample in sampler.samples(sizes):
+            # only the changed parameters are duplicated
+            currentPipeline = basePipeline.shared_copy()
+            performedActions = list(pre_actions)
+            # the last dimension is applied first
+            for dim in xrange(len(actions) - 1, -1, -1):
+                if not actions[dim]:
+                    continue
+                for action in actions[dim][sample[dim]]:
+                    currentPipeline.perform_action(action)
+                    performedActions.append(action)
+            yield currentPipeline, performedActions
+
+    @staticmethod
+    def count(actions, sampler=None):
+        """ count(actions: [action set], sampler: Sampler) -> int
+        Returns the number of pipelines the exploration will produce
+
+        """
+        if sampler is None:
+            sampler = CartesianSampler()
+        return sampler.count([max(1, len(dim_actions))
+                              for dim_actions in actions])
+
+################################################################################
+
+def _spaceSize(sizes):
+    """ _spaceSize(sizes: [int]) -> int
+    Returns the number of points in a space with the given dimension sizes
+
+    """
+    result = 1
+    for size in sizes:
+        result *= size
+    return result
+
+def _unravelIndex(index, sizes):
+    """ _unravelIndex(index: int, sizes: [int]) -> tuple(int)
+    Returns the point at the given index in a space with the given
+    dimension sizes, the first dimension varying the fastest
+
+    """
+    point = []
+    for size in sizes:
+        index, step = divmod(index, size)
+        point.append(step)
+    return tuple(point)
+
+class Sampler(object):
+    """
+    Sampler chooses the points of the parameter space that a parameter
+    exploration executes. A point is a tuple holding a step index for each
+    dimension.
+
+    Samplers can be given the value of an objective for each point with
+    report(), which adaptive samplers use to choose the following points.
+    The same seed always gives the same points.
+
+    """
+    def __init__(self, seed=None, maximize=False):
+        """ Sampler(seed: hashable, maximize: bool) -> Sampler
+        maximize tells whether the objective is to be maximized instead of
+        minimized
+
+        """
+        self.seed = seed
+        self.maximize = maximize
+        self.scores = {}
+        self._current = None
+
+    def samples(self, sizes):
+        """ samples(sizes: [int]) -> iterator over tuple(int)
+        Returns the points to explore given the size of each dimension
+
+        """
+        self.scores = {}
+        for point in self._samples(sizes):
+            self._current = point
+            yield point
+
+    def _samples(self, sizes):
+        raise NotImplementedError
+
+    def count(self, sizes):
+        """ count(sizes: [int]) -> int
+        Returns the number of points samples() produces
+
+        """
+        raise NotImplementedError
+
+    def report(self, score):
+        """ report(score: float) -> None
+        Gives the value of the objective for the last point returned by
+        samples()
+
+        """
+        self.scores[self._current] = score
+
+    def _rank(self, points):
+        """ _rank(points: [tuple(int)]) -> [tuple(int)]
+        Sorts points from best to worst objective, points without a score
+        coming last
+
+        """
+        if self.maximize:
+            worst = float('-inf')
+        else:
+            worst = float('inf')
+        def key(point):
+            score = self.scores.get(point)
+            if score is None:
+                score = worst
+            if self.maximize:
+                return -score
+            return score
+        return sorted(points, key=key)
+
+    def best(self):
+        """ best() -> (tuple(int), float)
+        Returns the best point reported so far and its score, or None
+
+        """
+        if not self.scores:
+            return None
+        point = self._rank(self.scores.keys())[0]
+        return point, self.scores[point]
+
+class CartesianSampler(Sampler):
+    """
+    CartesianSampler explores every point, the first dimension varying the
+    fastest
+
+    """
+    def _samples(self, sizes):
+        for point in itertools.product(*[xrange(size)
+                                         for size in reversed(sizes)]):
+            yield point[::-1]
+
+    def count(self, sizes):
+        return _spaceSize(sizes)
+
+class RandomSampler(Sampler):
+    """
+    RandomSampler explores a number of distinct points chosen uniformly at
+    random
+
+    """
+    def __init__(self, count, seed=None, maximize=False):
+        Sampler.__init__(self, seed, maximize)
+        self.sampleCount = count
+
+    def _samples(self, sizes):
+        rng = random.Random(self.seed)
+        total = _spaceSize(sizes)
+        for index in rng.sample(xrange(total), self.count(sizes)):
+            yield _unravelIndex(index, sizes)
+
+    def count(self, sizes):
+        return min(self.sampleCount, _spaceSize(sizes))
+
+class LatinHypercubeSampler(Sampler):
+    """
+    LatinHypercubeSampler explores a number of points such that each
+    dimension is split in as many equal strata as there are points, and
+    each stratum is taken exactly once. The steps are thus evenly covered
+    in every dimension, even with few points.
+
+    """
+    def __init__(self, count, seed=None, maximize=False):
+        Sampler.__init__(self, seed, maximize)
+        self.sampleCount = count
+
+    def _samples(self, sizes):
+        rng = random.Random(self.seed)
+        n = self.sampleCount
+        columns = []
+        for size in sizes:
+            strata = range(n)
+            rng.shuffle(strata)
+            columns.append([int((stratum + rng.random()) * size / n)
+                            for stratum in strata])
+        for i in xrange(n):
+            yield tuple(column[i] for column in columns)
+
+    def count(self, sizes):
+        return self.sampleCount
+
+class SuccessiveHalvingSampler(Sampler):
+    """
+    SuccessiveHalvingSampler picks a number of random candidates and
+    evaluates them with a small budget, keeps the best 1/eta of them and
+    evaluates those with a larger budget, and so on until one candidate is
+    left or the budget is exhausted.
+
+    The budget is one of the dimensions (e.g. a number of iterations),
+    whose steps are used in increasing order. Every point needs to have
+    its objective reported before the next one is requested; points
+    without a score are considered the worst.
+
+    """
+    def __init__(self, count, budgetDim, eta=2, seed=None, maximize=False):
+        Sampler.__init__(self, seed, maximize)
+        if eta < 2:
+            raise ValueError("eta should be at least 2")
+        self.sampleCount = count
+        self.budgetDim = budgetDim
+        self.eta = eta
+        self._lastRung = []
+
+    def _rungs(self, sizes):
+        """ _rungs(sizes: [int]) -> [(int, int)]
+        Returns the budget step and the number of candidates of each rung
+
+        """
+        others = list(sizes)
+        budgetSize = others[self.budgetDim]
+        others[self.budgetDim] = 1
+        counts = [min(self.sampleCount, _spaceSize(others))]
+        while counts[-1] > 1 and len(counts) < budgetSize:
+            counts.append(max(1, counts[-1] // self.eta))
+        if len(counts) == 1:
+            return [(budgetSize - 1, counts[0])]
+        last = len(counts) - 1
+        return [(int(round(rung * (budgetSize - 1) / last)), count)
+                for rung, count in enumerate(counts)]
+
+    def _samples(self, sizes):
+        rng = random.Random(self.seed)
+        others = list(sizes)
+        others[self.budgetDim] = 1
+        rungs = self._rungs(sizes)
+        candidates = [_unravelIndex(index, others)
+                      for index in rng.sample(xrange(_spaceSize(others)),
+                                              rungs[0][1])]
+        dim = self.budgetDim
+        for step, count in rungs:
+            candidates = candidates[:count]
+            points = [c[:dim] + (step,) + c[dim + 1:] for c in candidates]
+            self._lastRung = points
+            for point in points:
+                yield point
+            ranked = self._rank(points)
+            candidates = [p[:dim] + (0,) + p[dim + 1:] for p in ranked]
+
+    def count(self, sizes):
+        return sum(count for step, count in self._rungs(sizes))
+
+    def best(self):
+        """ best() -> (tuple(int), float)
+        Returns the best point of the last rung, which had the largest
+        budget, and its score, or None
+
+        """
+        points = [p for p in self._lastRung if p in self.scores]
+        if not points:
+            return None
+        point = self._rank(points)[0]
+        return point, self.scores[point]
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -254,13 +515,19 @@ def _pipelinePositions(sheetCount, rowCount, colCount,
 
     """
 
-    pipelinePositions = []
-    for pId in xrange(len(pipelines)):
-        col = pId % colCount
-        row = (pId // colCount) % rowCount
-        sheet = (pId // (colCount*rowCount)) % sheetCount
-        pipelinePositions.append((row, col, sheet))
-    return pipelinePositions
+    return [_pipelinePosition(sheetCount, rowCount, colCount, pId)
+            for pId in xrange(len(pipelines))]
+
+def _pipelinePosition(sheetCount, rowCount, colCount, pId):
+    """ _pipelinePosition(sheetCount: int, rowCount: int, colCount: int,
+                          pId: int) -> (int, int, int)
+    Returns the position (row, col, sheet) of the pipeline at index pId
+
+    """
+    col = pId % colCount
+    row = (pId // colCount) % rowCount
+    sheet = (pId // (colCount*rowCount)) % sheetCount
+    return (row, col, sheet)
 
 
 ################################################################################
@@ -283,5 +550,120 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+    class FakePipeline(object):
+        copies = 0
+
+        def __init__(self, performed=()):
+            self.performed = list(performed)
+
+        def __copy__(self):
+            TestParameterExploration.FakePipeline.copies += 1
+            return TestParameterExploration.FakePipeline(self.performed)
+
+        def shared_copy(self):
+            return copy.copy(self)
+
+        def perform_action(self, action):
+            self.performed.append(action)
+
+    def testIterExplore(self):
+        """The lazy exploration gives the pipelines in the same order"""
+        actions = [[('a1',), ('a2',)],
+                   [],
+                   [('c1', 'd1'), ('c2', 'd2'), ('c3', 'd3')],
+                   [('e1',), ('e2',)]]
+        explorer = ActionBasedParameterExploration()
+        self.assertEqual(explorer.count(actions), 12)
+        pipelines, performed = explorer.explore(self.FakePipeline(), actions,
+                                                ['pre'])
+        self.assertEqual(len(pipelines), 12)
+        self.assertEqual(performed[0], ['pre', 'e1', 'c1', 'd1', 'a1'])
+        self.assertEqual(performed[1], ['pre', 'e1', 'c1', 'd1', 'a2'])
+        self.assertEqual(performed[2], ['pre', 'e1', 'c2', 'd2', 'a1'])
+        self.assertEqual(performed[11], ['pre', 'e2', 'c3', 'd3', 'a2'])
+        self.assertEqual([p.performed for p in pipelines], performed)
+
+        # one pipeline is built at a time
+        self.FakePipeline.copies = 0
+        explored = explorer.iter_explore(self.FakePipeline(), actions * 3)
+        pipeline, performed = next(explored)
+        self.assertEqual(self.FakePipeline.copies, 2)
+        self.assertEqual(performed, ['e1', 'c1', 'd1', 'a1'] * 3)
+
+    def testSamplers(self):
+        """The samplers are deterministic and stay in the space"""
+        sizes = [5, 1, 8, 3]
+        for sampler in [RandomSampler(20, seed=3),
+                        LatinHypercubeSampler(16, seed=3)]:
+            points = list(sampler.samples(sizes))
+            self.assertEqual(len(points), sampler.count(sizes))
+            self.assertEqual(points, list(sampler.samples(sizes)))
+            for point in points:
+                self.assertEqual(len(point), len(sizes))
+                for step, size in zip(point, sizes):
+                    self.assertTrue(0 <= step < size)
+        self.assertNotEqual(list(RandomSampler(20, seed=3).samples(sizes)),
+                            list(RandomSampler(20, seed=4).samples(sizes)))
+
+        # distinct points, all of them if asked for more
+        points = list(RandomSampler(20, seed=3).samples(sizes))
+        self.assertEqual(len(set(points)), 20)
+        points = list(RandomSampler(1000, seed=3).samples(sizes))
+        self.assertEqual(sorted(points),
+                         sorted(CartesianSampler().samples(sizes)))
+
+        # each stratum is taken once
+        points = list(LatinHypercubeSampler(8, seed=1).samples(sizes))
+        self.assertEqual(sorted(p[2] for p in points), range(8))
+        for step in xrange(5):
+            self.assertIn(sum(1 for p in points if p[0] == step), (1, 2))
+
+    def testSuccessiveHalving(self):
+        """Successive halving keeps the best candidates"""
+        # the objective is the distance to 3 in the first dimension, a
+        # larger budget in the last dimension makes it more accurate
+        actions = [[('x%d' % i,) for i in xrange(10)],
+                   [('y%d' % i,) for i in xrange(10)],
+                   [],
+                   [('b%d' % i,) for i in xrange(4)]]
+        def objective(performed):
+            x = int([a for a in performed if a[0] == 'x'][0][1:])
+            y = int([a for a in performed if a[0] == 'y'][0][1:])
+            budget = int([a for a in performed if a[0] == 'b'][0][1:])
+            return abs(x - 3) + (y % 3) / (budget + 1)
+
+        def run(seed):
+            sampler = SuccessiveHalvingSampler(16, 3, seed=seed)
+            explorer = ActionBasedParameterExploration()
+            performed = []
+            for pipeline, actions_ in explorer.iter_explore(
+                    self.FakePipeline(), actions, sampler=sampler):
+                performed.append(actions_)
+                sampler.report(objective(actions_))
+            self.assertEqual(len(performed), explorer.count(actions,
+                                                            sampler))
+            return sampler, performed
+
+        sampler, performed = run(5)
+        self.assertEqual(len(performed), 16 + 8 + 4 + 2)
+        self.assertEqual([p[0] for p in performed],
+                         ['b0'] * 16 + ['b1'] * 8 + ['b2'] * 4 + ['b3'] * 2)
+        point, score = sampler.best()
+        self.assertEqual(point[3], 3)
+        self.assertEqual(score, min(objective(p) for p in performed[-2:]))
+        self.assertEqual(run(5)[1], performed)
+
+        # missing scores rank last
+        sampler = SuccessiveHalvingSampler(4, 0, seed=1, maximize=True)
+        points = []
+        for point in sampler.samples([3, 6]):
+            points.append(point)
+            if point[1] % 2:
+                sampler.report(point[1])
+        self.assertEqual(len(points), sampler.count([3, 6]))
+        self.assertEqual(len(points), 4 + 2 + 1)
+        self.assertEqual(sampler.best()[1], max(p[1] for p in points[:4]
+                                                if p[1] % 2))
+
 if __name__ == '__main__':
     unittest.main()
@@ -130,6 +130,8 @@ class ParameterExploration(DBParameterExploration):
     def collectParameterActions(self, pipeline):
         """ collectParameterActions() -> list
         Return a list of action lists corresponding to each dimension
+        There are as many dimensions as in self.dims, and at least 4 (the
+        dimensions of the spreadsheet)
         
         """
         if not pipeline:
@@ -137,7 +139,8 @@ class ParameterExploration(DBParameterExploration):
         unescape_dict = { "&apos;":"'", '&quot;':'"', '&#xa;':'\n' }
         from vistrails.core.modules.module_registry import get_module_registry
         reg = get_module_registry()
-        parameterValues = [[], [], [], []]
+        dims = self.dims
+        parameterValues = [[] for i in xrange(max(4, len(dims)))]
         # a list of added functions [(module_id, function_name)] = function
         added_functions = {}
         vistrail_vars = []
@@ -154,9 +157,9 @@ class ParameterExploration(DBParameterExploration):
             for param in pe_function.parameters:
                 port_spec_item = port_spec.port_spec_items[param.pos]
                 dim = param.dimension
-                if dim not in [0, 1, 2, 3]:
+                if not 0 <= dim < len(dims):
                     continue
-                count = self.dims[dim]
+                count = dims[dim]
                 # find interpolator values
                 values = []
                 text = '%s' % unescape(param.value, unescape_dict)
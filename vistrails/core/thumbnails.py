@@ -35,13 +35,15 @@
 ###############################################################################
 from __future__ import division
 
-import itertools
-
 """ Utilities for dealing with the thumbnails """
+import heapq
+import json
 import os
 import os.path
+import Queue
 import shutil
 import tempfile
+import threading
 import time
 import uuid
 import mimetypes
@@ -61,9 +63,19 @@ class CacheEntry(object):
         self.size = size
         
 class ThumbnailCache(object):
+    """The directory of thumbnails of executed versions.
+
+    The entries are recorded in an index file in the directory, so only the
+    files it doesn't list are read at startup; the total size is kept up to
+    date and the least recently added entries are found through a heap.
+    Thumbnails can be generated on a background thread with
+    add_entry_from_cell_dump_async().
+
+    """
     _instance = None
     IMAGE_MAX_WIDTH = 200 
     SUPPORTED_TYPES = ['image/png','image/jpeg','image/bmp','image/gif']
+    INDEX_FILENAME = 'index.json'
     @staticmethod
     def getInstance(*args, **kwargs):
         if ThumbnailCache._instance is None:
@@ -76,22 +88,32 @@ class ThumbnailCache(object):
         if ThumbnailCache._instance is not None:
             ThumbnailCache._instance.destroy()
 
-    def __init__(self):
+    def __init__(self, directory=None):
         self._temp_directory = None
+        self._directory = directory
         self.elements = {}
         self.vtelements = {}
+        self._size = 0
+        self._lru = []
+        self._lock = threading.RLock()
+        self._queue = Queue.Queue()
+        self._pending = {}
+        self._worker = None
         self.conf = None
         conf = get_vistrails_configuration()
-        if conf.has('thumbs'):
+        if conf is not None and conf.has('thumbs'):
             self.conf = conf.thumbs
         self.init_cache()
 
     def destroy(self):
+        self.wait()
         if self._temp_directory is not None:
             print "removing thumbnail directory"
             shutil.rmtree(self._temp_directory)
         
     def get_directory(self):
+        if self._directory is not None:
+            return self._directory
         thumbnail_dir = system.get_vistrails_directory('thumbs.cacheDir')
         if thumbnail_dir is not None:
             if not os.path.exists(thumbnail_dir):
@@ -105,34 +127,129 @@ class ThumbnailCache(object):
         return self._temp_directory
     
     def init_cache(self):
-        for root,dirs, files in os.walk(self.get_directory()):
-            for f in files:
-                fname = os.path.join(root,f)
-                statinfo = os.stat(fname)
-                size = int(statinfo[6])
-                time = float(statinfo[8])
-                entry = CacheEntry(fname, f, time, size)
-                self.elements[f] = entry
-                
+        """init_cache() -> None
+        Loads the entries from the index, or scans the directory if there
+        is no valid index. The index is reconciled with the files in the
+        directory: only the files it doesn't know about are read.
+
+        """
+        directory = self.get_directory()
+        with self._lock:
+            self.elements = {}
+            self._size = 0
+            self._lru = []
+            try:
+                with open(os.path.join(directory, self.INDEX_FILENAME),
+                          'rb') as fp:
+                    index = json.load(fp)
+                files = set(f for f in os.listdir(directory)
+                            if not f.startswith(self.INDEX_FILENAME))
+                changed = False
+                for f, (time, size) in index.iteritems():
+                    if f not in files:
+                        # deleted behind our back
+                        changed = True
+                        continue
+                    self._add_element(CacheEntry(os.path.join(directory, f),
+                                                 f, time, size))
+                for f in files:
+                    if f in self.elements:
+                        continue
+                    # added behind our back
+                    fname = os.path.join(directory, f)
+                    if not os.path.isfile(fname):
+                        continue
+                    statinfo = os.stat(fname)
+                    self._add_element(CacheEntry(fname, f,
+                                                 float(statinfo[8]),
+                                                 int(statinfo[6])))
+                    changed = True
+                if changed:
+                    self.save_index()
+            except (IOError, OSError, ValueError, TypeError):
+                self.elements = {}
+                self._size = 0
+                self._lru = []
+                for root,dirs, files in os.walk(directory):
+                    for f in files:
+                        if f.startswith(self.INDEX_FILENAME):
+                            continue
+                        fname = os.path.join(root,f)
+                        statinfo = os.stat(fname)
+                        size = int(statinfo[6])
+                        time = float(statinfo[8])
+                        entry = CacheEntry(fname, f, time, size)
+                        self._add_element(entry)
+                self.save_index()
+
+    def save_index(self, directory=None):
+        """save_index(directory: str) -> None
+        Writes the index of the entries to the directory, by default the
+        cache directory.
+
+        """
+        if directory is None:
+            directory = self.get_directory()
+        with self._lock:
+            index = dict((entry.name, (entry.time, entry.size))
+                         for entry in self.elements.itervalues())
+        filename = os.path.join(directory, self.INDEX_FILENAME)
+        tmp = filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as fp:
+                json.dump(index, fp)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError), e:
+            debug.warning("Couldn't save thumbnail index", e)
+
+    def _add_element(self, entry):
+        with self._lock:
+            old = self.elements.get(entry.name)
+            if old is not None:
+                self._size -= old.size
+            self.elements[entry.name] = entry
+            self._size += entry.size
+            heapq.heappush(self._lru, (entry.time, entry.name))
+            # drop the heap items of removed or replaced entries
+            if len(self._lru) > 2 * len(self.elements) + 16:
+                self._lru = [(e.time, e.name)
+                             for e in self.elements.itervalues()]
+                heapq.heapify(self._lru)
+
+    def _remove_element(self, name):
+        with self._lock:
+            entry = self.elements.pop(name, None)
+            if entry is not None:
+                self._size -= entry.size
+            return entry
+
     def get_abs_name_entry(self,name):
         """get_abs_name_entry(name) -> str 
         It will look for absolute file path of name in self.elements and 
         self.vtelements. It returns None if item was not found.
+        If the thumbnail is being generated, waits for it.
         
         """
+        event = self._pending.get(name)
+        if event is not None:
+            event.wait()
         try:
-            return self.elements[name].abs_name
+            abs_name = self.elements[name].abs_name
         except KeyError, e:
             try:
                 return self.vtelements[name].abs_name
             except KeyError, e:
                 return None
+        if not os.path.exists(abs_name):
+            # deleted behind our back
+            self._remove_element(name)
+            return None
+        return abs_name
         
     def size(self):
-        size = 0
-        for entry in self.elements.itervalues():
-            size += entry.size
-        return size
+        return self._size
 
     def move_cache_directory(self, sourcedir, destdir):
         """change_cache_directory(sourcedir: str, dest_dir: str) -> None"
@@ -140,45 +257,65 @@ class ThumbnailCache(object):
         
         """
         if os.path.exists(destdir):
-            for entry in self.elements.itervalues():
+            self.wait()
+            with self._lock:
+                for entry in self.elements.itervalues():
+                    try:
+                        srcname = entry.abs_name
+                        dstname = os.path.join(destdir,entry.name)
+                        shutil.move(srcname,dstname)
+                        entry.abs_name = dstname
+
+                    except shutil.Error, e:
+                        debug.warning("Could not move thumbnail from %s to %s" % (
+                                      sourcedir, destdir),
+                                      e)
                 try:
-                    srcname = entry.abs_name
-                    dstname = os.path.join(destdir,entry.name)
-                    shutil.move(srcname,dstname)
-                    entry.abs_name = dstname
-                        
-                except shutil.Error, e:
-                    debug.warning("Could not move thumbnail from %s to %s" % (
-                                  sourcedir, destdir),
-                                  e)
+                    os.remove(os.path.join(sourcedir, self.INDEX_FILENAME))
+                except OSError:
+                    pass
+                if self._directory is not None:
+                    self._directory = destdir
+            self.save_index(destdir)
                     
     def remove_lru(self,n=1):
-        elements = self.elements.values()
-        elements.sort(key=lambda obj: obj.time)
-        num = min(n,len(elements))
-        debug.debug("Will remove %s elements from cache..."%num)
-        debug.debug("Cache has %s elements and %s bytes"%(len(elements),
-                                                             self.size()))
-        for elem in itertools.islice(elements, num):
-            try:
-                del self.elements[elem.name]
-                os.unlink(elem.abs_name)
-            except os.error, e:
-                debug.warning("Could not remove file %s" % elem.abs_name, e)
+        with self._lock:
+            num = min(n,len(self.elements))
+            debug.debug("Will remove %s elements from cache..."%num)
+            debug.debug("Cache has %s elements and %s bytes"%(
+                        len(self.elements), self.size()))
+            removed = 0
+            while removed < num and self._lru:
+                time, name = heapq.heappop(self._lru)
+                elem = self.elements.get(name)
+                if elem is None or elem.time != time:
+                    # stale heap item
+                    continue
+                self._remove_element(name)
+                removed += 1
+                try:
+                    os.unlink(elem.abs_name)
+                except os.error, e:
+                    debug.warning("Could not remove file %s" % elem.abs_name, e)
 
     def remove(self,key):
-        if key in self.elements.keys():
-            entry = self.elements[key]
-            del self.elements[key]
-            os.unlink(entry.abs_name)
-        elif key in self.vtelements.keys():
-            entry = self.vtelements[key]
-            del self.vtelements[key]
-            os.unlink(entry.abs_name)
+        with self._lock:
+            if key in self.elements:
+                entry = self._remove_element(key)
+                os.unlink(entry.abs_name)
+            elif key in self.vtelements:
+                entry = self.vtelements[key]
+                del self.vtelements[key]
+                os.unlink(entry.abs_name)
             
     def clear(self):
-        self.elements = {}
-        self._delete_files(self.get_directory())
+        self.wait()
+        with self._lock:
+            self.elements = {}
+            self._size = 0
+            self._lru = []
+            self._delete_files(self.get_directory())
+            self.save_index()
         
     def add_entry_from_cell_dump(self, folder, key=None):
         """create_entry_from_cell_dump(folder: str) -> str
@@ -189,26 +326,93 @@ class ThumbnailCache(object):
         
         """
         
+        fname = "%s.png" % str(uuid.uuid1())
+        if self._create_entry(self._get_thumbnail_fnames(folder), fname, key):
+            self.save_index()
+            return fname
+        return None
+
+    def add_entry_from_cell_dump_async(self, folder, key=None,
+                                       remove_folder=False):
+        """add_entry_from_cell_dump_async(folder: str, key: str,
+                                           remove_folder: bool) -> str
+        Like add_entry_from_cell_dump() but the image is merged and saved by
+        a background thread. Returns the name the image will have in the
+        cache, or None if there are no valid images in folder.
+        If remove_folder is True, the folder is deleted once it has been
+        read; otherwise it must not change until wait() returns.
+
+        """
+        # the images are checked now, so that the name that is returned
+        # doesn't end up without a file
+        thumbnail_fnames = self._get_valid_thumbnail_fnames(
+                self._get_thumbnail_fnames(folder))
+        if not thumbnail_fnames:
+            if remove_folder:
+                shutil.rmtree(folder, ignore_errors=True)
+            return None
+        fname = "%s.png" % str(uuid.uuid1())
+        with self._lock:
+            self._pending[fname] = threading.Event()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work)
+                self._worker.setDaemon(True)
+                self._worker.start()
+        self._queue.put((folder, thumbnail_fnames, fname, key,
+                         remove_folder))
+        return fname
+
+    def wait(self):
+        """wait() -> None
+        Waits for the thumbnails being generated in the background.
+
+        """
+        if self._worker is not None:
+            self._queue.join()
+
+    def _work(self):
+        while True:
+            folder, thumbnail_fnames, fname, key, remove_folder = \
+                self._queue.get()
+            try:
+                self._create_entry(thumbnail_fnames, fname, key)
+                if self._queue.empty():
+                    self.save_index()
+            except Exception, e:
+                debug.unexpected_exception(e)
+                debug.warning("Couldn't create thumbnail", e)
+            finally:
+                if remove_folder:
+                    shutil.rmtree(folder, ignore_errors=True)
+                self._pending.pop(fname).set()
+                self._queue.task_done()
+
+    def _create_entry(self, thumbnail_fnames, fname, key):
+        """_create_entry(thumbnail_fnames: list(str), fname: str,
+                          key: str) -> bool
+        Merges the images into a single image, saved in the cache as fname,
+        replacing entry key. Returns False if there was no valid image.
+
+        """
         image = None
-        thumbnail_fnames = self._get_thumbnail_fnames(folder)
         if len(thumbnail_fnames) > 0:
             image = self._merge_thumbnails(thumbnail_fnames)
-        fname = None
-        if image is not None and image.width() > 0 and image.height() > 0:
-            fname = "%s.png" % str(uuid.uuid1())
-            abs_fname = self._save_thumbnail(image, fname) 
-            statinfo = os.stat(abs_fname)
-            size = int(statinfo[6])
-            time = float(statinfo[8])
-            entry = CacheEntry(abs_fname, fname, time, size)
+        if image is None or image.width() <= 0 or image.height() <= 0:
+            return False
+        abs_fname = self._save_thumbnail(image, fname) 
+        statinfo = os.stat(abs_fname)
+        size = int(statinfo[6])
+        time = float(statinfo[8])
+        entry = CacheEntry(abs_fname, fname, time, size)
+        with self._lock:
             #remove old element
             if key:
                 self.remove(key)
             if self.size() + size > self.conf.cacheSize*1024*1024:
                 self.remove_lru(10)
-                
-            self.elements[fname] = entry
-        return fname
+
+            self._add_element(entry)
+        return True
         
     def add_entries_from_files(self, absfnames):
         """add_entries_from_files(absfnames: list of str) -> None
@@ -254,10 +458,29 @@ class ThumbnailCache(object):
                     fnames.append(os.path.join(root,f))
         return fnames
 
+    @staticmethod
+    def _get_valid_thumbnail_fnames(fnames):
+        """_get_valid_thumbnail_fnames(fnames: list(str)) -> list(str)
+        Returns the files that contain a non-empty image, reading only
+        their headers when possible.
+
+        """
+        from PyQt4 import QtGui
+        valid = []
+        for fname in fnames:
+            reader = QtGui.QImageReader(fname)
+            size = reader.size()
+            if not size.isValid():
+                size = reader.read().size()
+            if size.width() > 0 and size.height() > 0:
+                valid.append(fname)
+        return valid
+
     @staticmethod
     def _merge_thumbnails(fnames):
         """_merge_thumbnails(fnames: list(str)) -> QImage 
         Generates a single image formed by all the images in the fnames list.
+        Only uses QImage, which can be used outside of the GUI thread.
         
         """
         from PyQt4 import QtCore, QtGui
@@ -267,7 +490,7 @@ class ThumbnailCache(object):
         # OS may return wrong order so  we need to sort
         fnames.sort()
         for fname in fnames:
-            pix = QtGui.QPixmap(fname)
+            pix = QtGui.QImage(fname)
             if pix.height() > 0 and pix.width() > 0:
                 pixmaps.append(pix)
                 #width += pix.width()
@@ -279,7 +502,7 @@ class ThumbnailCache(object):
             painter = QtGui.QPainter(finalImage)
             x = 0
             for pix in pixmaps:
-                painter.drawPixmap(0, x, pix)
+                painter.drawImage(0, x, pix)
                 x += pix.height()
             painter.end()
             if width > ThumbnailCache.IMAGE_MAX_WIDTH:
@@ -303,7 +526,85 @@ class ThumbnailCache(object):
     def _copy_thumbnails(self, thumbnails):
         """_copy_thumbnails(thumbnails: list of str) -> None """
         local_dir = self.get_directory()
+        copied = False
         for thumb in thumbnails:
-            local_thumb = os.path.join(local_dir, os.path.basename(thumb))
+            fname = os.path.basename(thumb)
+            local_thumb = os.path.join(local_dir, fname)
             if os.path.exists(thumb) and not os.path.exists(local_thumb):
                 shutil.copyfile(thumb, local_thumb)
+                statinfo = os.stat(local_thumb)
+                self._add_element(CacheEntry(local_thumb, fname,
+                                             float(statinfo[8]),
+                                             int(statinfo[6])))
+                copied = True
+        if copied:
+            self.save_index()
+
+################################################################################
+
+import unittest
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_test_thumbs_')
+        self.source = tempfile.mkdtemp(prefix='vt_test_thumbs_src_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.source)
+
+    def make_files(self, cache, sizes):
+        fnames = []
+        for i, size in enumerate(sizes):
+            fname = os.path.join(self.source, '%d.png' % i)
+            with open(fname, 'wb') as fp:
+                fp.write('x' * size)
+            fnames.append(fname)
+        cache._copy_thumbnails(fnames)
+
+    def test_index(self):
+        """The index is used and reconciled with the directory"""
+        cache = ThumbnailCache(self.directory)
+        self.make_files(cache, [10, 20, 30])
+        self.assertEqual(cache.size(), 60)
+        with open(os.path.join(self.directory, 'other.png'), 'wb') as fp:
+            fp.write('x' * 5)
+
+        os.remove(os.path.join(self.directory, '2.png'))
+
+        # new files are added to the index, missing ones are dropped
+        cache = ThumbnailCache(self.directory)
+        self.assertEqual(sorted(cache.elements),
+                         ['0.png', '1.png', 'other.png'])
+        self.assertEqual(cache.size(), 35)
+        with open(os.path.join(self.directory,
+                               ThumbnailCache.INDEX_FILENAME), 'rb') as fp:
+            self.assertEqual(sorted(json.load(fp)),
+                             ['0.png', '1.png', 'other.png'])
+
+        # without an index, the directory is scanned
+        os.remove(os.path.join(self.directory, ThumbnailCache.INDEX_FILENAME))
+        cache = ThumbnailCache(self.directory)
+        self.assertEqual(cache.size(), 35)
+
+        # missing files are dropped from the index
+        os.remove(os.path.join(self.directory, '1.png'))
+        self.assertIsNone(cache.get_abs_name_entry('1.png'))
+        self.assertEqual(cache.size(), 15)
+
+    def test_remove_lru(self):
+        cache = ThumbnailCache(self.directory)
+        self.make_files(cache, [10, 20, 30, 40])
+        for i, name in enumerate(['2.png', '0.png', '3.png', '1.png']):
+            cache.elements[name].time = i
+        cache._lru = [(e.time, e.name) for e in cache.elements.itervalues()]
+        heapq.heapify(cache._lru)
+        # replacing an entry makes its previous heap item stale
+        entry = cache.elements['2.png']
+        cache._add_element(CacheEntry(entry.abs_name, entry.name, 5,
+                                      entry.size))
+        cache.remove_lru(2)
+        self.assertEqual(sorted(cache.elements), ['1.png', '2.png'])
+        self.assertEqual(cache.size(), 50)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['1.png', '2.png', ThumbnailCache.INDEX_FILENAME])
@@ -226,6 +226,24 @@ class UpgradePackageRemap(object):
     def has_module_remaps(self, module_name):
         return module_name in self.remaps
 
+    def get_routes(self):
+        """get_routes() -> tuple
+
+        Returns the module names, versions and targets of the remaps,
+        leaving out the remap functions, as a hashable value.
+        """
+        routes = []
+        for module_name, module_remaps in sorted(self.remaps.iteritems()):
+            for module_remap in module_remaps:
+                new_module = module_remap.new_module
+                if isinstance(new_module, ModuleDescriptor):
+                    new_module = (new_module.spec_tuple,
+                                  new_module.package_version)
+                routes.append((module_name, module_remap.start_version,
+                               module_remap.end_version,
+                               module_remap.output_version, new_module))
+        return tuple(routes)
+
     def get_module_upgrade(self, module_name, old_version):
         for module_remap in self.get_module_remaps(module_name):
             if ((module_remap.start_version is None or 
@@ -372,6 +390,68 @@ class UpgradeWorkflowHandler(object):
                                                        'input', d,
                                                        function.sigstring)
 
+    @staticmethod
+    def get_upgrade_plan(controller, pipeline, module_id, function_remap=None,
+                         src_port_remap=None, dst_port_remap=None):
+        """get_upgrade_plan(controller, pipeline, module_id,
+                            function_remap=None, src_port_remap=None,
+                            dst_port_remap=None) -> ModuleDescriptor
+
+        Finds the descriptor an outdated module is automatically
+        upgraded to and checks that every port it uses still exists,
+        raising UpgradeWorkflowError otherwise.
+
+        Successful plans are cached in the registry for the module
+        type, version and set of checked ports, so that the other
+        instances of the same outdated module (in this pipeline or in
+        any other version) skip the lookups.
+        """
+        if function_remap is None:
+            function_remap = {}
+        if src_port_remap is None:
+            src_port_remap = {}
+        if dst_port_remap is None:
+            dst_port_remap = {}
+        invalid_module = pipeline.modules[module_id]
+        ports = set()
+        for _, conn_id in pipeline.graph.edges_from(module_id):
+            port = pipeline.connections[conn_id].source
+            if port.name not in src_port_remap:
+                ports.add((port.name, port.type, port.sigstring))
+        for _, conn_id in pipeline.graph.edges_to(module_id):
+            port = pipeline.connections[conn_id].destination
+            if port.name not in dst_port_remap:
+                ports.add((port.name, port.type, port.sigstring))
+        for function in invalid_module.functions:
+            if function.name not in function_remap:
+                ports.add((function.name, 'input', function.sigstring))
+        # ports missing from the descriptor may be defined on the module
+        local_ports = frozenset((spec.name, spec.type)
+                                for spec in invalid_module.port_spec_list)
+        key = ('automatic', invalid_module.descriptor_info,
+               frozenset(ports), local_ports)
+
+        reg = get_module_registry()
+        if key in reg._upgrade_plans:
+            return reg._upgrade_plans[key]
+
+        d = UpgradeWorkflowHandler.find_descriptor(controller, pipeline,
+                                                   module_id)
+        if not d:
+            if invalid_module.namespace:
+                nss = invalid_module.namespace + '|' + invalid_module.name
+            else:
+                nss = invalid_module.name
+            msg = ("Could not upgrade module %s from package %s.\n" %
+                    (nss, invalid_module.package))
+            raise UpgradeWorkflowError(msg)
+
+        UpgradeWorkflowHandler.check_upgrade(pipeline, module_id, d,
+                                             function_remap,
+                                             src_port_remap, dst_port_remap)
+        reg._upgrade_plans[key] = d
+        return d
+
     @staticmethod
     def attempt_automatic_upgrade(controller, pipeline, module_id,
                                   function_remap=None, src_port_remap=None, 
@@ -389,25 +469,10 @@ class UpgradeWorkflowHandler(object):
         successful.
         """
 
-        invalid_module = pipeline.modules[module_id]
-        mpkg, mname, mnamespace, mid = (invalid_module.package,
-                                        invalid_module.name,
-                                        invalid_module.namespace,
-                                        invalid_module.id)
-        d = UpgradeWorkflowHandler.find_descriptor(controller, pipeline, 
-                                                   module_id)
-        if not d:
-            if mnamespace:
-                nss = mnamespace + '|' + mname
-            else:
-                nss = mname
-            msg = ("Could not upgrade module %s from package %s.\n" %
-                    (nss, mpkg))
-            raise UpgradeWorkflowError(msg)
-
-        UpgradeWorkflowHandler.check_upgrade(pipeline, module_id, d, 
-                                             function_remap, 
-                                             src_port_remap, dst_port_remap)
+        d = UpgradeWorkflowHandler.get_upgrade_plan(controller, pipeline,
+                                                    module_id, function_remap,
+                                                    src_port_remap,
+                                                    dst_port_remap)
 
         # If we passed all of these checks, then we consider module to
         # be automatically upgradeable. Now create actions that will
@@ -715,72 +780,46 @@ class UpgradeWorkflowHandler(object):
                                                       use_registry)
 
     @staticmethod
-    def remap_module(controller, module_id, pipeline, pkg_remap):
-        """remap_module offers a method to shortcut the
-        specification of upgrades.  It is useful when just changing
-        the names of ports or modules, but can also be used to add
-        intermediate modules or change the format of parameters.  It
-        is usually called from handle_module_upgrade_request, and the
-        first three arguments are passed from the arguments to that
-        method.
-
-        pkg_remap specifies all of the changes and is of the format::
-
-            {<old_module_name>: [(<start_version>, <end_version>,
-                                  <new_module_klass> | <new_module_id> | None,
-                                  <remap_dictionary>)]}
-
-        where new_module_klass is the class and new_module_id
-        is a string of the format::
-
-            <package_name>:[<namespace> | ]<module_name>
-
-        passing None keeps the original name,
-        and remap_dictionary is {<remap_type>:
-        <name_changes>} and <name_changes> is a map from <old_name> to
-        <new_name> or <remap_function>
-        The remap functions are passed the old object and the new
-        module and should return a list of operations with elements of
-        the form ('add', <obj>).
-
-        For example::
-
-            def outputName_remap(old_conn, new_module):
-                ops = []
-                ...
-                return ops
-
-            pkg_remap = {'FileSink': [
-                             (None, '1.5.1', FileSink, {
-                                  'dst_port_remap': {
-                                      'overrideFile': 'overwrite',
-                                      'outputName': outputName_remap},
-                                  'function_remap': {
-                                      'overrideFile': 'overwrite',
-                                      'outputName': 'outputPath'}}),
-            }
+    def get_remap_plan(pkg_remap, old_module):
+        """get_remap_plan(pkg_remap, old_module) -> list
+
+        Resolves the chain of remaps that upgrades old_module to the
+        current package version, as a list of (UpgradeModuleRemap,
+        ModuleDescriptor, use_registry) steps.
+
+        The resolved steps are cached in the registry for each module
+        type and version and the versions and targets of the remaps, so
+        the remaps of the other instances of the same outdated module are
+        only resolved once, even if pkg_remap is built again for each
+        upgrade request. The UpgradeModuleRemap of each step is taken from
+        the pkg_remap that is passed, since its remap functions might be
+        different.
         """
-
         reg = get_module_registry()
 
-        old_module = pipeline.modules[module_id]
+        remaps = pkg_remap
+        if not isinstance(remaps, UpgradePackageRemap):
+            remaps = UpgradePackageRemap.from_dict(remaps)
+
         old_version = old_module.version
         old_desc_str = create_descriptor_string(old_module.package,
                                                 old_module.name,
                                                 old_module.namespace,
                                                 False)
-        # print 'running module_upgrade_request', old_module.name
-        if not isinstance(pkg_remap, UpgradePackageRemap):
-            pkg_remap = UpgradePackageRemap.from_dict(pkg_remap)
-        
-
-        action_list = []
-
+        key = ('remap', old_desc_str, old_version, remaps.get_routes())
+        if key in reg._upgrade_plans:
+            return [(remaps.get_module_upgrade(desc_str, version),
+                     new_module_desc, use_registry)
+                    for desc_str, version, new_module_desc, use_registry
+                    in reg._upgrade_plans[key]]
+
+        plan = []
+        steps = []
         old_module_t = \
             (old_module.package, old_module.name, old_module.namespace)
-        module_remap = pkg_remap.get_module_upgrade(old_desc_str, old_version)
-        tmp_pipeline = copy.copy(pipeline)
+        module_remap = remaps.get_module_upgrade(old_desc_str, old_version)
         while module_remap is not None:
+            steps.append((old_desc_str, old_version))
             new_module_type = module_remap.new_module
             if new_module_type is None:
                 new_module_t = old_module_t
@@ -824,9 +863,75 @@ class UpgradeWorkflowHandler(object):
                                                         new_module_t[2],
                                                         False)
                 old_version = new_pkg_version
-                next_module_remap = pkg_remap.get_module_upgrade(old_desc_str,
-                                                                 old_version)
+                next_module_remap = remaps.get_module_upgrade(old_desc_str,
+                                                              old_version)
                 old_module_t = new_module_t
+            plan.append((module_remap, new_module_desc, use_registry))
+            module_remap = next_module_remap
+
+        reg._upgrade_plans[key] = [step + (new_module_desc, use_registry)
+                                   for step, (_, new_module_desc,
+                                              use_registry)
+                                   in zip(steps, plan)]
+        return plan
+
+    @staticmethod
+    def remap_module(controller, module_id, pipeline, pkg_remap):
+        """remap_module offers a method to shortcut the
+        specification of upgrades.  It is useful when just changing
+        the names of ports or modules, but can also be used to add
+        intermediate modules or change the format of parameters.  It
+        is usually called from handle_module_upgrade_request, and the
+        first three arguments are passed from the arguments to that
+        method.
+
+        pkg_remap specifies all of the changes and is of the format::
+
+            {<old_module_name>: [(<start_version>, <end_version>,
+                                  <new_module_klass> | <new_module_id> | None,
+                                  <remap_dictionary>)]}
+
+        where new_module_klass is the class and new_module_id
+        is a string of the format::
+
+            <package_name>:[<namespace> | ]<module_name>
+
+        passing None keeps the original name,
+        and remap_dictionary is {<remap_type>:
+        <name_changes>} and <name_changes> is a map from <old_name> to
+        <new_name> or <remap_function>
+        The remap functions are passed the old object and the new
+        module and should return a list of operations with elements of
+        the form ('add', <obj>).
+
+        For example::
+
+            def outputName_remap(old_conn, new_module):
+                ops = []
+                ...
+                return ops
+
+            pkg_remap = {'FileSink': [
+                             (None, '1.5.1', FileSink, {
+                                  'dst_port_remap': {
+                                      'overrideFile': 'overwrite',
+                                      'outputName': outputName_remap},
+                                  'function_remap': {
+                                      'overrideFile': 'overwrite',
+                                      'outputName': 'outputPath'}}),
+            }
+        """
+
+        old_module = pipeline.modules[module_id]
+        plan = UpgradeWorkflowHandler.get_remap_plan(pkg_remap, old_module)
+
+        action_list = []
+        # the pipeline is only copied if a later step needs the result of
+        # the previous ones; the shared copy is thrown away before the
+        # caller's pipeline can change again
+        tmp_pipeline = pipeline
+        for i, (module_remap, new_module_desc, use_registry) in \
+                enumerate(plan):
             replace_module = UpgradeWorkflowHandler.replace_module
             actions = replace_module(controller,
                                      tmp_pipeline,
@@ -838,7 +943,12 @@ class UpgradeWorkflowHandler(object):
                                      module_remap.annotation_remap,
                                      module_remap.control_param_remap,
                                      use_registry)
+            action_list.extend(actions)
+            if i + 1 == len(plan):
+                break
 
+            if tmp_pipeline is pipeline:
+                tmp_pipeline = pipeline.shared_copy()
             for a in actions:
                 for op in a.operations:
                     # Update the id of the module being updated
@@ -848,9 +958,6 @@ class UpgradeWorkflowHandler(object):
                         module_id = op.objectId
                         break
                 tmp_pipeline.perform_action(a)
-
-            action_list.extend(actions)
-            module_remap = next_module_remap
         if len(action_list) > 0:
             return action_list
 
@@ -984,6 +1091,96 @@ class TestUpgradePackageRemap(unittest.TestCase):
                                          src_port_remap={'zz': None})]}
         self.run_multi_upgrade_test(pkg_remap)
 
+    def test_cached_plans(self):
+        from vistrails.core.application import get_vistrails_application
+
+        def make_remap():
+            # handle_module_upgrade_request() usually builds its remaps
+            # again on each call
+            return {'TestUpgradeA':
+                    [UpgradeModuleRemap('0.8', '0.9', '0.9', None,
+                                        function_remap={'a': 'aa'},
+                                        src_port_remap={'z': 'zz'}),
+                     UpgradeModuleRemap('0.9', '1.0', '1.0', None,
+                                        function_remap={'aa': 'aaa'},
+                                        src_port_remap={'zz': 'zzz'})]}
+
+        check_upgrade = UpgradeWorkflowHandler.check_upgrade
+        checks = []
+        def counting_check_upgrade(*args, **kwargs):
+            checks.append(args)
+            return check_upgrade(*args, **kwargs)
+
+        app = get_vistrails_application()
+        created_vistrail = False
+        pm = get_package_manager()
+        url_pkg = 'org.vistrails.vistrails.url'
+        enabled_url = False
+        try:
+            pm.late_enable_package('upgrades',
+                                   {'upgrades':
+                                    'vistrails.tests.resources.'})
+            if not pm.has_package(url_pkg):
+                pm.late_enable_package('URL')
+                enabled_url = True
+            app.new_vistrail()
+            created_vistrail = True
+            c = app.get_controller()
+            self.create_workflow(c)
+            d = ModuleDescriptor(package=url_pkg, name='HTTPFile',
+                                 namespace='', package_version='0.9')
+            m = c.create_module_from_descriptor(d, use_desc_pkg_version=True)
+            m.is_valid = False
+            c.add_module_action(m)
+            p = c.current_pipeline
+            plans = get_module_registry()._upgrade_plans
+            UpgradeWorkflowHandler.check_upgrade = \
+                staticmethod(counting_check_upgrade)
+
+            ops = []
+            for i in xrange(2):
+                actions = UpgradeWorkflowHandler.remap_module(c, 0, p,
+                                                              make_remap())
+                self.assertEqual(len(actions), 2)
+                ops.append([(op.vtType, op.what)
+                            for a in actions for op in a.operations])
+                self.assertEqual(len(plans), 1)
+            self.assertEqual(ops[0], ops[1])
+            # the remaps come from the pkg_remap that is passed
+            pkg_remap = UpgradePackageRemap.from_dict(make_remap())
+            plan = UpgradeWorkflowHandler.get_remap_plan(pkg_remap,
+                                                         p.modules[0])
+            self.assertIs(plan[0][0],
+                          pkg_remap.get_module_upgrade('TestUpgradeA', '0.8'))
+
+            # through a package's handle_module_upgrade_request()
+            handler = pm.get_package(url_pkg).module.\
+                handle_module_upgrade_request
+            ops = []
+            for i in xrange(2):
+                actions = handler(c, m.id, p)
+                self.assertEqual(len(actions), 1)
+                ops.append([(op.vtType, op.what)
+                            for a in actions for op in a.operations])
+                self.assertEqual(len(plans), 2)
+            self.assertEqual(ops[0], ops[1])
+
+            for i in xrange(2):
+                d = UpgradeWorkflowHandler.get_upgrade_plan(c, p, 1)
+                self.assertEqual(d.name, 'TestUpgradeB')
+                self.assertEqual(len(checks), 1)
+        finally:
+            UpgradeWorkflowHandler.check_upgrade = staticmethod(check_upgrade)
+            if created_vistrail:
+                app.close_vistrail()
+            for pkg in ['upgrades'] + (['URL'] if enabled_url else []):
+                try:
+                    pm.late_disable_package(pkg)
+                except MissingPackage:
+                    pass
+        # changing the registry drops the plans
+        self.assertEqual(get_module_registry()._upgrade_plans, {})
+
     def test_external_upgrade(self):
         from vistrails.core.application import get_vistrails_application
 
@@ -154,6 +154,7 @@ class VistrailController(object):
         self.is_abstraction = False
         self.changed = False
         self._upgrade_rev_map = None
+        self._terse_settings = None
 
         # if _cache_pipelines is True, cache pipelines to speed up
         # version switching
@@ -2632,9 +2633,21 @@ class VistrailController(object):
                 old_thumb_name = self.vistrail.get_thumbnail(version)
                 if 'compare_thumbnails' in extra_info:
                     old_thumb_name = None
-                fname = thumb_cache.add_entry_from_cell_dump(
-                                        extra_info['pathDumpCells'],
-                                        old_thumb_name)
+                    fname = thumb_cache.add_entry_from_cell_dump(
+                                            extra_info['pathDumpCells'],
+                                            old_thumb_name)
+                elif temp_folder_used:
+                    # merge and save the images in the background, the
+                    # thumbnail cache removes the folder when done
+                    fname = thumb_cache.add_entry_from_cell_dump_async(
+                                            extra_info['pathDumpCells'],
+                                            old_thumb_name,
+                                            remove_folder=True)
+                    temp_folder_used = False
+                else:
+                    fname = thumb_cache.add_entry_from_cell_dump(
+                                            extra_info['pathDumpCells'],
+                                            old_thumb_name)
                 if 'compare_thumbnails' in extra_info:
                     # check thumbnail difference
                     prev = None
@@ -2921,84 +2934,129 @@ class VistrailController(object):
                                         'hideUpgrades', True)
         self.show_upgrades = show_upgrades
 
-        # get full version tree (including pruned nodes) this tree is
-        # kept updated all the time. This data is read only and should
-        # not be updated!
-        fullVersionTree = self.vistrail.tree.getVersionTree()
-
-        # create tersed tree
-        open_list = [(0, None, False, False)]  # Elements to be handled
-        tersedVersionTree = Graph()
+        # Only walk the parts of the version tree that changed since the
+        # terse graph was computed, if possible
+        if not self._update_terse_graph():
+            self._build_terse_graph()
 
-        # cache actionMap and tagMap because they're properties, sort
-        # of slow
-        am = self.vistrail.actionMap
-        tm = self.vistrail.get_tagMap()
-        last_n = self.vistrail.getLastActions(self.num_versions_always_shown)
+    def _terse_graph_settings(self):
+        # the search only changes the graph if it is refined
+        return (self.vistrail, self.show_upgrades, self.full_tree,
+                self.num_versions_always_shown, self.refine,
+                self.search if self.refine else None)
 
+    def _build_terse_graph(self):
+        """Computes the terse graph from scratch.
+        """
+        # process upgrade annotations
         upgrades = set()
-        upgrade_rev_map = {}
-        current_version = self.current_version
-        def rev_map(v):
-            return upgrade_rev_map.get(v, v)
-
+        upgrade_parent_map = {}
         if not self.show_upgrades:
-            # process upgrade annotations
             for ann in self.vistrail.action_annotations:
                 if ann.key != Vistrail.UPGRADE_ANNOTATION:
                     continue
                 # The target is an upgrade
                 upgrades.add(int(ann.value))
                 # Map from upgraded version to original
-                upgrade_rev_map[int(ann.value)] = ann.action_id
-
-            # Map current version
-            current_version = rev_map(current_version)
-
-            # Map tags
-            tm, orig_tm = {}, tm
-            for version, name in sorted(orig_tm.iteritems(),
-                                        key=lambda p: p[0]):
-                v = version
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                    if v in orig_tm:
-                        # Found another tag in upgrade chain, don't move tag
-                        v = version
-                        break
-                tm[v] = name
-            del orig_tm
+                upgrade_parent_map[int(ann.value)] = ann.action_id
+
+        # Transitively flatten upgrade_rev_map
+        upgrade_rev_map = dict(upgrade_parent_map)
+        for k, v in upgrade_rev_map.iteritems():
+            while v in upgrade_rev_map:
+                v = upgrade_rev_map[v]
+            upgrade_rev_map[k] = v
+
+        self._upgrades = upgrades
+        self._upgrade_parent_map = upgrade_parent_map
+        self._upgrade_rev_map = upgrade_rev_map
+        self._terse_settings = self._terse_graph_settings()
+        self._terse_changes = (self.vistrail.version_changes_dropped +
+                               len(self.vistrail.version_changes))
+        self._terse_tags = self._get_terse_tags()
+        self._terse_last_n = set(self.vistrail.getLastActions(
+                self.num_versions_always_shown))
+        self._terse_current = upgrade_rev_map.get(self.current_version,
+                                                  self.current_version)
+        # value of 'collapsible' passed to the children of tersed vertices
+        self._terse_collapsible = {}
+
+        tersedVersionTree = Graph()
+        self._walk_terse_graph(tersedVersionTree, [(0, None, False, False)])
 
-            # Transitively flatten upgrade_rev_map
-            for k, v in upgrade_rev_map.iteritems():
-                while v in upgrade_rev_map:
-                    v = upgrade_rev_map[v]
-                upgrade_rev_map[k] = v
+        self._current_terse_graph = tersedVersionTree
+        self._current_full_graph = self.vistrail.tree.getVersionTree()
+
+    def _get_terse_tags(self):
+        """Returns the tag map, with tags moved from upgrades to the original
+        versions.
+        """
+        orig_tm = self.vistrail.get_tagMap()
+        if self.show_upgrades:
+            return orig_tm
+        upgrade_parent_map = self._upgrade_parent_map
+        tm = {}
+        for version, name in sorted(orig_tm.iteritems(),
+                                    key=lambda p: p[0]):
+            v = version
+            while v in upgrade_parent_map:
+                v = upgrade_parent_map[v]
+                if v in orig_tm:
+                    # Found another tag in upgrade chain, don't move tag
+                    v = version
+                    break
+            tm[v] = name
+        return tm
+
+    def _get_terse_children(self, current):
+        """Returns the children of a version in the terse graph, skipping
+        pruned versions and hidden upgrades.
+        """
+        # get full version tree (including pruned nodes) this tree is
+        # kept updated all the time. This data is read only and should
+        # not be updated!
+        fullVersionTree = self.vistrail.tree.getVersionTree()
+        am = self.vistrail.actionMap
+        all_children = [
+            to for to, _ in fullVersionTree.adjacency_list[current]
+            if to in am]
+        children = []
+        while all_children:
+            child = all_children.pop()
+            # Pruned: drop it
+            if self.vistrail.is_pruned(child):
+                pass
+            # An upgrade: get its children directly
+            # (unless it is tagged, and that tag couldn't be moved)
+            elif (not self.show_upgrades and
+                  (child in self._upgrades or
+                   am[child].description == 'Upgrade') and
+                  child not in self._terse_tags):
+                all_children.extend(
+                    to for to, _ in fullVersionTree.adjacency_list[child]
+                    if to in am)
+            else:
+                children.append(child)
+        return children
+
+    def _walk_terse_graph(self, tersedVersionTree, open_list):
+        """Adds the versions in open_list and their descendants to the terse
+        graph.
+
+        open_list contains (version, parent, expandable, collapsible) tuples.
+        """
+        # cache actionMap and tagMap because they're properties, sort
+        # of slow
+        am = self.vistrail.actionMap
+        tm = self._terse_tags
+        last_n = self._terse_last_n
+        current_version = self._terse_current
 
         while open_list:
             current, parent, expandable, collapsible = open_list.pop()
 
             # mount children list
-            all_children = [
-                to for to, _ in fullVersionTree.adjacency_list[current]
-                if to in am]
-            children = []
-            while all_children:
-                child = all_children.pop()
-                # Pruned: drop it
-                if self.vistrail.is_pruned(child):
-                    pass
-                # An upgrade: get its children directly
-                # (unless it is tagged, and that tag couldn't be moved)
-                elif (not self.show_upgrades and
-                      (child in upgrades or
-                       am[child].description == 'Upgrade') and
-                      child not in tm):
-                    all_children.extend(
-                        to for to, _ in fullVersionTree.adjacency_list[child]
-                        if to in am)
-                else:
-                    children.append(child)
+            children = self._get_terse_children(current)
 
             display = (self.full_tree or
                        current == 0 or                 # is root
@@ -3041,13 +3099,128 @@ class VistrailController(object):
 
             if collapsible and len(children) > 1:
                 collapsible = False
+            if parentToChildren == current:
+                self._terse_collapsible[current] = collapsible
             for child in children:
                 open_list.append((child, parentToChildren,
                                   expandable, collapsible))
 
-        self._current_terse_graph = tersedVersionTree
-        self._current_full_graph = self.vistrail.tree.getVersionTree()
-        self._upgrade_rev_map = upgrade_rev_map
+    def _update_terse_graph(self):
+        """Updates the terse graph for the changes made to the vistrail.
+
+        Returns False if the graph needs to be computed from scratch instead.
+
+        The changes mark some versions as dirty. The terse graph below the
+        second tersed ancestor of each dirty version is computed again: the
+        first tersed ancestor's children might have changed, but the second
+        one and everything above it are not affected.
+        """
+        graph = self._current_terse_graph
+        if (graph is None or self.vistrail is None or
+                (self.refine and self.search) or
+                self._terse_settings != self._terse_graph_settings()):
+            return False
+        changes = self.vistrail.version_changes
+        first = self.vistrail.version_changes_dropped
+        if not first <= self._terse_changes <= first + len(changes):
+            # some changes were dropped, or this is another vistrail
+            return False
+
+        dirty = set()
+        for what, version, annotation in changes[self._terse_changes - first:]:
+            if what in ('action', 'expand'):
+                dirty.add(version)
+            elif what == 'annotation' or what == 'delete_annotation':
+                if annotation.key == Vistrail.PRUNE_ANNOTATION:
+                    dirty.add(version)
+                elif (annotation.key == Vistrail.UPGRADE_ANNOTATION and
+                        not self.show_upgrades):
+                    if what == 'delete_annotation':
+                        return False
+                    upgrade = int(annotation.value)
+                    self._upgrades.add(upgrade)
+                    self._upgrade_parent_map[upgrade] = version
+                    self._upgrade_rev_map[upgrade] = \
+                        self._upgrade_rev_map.get(version, version)
+                    dirty.add(upgrade)
+            elif what == 'change_annotation' or what == 'delete_action':
+                return False
+        self._terse_changes = first + len(changes)
+
+        # changes to the tags, latest versions and current version
+        tags = self._get_terse_tags()
+        dirty.update(v for v in set(tags) | set(self._terse_tags)
+                     if tags.get(v) != self._terse_tags.get(v))
+        self._terse_tags = tags
+        last_n = set(self.vistrail.getLastActions(
+                self.num_versions_always_shown))
+        dirty.update(last_n ^ self._terse_last_n)
+        self._terse_last_n = last_n
+        current = self._upgrade_rev_map.get(self.current_version,
+                                            self.current_version)
+        if current != self._terse_current:
+            dirty.update((current, self._terse_current))
+            self._terse_current = current
+
+        full = self.vistrail.tree.getVersionTree()
+        anchors = set()
+        for version in dirty:
+            if version not in full.vertices:
+                continue
+            anchor = version
+            for i in xrange(2):
+                anchor = self._get_tersed_ancestor(anchor, graph, full)
+                if anchor is None:
+                    return False
+            anchors.add(anchor)
+        if 0 in anchors:
+            return False
+
+        for anchor in anchors:
+            # Skip anchors below another one
+            v = anchor
+            while v != 0:
+                v = full.parent(v)
+                if v in anchors:
+                    break
+            else:
+                self._rewalk_terse_graph(graph, anchor)
+        return True
+
+    def _get_tersed_ancestor(self, version, graph, full):
+        while version != 0:
+            version = full.parent(version)
+            if version in graph.vertices:
+                return version
+        return None
+
+    def _rewalk_terse_graph(self, graph, anchor):
+        """Recomputes the terse graph below a tersed version.
+        """
+        # Remove the tersed vertices below
+        open_list = [to for to, _ in graph.adjacency_list[anchor]]
+        graph.adjacency_list[anchor] = []
+        while open_list:
+            v = open_list.pop()
+            open_list.extend(to for to, _ in graph.adjacency_list[v])
+            del graph.adjacency_list[v]
+            del graph.inverse_adjacency_list[v]
+            del graph.vertices[v]
+            self._terse_collapsible.pop(v, None)
+
+        # Walk the version tree from there
+        collapsible = self._terse_collapsible[anchor]
+        self._walk_terse_graph(graph,
+                               [(child, anchor, False, collapsible)
+                                for child in self._get_terse_children(anchor)])
+
+    def rename_terse_vertex(self, old_version, new_version):
+        """Replaces a version that isn't displayed in the terse graph by
+        another one, when moving the current version along a branch.
+        """
+        self._current_terse_graph.rename_vertex(old_version, new_version)
+        # Next update can't be incremental
+        self._terse_settings = None
 
     def save_version_graph(self, filename, tersed=True, highlight=None):
         if tersed:
@@ -4398,6 +4571,120 @@ class TestTerseGraph(unittest.TestCase):
         vistrail = locator.load()
         return VistrailController(vistrail, locator)
 
+    def test_incremental(self):
+        """Updates the tersed version tree as the vistrail changes"""
+        import random
+        rng = random.Random(4)
+        vistrail = Vistrail()
+        def add_version(parent, upgrade=False):
+            action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+            vistrail.add_action(action, parent)
+            if upgrade:
+                vistrail.set_upgrade(parent, str(action.id))
+        for i in xrange(100):
+            add_version(rng.choice([0] + vistrail.actionMap.keys()))
+        controller = VistrailController(vistrail, None, auto_save=False)
+
+        for show_upgrades in (False, True):
+            controller.recompute_terse_graph(show_upgrades)
+            for i in xrange(150):
+                version = rng.choice(vistrail.actionMap.keys())
+                change = rng.randrange(6)
+                if change == 0:
+                    add_version(rng.choice([version,
+                                            max(vistrail.actionMap)]))
+                elif change == 1:
+                    vistrail.set_tag(version, 'tag %d' % i)
+                elif change == 2:
+                    vistrail.set_prune(version, str(rng.random() < 0.3))
+                elif change == 3:
+                    vistrail.expandVersion(version)
+                elif change == 4:
+                    controller.current_version = version
+                elif not vistrail.has_upgrade(version):
+                    add_version(version, True)
+                controller.recompute_terse_graph(show_upgrades)
+                graph = controller._current_terse_graph
+                incremental = (dict(graph.vertices),
+                               dict((v, list(e)) for v, e in
+                                    graph.adjacency_list.iteritems()))
+                controller._build_terse_graph()
+                graph = controller._current_terse_graph
+                self.assertEqual(incremental,
+                                 (graph.vertices, graph.adjacency_list))
+
+    def test_dropped_changes(self):
+        """Rebuilds the tersed version tree when changes were dropped"""
+        vistrail = Vistrail()
+        vistrail.MAX_VERSION_CHANGES = 10
+        def add_version(parent):
+            action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+            vistrail.add_action(action, parent)
+            return action.id
+        controller = VistrailController(vistrail, None, auto_save=False)
+        def check_graph():
+            controller.recompute_terse_graph(False)
+            graph = controller._current_terse_graph
+            incremental = (dict(graph.vertices),
+                           dict((v, list(e)) for v, e in
+                                graph.adjacency_list.iteritems()))
+            controller._build_terse_graph()
+            graph = controller._current_terse_graph
+            self.assertEqual(incremental,
+                             (graph.vertices, graph.adjacency_list))
+
+        version = 0
+        for i in xrange(8):
+            version = add_version(version if i % 3 else 0)
+        check_graph()
+        for i in xrange(30):
+            version = add_version(version if i % 4 else 0)
+        self.assertLessEqual(len(vistrail.version_changes), 10)
+        self.assertGreater(vistrail.version_changes_dropped, 0)
+        self.assertFalse(controller._update_terse_graph())
+        check_graph()
+        self.assertEqual(controller._terse_changes,
+                         vistrail.version_changes_dropped +
+                         len(vistrail.version_changes))
+        add_version(version)
+        check_graph()
+
+    def test_refine(self):
+        """Rebuilds the tersed version tree when refining changes"""
+        import random
+        rng = random.Random(2)
+        class TagSearch(object):
+            def match(self, vistrail, action):
+                return vistrail.get_tag(action.id) == 'tag 14'
+
+        vistrail = Vistrail()
+        for i in xrange(60):
+            action = Action(id=vistrail.idScope.getNewId(Action.vtType))
+            vistrail.add_action(action,
+                                rng.choice([0] + vistrail.actionMap.keys()))
+            if i % 7 == 0:
+                vistrail.set_tag(action.id, 'tag %d' % i)
+        controller = VistrailController(vistrail, None, auto_save=False)
+        controller.recompute_terse_graph(False)
+        full = dict(controller._current_terse_graph.vertices)
+
+        controller.search = TagSearch()
+        controller.refine = True
+        controller.recompute_terse_graph(False)
+        self.assertLess(len(controller._current_terse_graph.vertices),
+                        len(full))
+
+        for undo in ('refine', 'search'):
+            if undo == 'refine':
+                controller.refine = False
+            else:
+                controller.refine = True
+                controller.recompute_terse_graph(False)
+                controller.search = None
+            controller.recompute_terse_graph(False)
+            self.assertEqual(dict(controller._current_terse_graph.vertices),
+                             full)
+
     def test_workflow1_upgrades(self):
         """Computes the tersed version tree, with upgrades"""
         controller = self.get_workflow('upgrades1.xml')
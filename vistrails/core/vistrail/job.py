@@ -48,7 +48,11 @@ from uuid import uuid1
 
 import datetime
 import getpass
+import heapq
+import itertools
 import json
+import Queue
+import threading
 import time
 import unittest
 import weakref
@@ -342,6 +346,177 @@ class Job(object):
         return True
 
 
+def is_job_done(handle):
+    """ is_job_done(handle: JobHandle) -> bool
+
+        A job is done when it reaches finished or failed state
+        val() is used by stable batchq branch
+    """
+    finished = handle.finished()
+    if hasattr(finished, 'val'):
+        finished = finished.val()
+    if finished:
+        return True
+
+    # FIXME : deprecate this, remove from RemoteQ
+    # finished should just return True here too
+    if hasattr(handle, 'failed'):
+        failed = handle.failed()
+        if hasattr(failed, 'val'):
+            failed = failed.val()
+        if failed:
+            return True
+    return False
+
+
+class PolledJob(object):
+    """ A job handle watched by a JobPoller.
+    """
+    def __init__(self, handle, interval):
+        self.handle = handle
+        self.interval = interval
+        self.done = False
+        self.callbacks = []
+
+
+class JobPoller(object):
+    """ Checks the status of many job handles in the background.
+
+    Handles are checked by a pool of worker threads, so that a slow status
+    query (e.g. over SSH) doesn't hold back the other jobs. A job is checked
+    again after an interval that grows from `interval` up to `max_interval`
+    while it keeps running.
+
+    If the class of a handle has a `finished_batch(handles)` class method,
+    returning a list of booleans, the handles of that class that are due are
+    checked together with a single call.
+    """
+
+    def __init__(self, interval=1.0, max_interval=600.0, backoff=1.5,
+                 workers=4):
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.backoff = backoff
+        self._condition = threading.Condition()
+        self._jobs = {}  # id(handle) -> PolledJob
+        self._schedule = []  # heap of (time, counter, PolledJob)
+        self._counter = itertools.count()
+        self._tasks = Queue.Queue()
+        self._running = True
+
+        self._threads = [threading.Thread(target=self._schedule_loop)]
+        self._threads.extend(threading.Thread(target=self._worker_loop)
+                             for i in xrange(workers))
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def watch(self, handle, callback=None):
+        """ watch(handle: JobHandle, callback: callable) -> PolledJob
+
+            Starts monitoring a job. callback(handle) is called from a worker
+            thread once the job is done.
+        """
+        with self._condition:
+            job = self._jobs.get(id(handle))
+            if job is None:
+                job = self._jobs[id(handle)] = PolledJob(handle, self.interval)
+                heapq.heappush(self._schedule,
+                               (time.time(), next(self._counter), job))
+                self._condition.notify_all()
+            if callback is not None:
+                job.callbacks.append(callback)
+        return job
+
+    def wait(self, jobs, timeout=None):
+        """ wait(jobs: list of PolledJob, timeout: float) -> bool
+
+            Blocks until all the given jobs are done, or the timeout expires.
+            Returns whether all the jobs are done.
+        """
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._condition:
+            while not all(job.done for job in jobs):
+                if timeout is None:
+                    # A wait without timeout can't be interrupted by Ctrl+C
+                    self._condition.wait(1.0)
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(min(remaining, 1.0))
+        return True
+
+    def stop(self):
+        """ stop() -> None
+
+            Stops the background threads. Pending jobs are not checked anymore.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for i in xrange(len(self._threads) - 1):
+            self._tasks.put(None)
+
+    def _schedule_loop(self):
+        with self._condition:
+            while self._running:
+                now = time.time()
+                due = []
+                while self._schedule and self._schedule[0][0] <= now:
+                    due.append(heapq.heappop(self._schedule)[2])
+                batches = {}
+                for job in due:
+                    batch = getattr(type(job.handle), 'finished_batch', None)
+                    if batch is not None:
+                        batches.setdefault(batch, []).append(job)
+                    else:
+                        self._tasks.put((None, [job]))
+                for batch, jobs in batches.iteritems():
+                    self._tasks.put((batch, jobs))
+                if self._schedule:
+                    self._condition.wait(self._schedule[0][0] - now)
+                else:
+                    self._condition.wait()
+
+    def _worker_loop(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            batch, jobs = task
+            try:
+                if batch is not None:
+                    results = batch([job.handle for job in jobs])
+                else:
+                    results = [is_job_done(jobs[0].handle)]
+            except Exception, e:
+                debug.warning("Error checking job status", e)
+                results = [False] * len(jobs)
+            callbacks = []
+            with self._condition:
+                now = time.time()
+                for job, done in itertools.izip(jobs, results):
+                    if done:
+                        job.done = True
+                        del self._jobs[id(job.handle)]
+                        callbacks.extend((cb, job.handle)
+                                         for cb in job.callbacks)
+                    else:
+                        job.interval = min(job.interval * self.backoff,
+                                           self.max_interval)
+                        heapq.heappush(self._schedule,
+                                       (now + job.interval,
+                                        next(self._counter), job))
+                self._condition.notify_all()
+            for callback, handle in callbacks:
+                try:
+                    callback(handle)
+                except Exception, e:
+                    debug.unexpected_exception(e)
+
+
 class JobMonitor(object):
     """ Keeps a list of running jobs and the current job for a vistrail.
 
@@ -354,6 +529,9 @@ class JobMonitor(object):
         self.workflows = {}
         self.jobs = {}
         self.callback = None
+        self.poller = None
+        # jobs of the current workflow watched by the poller
+        self._polled = []
         if json_string is not None:
             self.unserialize(json_string)
 
@@ -364,6 +542,48 @@ class JobMonitor(object):
         """
         self.callback = weakref.ref(callback)
 
+    def enablePolling(self, poller=None):
+        """ enablePolling(poller: JobPoller) -> None
+            Monitors jobs in the background instead of blocking in checkJob()
+
+            Suspended modules don't wait for their job anymore, so that all
+            the jobs of a workflow get submitted; waitForJobs() then waits for
+            all of them at once.
+        """
+        if poller is None:
+            conf = get_vistrails_configuration()
+            poller = JobPoller(interval=min(1.0, conf.jobCheckInterval),
+                               max_interval=conf.jobCheckInterval)
+        self.poller = poller
+
+    def disablePolling(self):
+        """ disablePolling() -> None
+            Stops monitoring jobs in the background
+
+        """
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+        self._polled = []
+
+    def waitForJobs(self, timeout=None):
+        """ waitForJobs(timeout: float) -> bool
+            Waits for the jobs the current workflow got suspended on
+
+            Returns True once they are all done, meaning that the workflow can
+            be resumed, False if there was nothing to wait for or if the wait
+            was interrupted.
+        """
+        if self.poller is None or not self._polled:
+            return False
+        debug.log("Waiting for %d job(s), press Ctrl+C to suspend" %
+                  len(self._polled))
+        try:
+            return self.poller.wait(self._polled, timeout)
+        except KeyboardInterrupt:
+            debug.warning("Interrupted by user, jobs are still running")
+            return False
+
     ###########################################################################
     # Running Workflows
 
@@ -472,6 +692,7 @@ class JobMonitor(object):
                             self._current_workflow.id)
         workflow.reset()
         self._current_workflow = workflow
+        self._polled = []
         if self.callback is not None and self.callback() is not None:
             self.callback().startWorkflow(workflow)
 
@@ -559,6 +780,8 @@ class JobMonitor(object):
         if not workflow:
             return  # ignore non-monitored jobs
         workflow.parents[id(error)] = error
+        if self.poller is not None and error.handle is not None:
+            self._polled.append(self.poller.watch(error.handle))
 
     def setCache(self, id, params, name=''):
         self.addJob(id, params, name, True)
@@ -583,7 +806,7 @@ class JobMonitor(object):
 
         conf = get_vistrails_configuration()
         interval = conf.jobCheckInterval
-        if interval and not conf.jobAutorun:
+        if interval and not conf.jobAutorun and self.poller is None:
             if handle:
                 # wait for module to complete
                 try:
@@ -629,23 +852,8 @@ class JobMonitor(object):
         """ isDone(self, monitor) -> bool
 
             A job is done when it reaches finished or failed state
-            val() is used by stable batchq branch
         """
-        finished = handle.finished()
-        if hasattr(finished, 'val'):
-            finished = finished.val()
-        if finished:
-            return True
-
-        # FIXME : deprecate this, remove from RemoteQ
-        # finished should just return True here too
-        if hasattr(handle, 'failed'):
-            failed = handle.failed()
-            if hasattr(failed, 'val'):
-                failed = failed.val()
-            if failed:
-                return True
-        return False
+        return is_job_done(handle)
 
 
 ###############################################################################
@@ -688,3 +896,63 @@ class TestJob(unittest.TestCase):
         self.assertIn(workflow2.id, jm.workflows)
         self.assertEqual(workflow1, jm.workflows[workflow1.id])
         self.assertEqual(workflow2, jm.workflows[workflow2.id])
+
+    def test_poller(self):
+        class Handle(object):
+            def __init__(self, checks):
+                self.checks = checks
+            def finished(self):
+                self.checks -= 1
+                return self.checks <= 0
+
+        class BatchHandle(Handle):
+            batches = []
+            @classmethod
+            def finished_batch(cls, handles):
+                cls.batches.append(len(handles))
+                return [h.finished() for h in handles]
+
+        poller = JobPoller(interval=0.01, max_interval=0.05)
+        try:
+            done = []
+            jobs = [poller.watch(Handle(i % 3), done.append)
+                    for i in xrange(10)]
+            jobs.extend(poller.watch(BatchHandle(2)) for i in xrange(10))
+            self.assertTrue(poller.wait(jobs, 5))
+            self.assertEqual(len(done), 10)
+            # due handles that support it are checked together
+            self.assertEqual(sum(BatchHandle.batches), 20)
+            self.assertLess(len(BatchHandle.batches), 20)
+
+            self.assertFalse(poller.wait([poller.watch(Handle(1000))], 0.1))
+        finally:
+            poller.stop()
+
+    def test_wait_for_jobs(self):
+        class Handle(object):
+            def __init__(self):
+                self.done = False
+            def finished(self):
+                return self.done
+
+        class FakeModule(object):
+            pass
+
+        jm = JobMonitor()
+        jm.enablePolling(JobPoller(interval=0.01, max_interval=0.01))
+        try:
+            self.assertFalse(jm.waitForJobs())
+            jm.startWorkflow(Workflow(1))
+            handles = [Handle() for i in xrange(3)]
+            for i, handle in enumerate(handles):
+                module = FakeModule()
+                module.signature = 'job%d' % i
+                jm.addParent(ModuleSuspended(module, 'Job is running',
+                                             handle=handle))
+            self.assertFalse(jm.waitForJobs(0.1))
+            for handle in handles:
+                handle.done = True
+            self.assertTrue(jm.waitForJobs(5))
+            jm.finishWorkflow()
+        finally:
+            jm.disablePolling()
@@ -54,6 +54,7 @@ from vistrails.db.domain import DBWorkflow
 from vistrails.core.utils import InvalidPipeline
 
 import copy
+import itertools
 
 import unittest
 from vistrails.core.vistrail.abstraction import Abstraction
@@ -110,8 +111,47 @@ class CycleInPipeline(Exception):
     def __str__(self):
         return "Pipeline contains a cycle"
 
+def _shallow_copy(obj):
+    """ _shallow_copy(obj: DBObject) -> DBObject
+    Returns a copy of obj that has its own lists, dicts and sets, but shares
+    the objects they contain with obj
+
+    """
+    cp = obj.__class__.__new__(obj.__class__)
+    d = cp.__dict__
+    d.update(obj.__dict__)
+    for name, value in d.items():
+        t = type(value)
+        if t is list or t is dict or t is set:
+            d[name] = t(value)
+    return cp
+
+def _replace_children(parent, replacements):
+    """ _replace_children(parent: DBObject, replacements: dict) -> None
+    Replaces child objects everywhere parent refers to them, replacements
+    mapping the id() of each old child to the new one
+
+    """
+    d = parent.__dict__
+    for name, value in d.items():
+        if id(value) in replacements:
+            d[name] = replacements[id(value)]
+        elif type(value) is list:
+            for i, v in enumerate(value):
+                if id(v) in replacements:
+                    value[i] = replacements[id(v)]
+        elif type(value) is dict:
+            for k, v in value.items():
+                if id(v) in replacements:
+                    value[k] = replacements[id(v)]
+
 class Pipeline(DBWorkflow):
     """ A Pipeline is a set of modules and connections between them. """
+
+    # keys of the nested objects (functions, parameters, ports, ...) that
+    # belong to this pipeline only, if it was created by shared_copy();
+    # None otherwise
+    _owned = None
     
     def __init__(self, *args, **kwargs):
         """ __init__() -> Pipelines
@@ -128,6 +168,7 @@ class Pipeline(DBWorkflow):
         self.set_defaults()
 
     def set_defaults(self, other=None):
+        self._owned = None
         if other is None:
             self.is_valid = False
             self.aliases = Bidict()
@@ -191,6 +232,136 @@ class Pipeline(DBWorkflow):
         cp.set_defaults(self)
         return cp
 
+    def shared_copy(self):
+        """ shared_copy() -> Pipeline
+        Returns a copy of the pipeline that shares the contents of its
+        modules and connections (functions, parameters, ports, ...) with
+        this one. Shared objects are copied by the new pipeline the first
+        time they are changed through its operations (perform_action(),
+        add_*, change_*, delete_*, db_get_object()), so only the parts that
+        change are duplicated.
+
+        This pipeline is not affected, but it must not be changed while the
+        copy is in use, since the copy would see the changes: only use this
+        on pipelines that are not shared with the rest of the application,
+        or copies that are thrown away before the pipeline changes.
+
+        Modules and connections themselves are copied, but their contents
+        should not be modified directly. Groups and abstractions are fully
+        copied.
+
+        """
+        cp = _shallow_copy(self)
+        cp.tmp_id = copy.copy(self.tmp_id)
+        cp.graph = copy.copy(self.graph)
+        cp.aliases = Bidict(self.aliases)
+        cp._subpipeline_signatures = Bidict(self._subpipeline_signatures)
+        cp._module_signatures = Bidict(self._module_signatures)
+        cp._connection_signatures = Bidict(self._connection_signatures)
+        cp._owned = set()
+
+        objects = cp.objects
+        replacements = {}
+        for module in self.db_modules:
+            if module.vtType == Module.vtType:
+                new_module = _shallow_copy(module)
+            else:
+                new_module = copy.copy(module)
+                for (obj, _, _) in new_module.db_children():
+                    key = (self._vtTypeMap.get(obj.vtType, obj.vtType),
+                           obj.db_id)
+                    objects[key] = obj
+                    cp._owned.add(key)
+            replacements[id(module)] = new_module
+            objects[(Module.vtType, module.id)] = new_module
+        for connection in self.db_connections:
+            new_connection = _shallow_copy(connection)
+            replacements[id(connection)] = new_connection
+            objects[(Connection.vtType, connection.id)] = new_connection
+        _replace_children(cp, replacements)
+        return cp
+
+    def _find_parent(self, obj):
+        """ _find_parent(obj: DBObject) -> DBObject
+        Returns the object that contains obj in this pipeline
+
+        """
+        index = 'db_%ss_id_index' % obj.vtType
+        attr = '_db_%s' % obj.vtType
+        def is_parent(candidate):
+            d = candidate.__dict__
+            return d.get(index, {}).get(obj.db_id) is obj or \
+                d.get(attr) is obj
+        for candidate in itertools.chain([self], self.db_modules,
+                                         self.db_connections):
+            if is_parent(candidate):
+                return candidate
+        for module in self.db_modules:
+            for candidate in itertools.chain(module.db_functions,
+                                             module.db_portSpecs):
+                if is_parent(candidate):
+                    return candidate
+        raise VistrailsInternalError("%s %s not found in pipeline" %
+                                     (obj.vtType, obj.db_id))
+
+    def _own_object(self, obj_type, obj_id):
+        """ _own_object(obj_type: str, obj_id: long) -> DBObject
+        Returns the object with the given type and id, first copying it if
+        it is shared with another pipeline (see shared_copy()), or None
+
+        """
+        obj_type = self._vtTypeMap.get(obj_type, obj_type)
+        key = (obj_type, obj_id)
+        obj = self.objects.get(key)
+        if (obj is None or self._owned is None or key in self._owned or
+                obj_type == Module.vtType or obj_type == Connection.vtType):
+            return obj
+        parent = self._find_parent(obj)
+        if parent is not self:
+            parent = self._own_object(parent.vtType, parent.db_id)
+        new_obj = _shallow_copy(obj)
+        _replace_children(parent, {id(obj): new_obj})
+        self.objects[key] = new_obj
+        self._owned.add(key)
+        return new_obj
+
+    def db_get_object(self, type, id):
+        if self._owned is None:
+            return DBWorkflow.db_get_object(self, type, id)
+        # the caller might change it
+        obj = self._own_object(type, id)
+        if obj is None:
+            raise KeyError((type, id))
+        return obj
+
+    def db_add_object(self, object, parent_obj_type=None,
+                      parent_obj_id=None, parent_obj=None):
+        if self._owned is not None:
+            if parent_obj is None and parent_obj_type is not None and \
+                    parent_obj_id is not None:
+                parent_obj = self._own_object(parent_obj_type, parent_obj_id)
+            self._owned.add((self._vtTypeMap.get(object.vtType,
+                                                 object.vtType),
+                             object.getPrimaryKey()))
+        DBWorkflow.db_add_object(self, object, parent_obj_type,
+                                 parent_obj_id, parent_obj)
+
+    def db_change_object(self, old_id, object, parent_obj_type=None,
+                         parent_obj_id=None, parent_obj=None):
+        if self._owned is not None and parent_obj is None and \
+                parent_obj_type is not None and parent_obj_id is not None:
+            parent_obj = self._own_object(parent_obj_type, parent_obj_id)
+        DBWorkflow.db_change_object(self, old_id, object, parent_obj_type,
+                                    parent_obj_id, parent_obj)
+
+    def db_delete_object(self, obj_id, obj_type, parent_obj_type=None,
+                         parent_obj_id=None, parent_obj=None):
+        if self._owned is not None and parent_obj is None and \
+                parent_obj_type is not None and parent_obj_id is not None:
+            parent_obj = self._own_object(parent_obj_type, parent_obj_id)
+        DBWorkflow.db_delete_object(self, obj_id, obj_type, parent_obj_type,
+                                    parent_obj_id, parent_obj)
+
     @staticmethod
     def convert(_workflow):
         if _workflow.__class__ == Pipeline:
@@ -1494,6 +1665,73 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(p1, p3)
         self.assertNotEquals(p1.id, p3.id)
 
+    def test_shared_copy(self):
+        """A shared copy only duplicates what changes"""
+        from vistrails.core.db.action import create_action
+        from vistrails.core.vistrail.controller import VistrailController
+        basic_pkg = get_vistrails_basic_pkg_id()
+        create_module = VistrailController.create_module_static
+        create_function = VistrailController.create_function_static
+        id_scope = IdScope()
+        m1 = create_module(id_scope, basic_pkg, 'String')
+        m1.add_function(create_function(id_scope, m1, 'value', ['a']))
+        m2 = create_module(id_scope, basic_pkg, 'String')
+        m2.add_function(create_function(id_scope, m2, 'value', ['b']))
+        m3 = create_module(id_scope, basic_pkg, 'ConcatenateString')
+        c1 = VistrailController.create_connection_static(id_scope, m1, 'value',
+                                                         m3, 'str1')
+        c2 = VistrailController.create_connection_static(id_scope, m2, 'value',
+                                                         m3, 'str2')
+        p1 = Pipeline()
+        p1.perform_action(create_action([('add', m1), ('add', m2),
+                                         ('add', m3), ('add', c1),
+                                         ('add', c2)]))
+        full = copy.copy(p1)
+        p2 = p1.shared_copy()
+        self.assertEqual(p1, p2)
+        self.assertIsNot(p1.modules[m1.id], p2.modules[m1.id])
+        self.assertIs(p1.modules[m1.id].functions[0],
+                      p2.modules[m1.id].functions[0])
+
+        # change a parameter in the copy
+        function = p2.modules[m1.id].functions[0]
+        old_param = function.params[0]
+        new_param = copy.copy(old_param)
+        new_param.real_id = id_scope.getNewId(ModuleParam.vtType)
+        new_param.strValue = 'c'
+        p2.perform_action(create_action([('change', old_param, new_param,
+                                          ModuleFunction.vtType,
+                                          function.real_id)]))
+        self.assertEqual(p2.modules[m1.id].functions[0].params[0].strValue,
+                         'c')
+        self.assertEqual(p1.modules[m1.id].functions[0].params[0].strValue,
+                         'a')
+        self.assertIs(p1.modules[m2.id].functions[0],
+                      p2.modules[m2.id].functions[0])
+        self.assertEqual(p1, full)
+
+        # the original doesn't track the objects it shares
+        self.assertIsNone(p1._owned)
+        param_id = p1.modules[m2.id].functions[0].params[0].real_id
+        self.assertIs(p1.db_get_object(ModuleParam.vtType, param_id),
+                      p2.modules[m2.id].functions[0].params[0])
+
+        # deleting in the copy
+        p2.delete_module(m2.id)
+        self.assertEqual(p1.module_count(), 3)
+        self.assertEqual(p1.connection_count(), 2)
+        self.assertEqual(p2.module_count(), 2)
+        self.assertEqual(p2.connection_count(), 1)
+        self.assertEqual(p1.modules[m3.id].connected_input_ports,
+                         {'str1': 1, 'str2': 1})
+
+        # copies of copies
+        p3 = p2.shared_copy()
+        p3.delete_connection(c1.id)
+        self.assertEqual(p2.connection_count(), 1)
+        self.assertEqual(p3.connection_count(), 0)
+        self.assertEqual(copy.copy(p2), p2)
+
     def test_serialization(self):
         import vistrails.core.db.io
         p1 = self.create_default_pipeline()
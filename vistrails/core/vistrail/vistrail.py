@@ -40,6 +40,7 @@ from vistrails.core.paramexplore.paramexplore import ParameterExploration
 import copy
 import datetime
 import getpass
+import heapq
 
 from vistrails.db.domain import DBVistrail
 from vistrails.db.services.io import open_vt_log_from_db, open_log_from_xml
@@ -121,6 +122,15 @@ class Vistrail(DBVistrail):
             self.is_abstraction = other.is_abstraction
             self.locator = other.locator
 
+        # changes that affect the version tree, as (what, version, extra)
+        # tuples, so that views of the tree can be updated incrementally
+        # (see VistrailController.recompute_terse_graph())
+        # Only the last changes are kept; version_changes_dropped counts the
+        # ones that were dropped, the views that hadn't seen them are
+        # rebuilt from scratch
+        self.version_changes = []
+        self.version_changes_dropped = 0
+
         # object to keep explicit expanded 
         # version tree always updated
         self.tree = ExplicitExpandedVersionTree(self)
@@ -175,6 +185,42 @@ class Vistrail(DBVistrail):
     def _get_actionMap(self):
         return self.db_actions_id_index
     actionMap = property(_get_actionMap)
+
+    # number of changes kept in version_changes
+    MAX_VERSION_CHANGES = 1000
+
+    def _version_changed(self, what, version, extra=None):
+        # Objects are added by the db layer before set_defaults() is called
+        changes = getattr(self, 'version_changes', None)
+        if changes is not None:
+            changes.append((what, version, extra))
+            if len(changes) > self.MAX_VERSION_CHANGES:
+                drop = len(changes) // 2
+                del changes[:drop]
+                self.version_changes_dropped += drop
+
+    def db_add_action(self, action):
+        DBVistrail.db_add_action(self, action)
+        self._version_changed('action', action.db_id)
+
+    def db_delete_action(self, action):
+        DBVistrail.db_delete_action(self, action)
+        self._version_changed('delete_action', action.db_id)
+
+    def db_add_actionAnnotation(self, annotation):
+        DBVistrail.db_add_actionAnnotation(self, annotation)
+        self._version_changed('annotation', annotation.db_action_id,
+                              annotation)
+
+    def db_change_actionAnnotation(self, annotation):
+        DBVistrail.db_change_actionAnnotation(self, annotation)
+        self._version_changed('change_annotation', annotation.db_action_id,
+                              annotation)
+
+    def db_delete_actionAnnotation(self, annotation):
+        DBVistrail.db_delete_actionAnnotation(self, annotation)
+        self._version_changed('delete_annotation', annotation.db_action_id,
+                              annotation)
     
     def get_annotation(self, key):
         if self.db_has_annotation_with_key(key):
@@ -518,8 +564,7 @@ class Vistrail(DBVistrail):
         if num_actions < n:
             n = num_actions
         if n > 0:
-            sorted_keys = sorted(self.actionMap.keys())
-            last_n = sorted_keys[num_actions-n:num_actions-1]
+            last_n = sorted(heapq.nlargest(n, self.actionMap))[:-1]
         return last_n
 
     def hasVersion(self, version):
@@ -998,6 +1043,7 @@ class Vistrail(DBVistrail):
         """
         if version!=0: # not root
             self.actionMap[version].expand = 1
+            self._version_changed('expand', version)
 
     def collapseVersion(self, version):
         """ collapseVersion(version: int) -> None
@@ -1006,6 +1052,7 @@ class Vistrail(DBVistrail):
         """
         if version!=0:
             self.actionMap[version].expand = 0
+            self._version_changed('expand', version)
 
     def setSavedQueries(self, savedQueries):
         """ setSavedQueries(savedQueries: list of (str, str, str)) -> None
@@ -1353,12 +1353,15 @@ def save_opm_to_xml(opm_graph, filename, version=None):
         version = currentVersion
     daoList = getVersionDAO(version)
     tags = {'xmlns': 'http://openprovenance.org/model/v1.01.a',
+            'version': version,
             }
-    opm_graph = vistrails.db.services.opm.create_opm(opm_graph.workflow, 
-                                           opm_graph.version,
-                                           opm_graph.log,
-                                           opm_graph.registry)
-    daoList.save_to_xml(opm_graph, filename, tags, version)
+    # the records are written as they are created, so that large logs
+    # do not have to fit in memory
+    vistrails.db.services.opm.write_opm(opm_graph.workflow,
+                                        opm_graph.version,
+                                        opm_graph.log,
+                                        opm_graph.registry,
+                                        filename, daoList, tags)
     return opm_graph
 
 ##############################################################################
@@ -1373,11 +1376,14 @@ def save_prov_to_xml(prov_document, filename, version=None):
     tags = {'xmlns:prov': 'http://www.w3.org/ns/prov#',
             'xmlns:dcterms': 'http://purl.org/dc/terms/',
             'xmlns:vt': 'http://www.vistrails.org/registry.xsd',
+            'version': version,
             }
-    prov_document = vistrails.db.services.prov.create_prov(prov_document.workflow, 
-                                                 prov_document.version,
-                                                 prov_document.log)
-    daoList.save_to_xml(prov_document, filename, tags, version)
+    # the records are written as they are created, so that large logs
+    # do not have to fit in memory
+    vistrails.db.services.prov.write_prov(prov_document.workflow,
+                                          prov_document.version,
+                                          prov_document.log,
+                                          filename, daoList, tags)
     return prov_document
 
 ##############################################################################
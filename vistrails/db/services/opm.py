@@ -49,6 +49,8 @@ from vistrails.db.domain import DBOpmProcess, DBOpmArtifact, DBOpmUsed, \
     DBConnection, DBGroup, DBPortSpec, DBOpmWasTriggeredBy, DBFunction, \
     DBParameter
 from vistrails.db.services.vistrail import materializeWorkflow
+from vistrails.db.services.xml_stream import ElementTree, XMLSpool, \
+    XMLStreamWriter, replace_element
 
 def create_process(item_exec, account, id_scope):
     return DBOpmProcess(id='p' + str(id_scope.getNewId(DBOpmProcess.vtType)),
@@ -128,12 +130,180 @@ def create_account(depth, id_scope):
                            value=str(depth))
     return account
 
+def is_group_process(process):
+    """is_group_process(process: DBOpmProcess) -> bool
+    Tells whether process stands for a group or a looping module, whose
+    inner processes are in a finer account
+
+    """
+    item_exec = process.db_value.db_value
+    if item_exec.vtType == DBGroupExec.vtType:
+        return True
+    return (item_exec.vtType == DBModuleExec.vtType and
+            len(item_exec.db_loop_execs) > 0)
+
+def is_group_dependency(dependency, group_ids):
+    """is_group_dependency(dependency: DBOpmDependency,
+                           group_ids: set) -> bool
+    Tells whether dependency links artifacts to one of the processes
+    in group_ids
+
+    """
+    return ((dependency.vtType == DBOpmWasGeneratedBy.vtType and
+             dependency.db_cause.db_id in group_ids) or
+            (dependency.vtType == DBOpmUsed.vtType and
+             dependency.db_effect.db_id in group_ids))
+
+def create_overlaps(max_depth):
+    overlaps = []
+    for i in xrange(max_depth+1):
+        for j in xrange(i+1, max_depth+1):
+            ids = [DBOpmAccountId(id='acct' + str(i)),
+                   DBOpmAccountId(id='acct' + str(j))]
+            overlaps.append(DBOpmOverlaps(opm_account_ids=ids))
+    return overlaps
+
 def create_opm(workflow, version, log, reg):
-    id_scope = IdScope()
     processes = []
-    # conn_artifacts = {}
     artifacts = []
     dependencies = []
+    records = {'processes': processes,
+               'artifacts': artifacts,
+               'dependencies': dependencies}
+    def add_record(section, obj, shared=False):
+        records[section].append(obj)
+    def release_records(section, objs):
+        pass
+    accounts = walk_opm(workflow, version, log, reg, add_record,
+                        release_records)
+
+    #print processes
+    #print dependencies
+    max_depth = max(int(account.db_value) for account in accounts)
+    def add_finer_depths(objs, exclude_groups=False, exclude_deps=False, 
+                         p_ids=set()):
+        new_p_ids = []
+        for obj in objs:
+            can_update=True
+            if exclude_groups:
+                if is_group_process(obj):
+                    new_p_ids.append(obj.db_id)
+                    can_update = False
+                
+            if exclude_deps:
+                if is_group_dependency(obj, p_ids):
+                    can_update = False
+            if can_update:
+                min_depth = int(obj.db_accounts[0].db_id[4:])
+                for i in xrange(min_depth+1, max_depth+1):
+                    obj.db_add_account(DBOpmAccountId(id='acct' + str(i)))
+        return new_p_ids
+
+    # FIXME: also exclude group dependencies (used, wasGeneratedBy)...
+    p_ids = add_finer_depths(processes, True)
+    print p_ids
+    add_finer_depths(artifacts)
+    add_finer_depths(dependencies, False, True, set(p_ids))
+
+    overlaps = create_overlaps(max_depth)
+    opm_graph = DBOpmGraph(accounts=DBOpmAccounts(accounts=accounts,
+                                                  opm_overlapss=overlaps),
+                           processes=DBOpmProcesses(processs=processes),
+                           artifacts=\
+                               DBOpmArtifacts(artifacts=artifacts),
+                           dependencies=\
+                               DBOpmDependencies(dependencys=dependencies),
+                           )
+    return opm_graph
+
+# stands for the accounts finer than that of a record, which are only
+# known once all of them have been written
+FINER_ACCOUNTS = 'acct*'
+
+def write_opm(workflow, version, log, reg, filename, dao_list, tags):
+    """write_opm(workflow: DBWorkflow, version: int, log: DBLog,
+                 reg: DBRegistry, filename: str, dao_list: DAOList,
+                 tags: dict) -> None
+    Writes the OPM graph to filename as its records are created, instead
+    of building it in memory first. Artifacts for files, tables and
+    functions are held until no later execution can change them. tags
+    are set on the root element.
+
+    """
+    # section -> (container class, attribute holding the records)
+    sections = [('processes', DBOpmProcesses, 'processs'),
+                ('artifacts', DBOpmArtifacts, 'artifacts'),
+                ('dependencies', DBOpmDependencies, 'dependencys')]
+    containers = dict((section, (klass, attr))
+                      for section, klass, attr in sections)
+    spools = dict((section, XMLSpool(dao_list, 2))
+                  for section, klass, attr in sections)
+    group_ids = set()
+    try:
+        def write_record(section, obj):
+            if section == 'processes':
+                can_update = not is_group_process(obj)
+                if not can_update:
+                    group_ids.add(obj.db_id)
+            elif section == 'dependencies':
+                can_update = not is_group_dependency(obj, group_ids)
+            else:
+                can_update = True
+            min_depth = None
+            if can_update:
+                min_depth = int(obj.db_accounts[0].db_id[4:])
+                obj.db_add_account(DBOpmAccountId(id=FINER_ACCOUNTS))
+            klass, attr = containers[section]
+            spools[section].add(klass(**{attr: [obj]}), min_depth)
+        def add_record(section, obj, shared=False):
+            if not shared:
+                write_record(section, obj)
+        def release_records(section, objs):
+            for obj in objs:
+                write_record(section, obj)
+        accounts = walk_opm(workflow, version, log, reg, add_record,
+                            release_records)
+
+        max_depth = max(int(account.db_value) for account in accounts)
+        def account_xml(account_id):
+            return ElementTree.tostring(dao_list.write_xml_object(
+                    DBOpmAccountId(id=account_id)))
+        finer_marker = account_xml(FINER_ACCOUNTS)
+        finer_accounts = [account_xml('acct' + str(i))
+                          for i in xrange(max_depth+1)]
+        def add_finer_depths(text, min_depth):
+            if min_depth is None:
+                return text
+            return replace_element(text, finer_marker,
+                                   finer_accounts[min_depth+1:])
+
+        root = dao_list.write_xml_object(DBOpmGraph())
+        for k, v in tags.iteritems():
+            root.set(k, v)
+        writer = XMLStreamWriter(filename, root)
+        overlaps = create_overlaps(max_depth)
+        writer.write_element(dao_list.write_xml_object(
+                DBOpmAccounts(accounts=accounts, opm_overlapss=overlaps)))
+        for section, klass, attr in sections:
+            writer.write_section(dao_list.write_xml_object(klass()),
+                                 spools[section], add_finer_depths)
+        writer.close()
+    finally:
+        for spool in spools.itervalues():
+            spool.close()
+
+def walk_opm(workflow, version, log, reg, add_record, release_records):
+    """walk_opm(workflow: DBWorkflow, version: int, log: DBLog,
+                reg: DBRegistry, add_record: callable,
+                release_records: callable) -> list
+    Creates the OPM records for the executions of version in log,
+    calling add_record(section, obj, shared) for each of them. Shared
+    artifacts can still change after being added; they are passed to
+    release_records(section, objs) once they cannot. Returns the
+    accounts.
+
+    """
+    id_scope = IdScope()
     accounts = []
     depth_accounts = {}
     file_artifacts = {}
@@ -146,7 +316,7 @@ def create_opm(workflow, version, log, reg):
             print item_exec.db_module_name
         elif hasattr(item_exec, 'db_group_name'):
             print item_exec.db_group_name
-        processes.append(process)
+        add_record('processes', process)
         module = workflow.db_modules_id_index[item_exec.db_module_id]
         module_processes[module.db_id] = (module, process)
 
@@ -253,7 +423,7 @@ def create_opm(workflow, version, log, reg):
                 
                 artifact = \
                     create_artifact_from_port_spec(port_spec, account, id_scope)
-                artifacts.append(artifact)
+                add_record('artifacts', artifact)
                 print 'adding conn_artifact', artifact.db_id, source_t, \
                     source.db_moduleName
                 conn_artifacts[source_t] = artifact
@@ -281,15 +451,15 @@ def create_opm(workflow, version, log, reg):
                 found_input_ports['OutputPort'].db_parameters[0].db_val
 
             s_process = create_process_manual('Split', account, id_scope)
-            processes.append(s_process)
-            dependencies.append(create_used(s_process,
-                                            input_list_artifact,
-                                            account,
-                                            id_scope))
+            add_record('processes', s_process)
+            add_record('dependencies', create_used(s_process,
+                                                   input_list_artifact,
+                                                   account,
+                                                   id_scope))
             # need to have process that condenses artifacts from each iteration
             if result_artifact is not None:
                 j_process = create_process_manual('Join', account, id_scope)
-                processes.append(j_process)
+                add_record('processes', j_process)
             for loop_exec in item_exec.db_loop_execs:
                 for loop_iteration in loop_exec.db_loop_iterations:
                     loop_up_artifacts = {}
@@ -301,11 +471,11 @@ def create_opm(workflow, version, log, reg):
                         s_artifact = \
                             create_artifact_from_port_spec(port_spec, account,
                                                            id_scope)
-                        artifacts.append(s_artifact)
-                        dependencies.append(create_was_generated_by(s_artifact,
-                                                                    s_process,
-                                                                    account,
-                                                                    id_scope))
+                        add_record('artifacts', s_artifact)
+                        add_record('dependencies', create_was_generated_by(s_artifact,
+                                                                           s_process,
+                                                                           account,
+                                                                           id_scope))
                         if input_name not in loop_up_artifacts:
                             loop_up_artifacts[input_name] = []
                         loop_up_artifacts[input_name].append(s_artifact)
@@ -318,14 +488,14 @@ def create_opm(workflow, version, log, reg):
                         o_artifact = \
                                 create_artifact_from_port_spec(port_spec, account,
                                                                id_scope)
-                        artifacts.append(o_artifact)
+                        add_record('artifacts', o_artifact)
                         if output_port not in loop_down_artifacts:
                             loop_down_artifacts[output_port] = []
                         loop_down_artifacts[output_port].append(o_artifact)
 
                     if result_artifact is not None:
-                        dependencies.append(create_used(j_process, o_artifact,
-                                                        account, id_scope))
+                        add_record('dependencies', create_used(j_process, o_artifact,
+                                                               account, id_scope))
 
                     # now process a loop_exec
                     for child_exec in loop_iteration.db_item_execs:
@@ -339,10 +509,10 @@ def create_opm(workflow, version, log, reg):
 
             # need to set Return artifact and connect j_process to it
             if result_artifact is not None:
-                dependencies.append(create_was_generated_by(result_artifact,
-                                                            j_process,
-                                                            account,
-                                                            id_scope))
+                add_record('dependencies', create_was_generated_by(result_artifact,
+                                                                   j_process,
+                                                                   account,
+                                                                   id_scope))
 
         def process_module_loop(module, found_input_ports, found_output_ports):
             print "*** Processing Module with loops"
@@ -358,17 +528,17 @@ def create_opm(workflow, version, log, reg):
                                 if found_output_ports[r] is not None
                                 for a in found_output_ports[r]]
             s_process = create_process_manual('Split', account, id_scope)
-            processes.append(s_process)
+            add_record('processes', s_process)
             for input_port in found_input_ports:
                 for input_name in input_port:
-                    dependencies.append(create_used(s_process,
-                                                    found_input_ports[input_name],
-                                                    account,
-                                                    id_scope))
+                    add_record('dependencies', create_used(s_process,
+                                                           found_input_ports[input_name],
+                                                           account,
+                                                           id_scope))
             # need to have process that condenses artifacts from each iteration
             if result_artifacts:
                 j_process = create_process_manual('Join', account, id_scope)
-                processes.append(j_process)
+                add_record('processes', j_process)
             for loop_exec in item_exec.db_loop_execs:
                 for loop_iteration in loop_exec.db_loop_iterations:
                     loop_up_artifacts = {}
@@ -381,11 +551,11 @@ def create_opm(workflow, version, log, reg):
                             s_artifact = \
                                 create_artifact_from_port_spec(port_spec, account,
                                                                id_scope)
-                            artifacts.append(s_artifact)
-                            dependencies.append(create_was_generated_by(s_artifact,
-                                                                        s_process,
-                                                                        account,
-                                                                        id_scope))
+                            add_record('artifacts', s_artifact)
+                            add_record('dependencies', create_was_generated_by(s_artifact,
+                                                                               s_process,
+                                                                               account,
+                                                                               id_scope))
                             if input_name not in loop_up_artifacts:
                                 loop_up_artifacts[input_name] = []
                             loop_up_artifacts[input_name].append(s_artifact)
@@ -399,14 +569,14 @@ def create_opm(workflow, version, log, reg):
                             o_artifact = \
                                     create_artifact_from_port_spec(port_spec, account,
                                                                    id_scope)
-                            artifacts.append(o_artifact)
+                            add_record('artifacts', o_artifact)
                             if output_name not in loop_down_artifacts:
                                 loop_down_artifacts[output_name] = []
                             loop_down_artifacts[output_name].append(o_artifact)
 
                             if result_artifacts:
-                                dependencies.append(create_used(j_process, o_artifact,
-                                                                account, id_scope))
+                                add_record('dependencies', create_used(j_process, o_artifact,
+                                                                       account, id_scope))
 
                     # now process a loop_exec
                     for child_exec in loop_iteration.db_item_execs:
@@ -420,10 +590,10 @@ def create_opm(workflow, version, log, reg):
 
             # need to set Return artifacts and connect j_process to it
             for result_artifact in result_artifacts:
-                dependencies.append(create_was_generated_by(result_artifact,
-                                                            j_process,
-                                                            account,
-                                                            id_scope))
+                add_record('dependencies', create_was_generated_by(result_artifact,
+                                                                   j_process,
+                                                                   account,
+                                                                   id_scope))
 
         def process_group(module, found_input_ports, found_output_ports):
             # identify depth and create new account if necessary
@@ -447,15 +617,15 @@ def create_opm(workflow, version, log, reg):
             if module.db_name == 'InputPort':
                 if port_name in in_upstream_artifacts:
                     for artifact in in_upstream_artifacts[port_name]:
-                        dependencies.append(create_used(process, artifact,
-                                                        account, id_scope))
+                        add_record('dependencies', create_used(process, artifact,
+                                                               account, id_scope))
             elif module.db_name == 'OutputPort':
                 if port_name in in_downstream_artifacts:
                     for artifact in in_downstream_artifacts[port_name]:
-                        dependencies.append(create_was_generated_by(artifact,
-                                                                    process, 
-                                                                    account, 
-                                                                    id_scope))
+                        add_record('dependencies', create_was_generated_by(artifact,
+                                                                           process, 
+                                                                           account, 
+                                                                           id_scope))
 
         def process_if_module(module, found_input_ports, found_output_ports):
             print 'processing IFFFF'
@@ -479,10 +649,10 @@ def create_opm(workflow, version, log, reg):
             # FIXME: assume true for now
             # eventually need to check which module_id was execed for this
             # current item exec
-            dependencies.append(create_was_triggered_by(cond_process,
-                                                        process,
-                                                        account,
-                                                        id_scope))
+            add_record('dependencies', create_was_triggered_by(cond_process,
+                                                               process,
+                                                               account,
+                                                               id_scope))
 
         if add_extras:
             print '***adding extras'
@@ -490,15 +660,15 @@ def create_opm(workflow, version, log, reg):
             out_downstream_artifacts = copy.copy(in_downstream_artifacts)
             for port_name, artifact_list in in_upstream_artifacts.iteritems():
                 for artifact in artifact_list:
-                    dependencies.append(create_used(process, artifact,
-                                                    account, id_scope))
+                    add_record('dependencies', create_used(process, artifact,
+                                                           account, id_scope))
             for port_name, artifact_list in in_downstream_artifacts.iteritems():
                 for artifact in artifact_list:
                     # conn_artifacts[(port_name, 'output')] = artifact
-                    dependencies.append(create_was_generated_by(artifact,
-                                                                process,
-                                                                account,
-                                                                id_scope))
+                    add_record('dependencies', create_was_generated_by(artifact,
+                                                                       process,
+                                                                       account,
+                                                                       id_scope))
         else:
             out_upstream_artifacts = {}
             out_downstream_artifacts = {}
@@ -550,7 +720,7 @@ def create_opm(workflow, version, log, reg):
                     artifact = create_artifact_from_db_tuple(db_tuple,
                                                              account,
                                                              id_scope)
-                    artifacts.append(artifact)
+                    add_record('artifacts', artifact, True)
                     db_artifacts[db_tuple] = artifact
                 else:
                     artifact = db_artifacts[db_tuple]
@@ -566,29 +736,29 @@ def create_opm(workflow, version, log, reg):
                         artifact = create_artifact_from_filename(fname,
                                                                  account,
                                                                  id_scope)
-                        artifacts.append(artifact)
+                        add_record('artifacts', artifact, True)
                         file_artifacts[fname] = artifact
                     else:
                         artifact = file_artifacts[fname]
                         if int(artifact.db_accounts[0].db_id[4:]) > \
                                 int(account.db_id[4:]):
                             artifact.db_accounts[0] = account
-                    dependencies.append(create_used(process, artifact,
-                                                    account, id_scope))
+                    add_record('dependencies', create_used(process, artifact,
+                                                           account, id_scope))
             elif annotation.db_key == 'generated_tables':
                 generated_tables = literal_eval(annotation.db_value)
                 for db_tuple in generated_tables:
                     artifact = process_db_tuple(db_tuple)
-                    dependencies.append(create_was_generated_by(artifact,
-                                                                process,
-                                                                account,
-                                                                id_scope))
+                    add_record('dependencies', create_was_generated_by(artifact,
+                                                                       process,
+                                                                       account,
+                                                                       id_scope))
             elif annotation.db_key == 'used_tables':
                 used_tables = literal_eval(annotation.db_value)
                 for db_tuple in used_tables:
                     artifact = process_db_tuple(db_tuple)
-                    dependencies.append(create_used(process, artifact,
-                                                    account, id_scope))
+                    add_record('dependencies', create_used(process, artifact,
+                                                           account, id_scope))
 
         # process functions
         for function in module.db_functions:
@@ -608,15 +778,15 @@ def create_opm(workflow, version, log, reg):
                                                          account,
                                                          id_scope)
                 print 'adding artifact', artifact.db_id
-                artifacts.append(artifact)
+                add_record('artifacts', artifact, True)
                 function_artifacts[function_t] = artifact
             if function.db_name in special_ports[0]:
                 found_input_ports[function.db_name] = artifact
             if function.db_name not in out_upstream_artifacts:
                 out_upstream_artifacts[function.db_name] = []
             out_upstream_artifacts[function.db_name].append(artifact)
-            dependencies.append(create_used(process, artifact, account,
-                                            id_scope))
+            add_record('dependencies', create_used(process, artifact, account,
+                                                   id_scope))
 
         # process connections
         if module.db_id in upstream_lookup:
@@ -635,8 +805,8 @@ def create_opm(workflow, version, log, reg):
                     out_upstream_artifacts[dest.db_name].append(artifact)
                     print 'adding dependency (pa)', process.db_id, \
                         artifact.db_id
-                    dependencies.append(create_used(process, artifact, 
-                                                    account, id_scope))
+                    add_record('dependencies', create_used(process, artifact, 
+                                                           account, id_scope))
 
         if item_exec.db_completed == 1:
             if module.db_id in downstream_lookup:
@@ -668,10 +838,10 @@ def create_opm(workflow, version, log, reg):
                             out_downstream_artifacts[source.db_name].append(artifact)
                             print 'adding dependency (ap)', artifact.db_id, \
                                 process.db_id
-                            dependencies.append(create_was_generated_by(artifact, 
-                                                                        process, 
-                                                                        account,
-                                                                        id_scope))
+                            add_record('dependencies', create_was_generated_by(artifact, 
+                                                                               process, 
+                                                                               account,
+                                                                               id_scope))
 
         if special_ports[2] is not None:
             special_ports[2](module, found_input_ports, found_output_ports)
@@ -741,6 +911,7 @@ def create_opm(workflow, version, log, reg):
                                  depth, conn_artifacts, function_artifacts,
                                  module_processes,
                                  upstream_artifacts, downstream_artifacts)
+                release_records('artifacts', function_artifacts.values())
         else:
             for item_exec in parent_exec.db_item_execs:
                 do_create_process(workflow, item_exec, account, 
@@ -750,6 +921,7 @@ def create_opm(workflow, version, log, reg):
                              downstream_lookup, depth, conn_artifacts,
                              function_artifacts, module_processes,
                              upstream_artifacts, downstream_artifacts)
+            release_records('artifacts', function_artifacts.values())
                 
     account_id = id_scope.getNewId(DBOpmAccount.vtType)
     account = DBOpmAccount(id='acct' + str(account_id),
@@ -757,58 +929,9 @@ def create_opm(workflow, version, log, reg):
     accounts.append(account)
     depth_accounts[0] = account
     process_workflow(workflow, log, account, {}, {}, 0, True) 
-
-    #print processes
-    #print dependencies
-    max_depth = max(depth_accounts)
-    def add_finer_depths(objs, exclude_groups=False, exclude_deps=False, 
-                         p_ids=set()):
-        new_p_ids = []
-        for obj in objs:
-            can_update=True
-            if exclude_groups:
-                if obj.db_value.db_value.vtType == DBGroupExec.vtType:
-                    new_p_ids.append(obj.db_id)
-                    can_update = False
-                elif obj.db_value.db_value.vtType == DBModuleExec.vtType and \
-                        len(obj.db_value.db_value.db_loop_execs) > 0:
-                    new_p_ids.append(obj.db_id)
-                    can_update = False
-                
-            if exclude_deps:
-                if ((obj.vtType == DBOpmWasGeneratedBy.vtType and
-                     obj.db_cause.db_id in p_ids) or 
-                    (obj.vtType == DBOpmUsed.vtType and
-                     obj.db_effect.db_id in p_ids)):
-                    can_update = False
-            if can_update:
-                min_depth = int(obj.db_accounts[0].db_id[4:])
-                for i in xrange(min_depth+1, max_depth+1):
-                    obj.db_add_account(DBOpmAccountId(id='acct' + str(i)))
-        return new_p_ids
-
-    # FIXME: also exclude group dependencies (used, wasGeneratedBy)...
-    p_ids = add_finer_depths(processes, True)
-    print p_ids
-    add_finer_depths(artifacts)
-    add_finer_depths(dependencies, False, True, set(p_ids))
-
-    overlaps = []
-    for i in xrange(max_depth+1):
-        for j in xrange(i+1, max_depth+1):
-            ids = [DBOpmAccountId(id='acct' + str(i)),
-                   DBOpmAccountId(id='acct' + str(j))]
-            overlaps.append(DBOpmOverlaps(opm_account_ids=ids))
-
-    opm_graph = DBOpmGraph(accounts=DBOpmAccounts(accounts=accounts,
-                                                  opm_overlapss=overlaps),
-                           processes=DBOpmProcesses(processs=processes),
-                           artifacts=\
-                               DBOpmArtifacts(artifacts=artifacts),
-                           dependencies=\
-                               DBOpmDependencies(dependencys=dependencies),
-                           )
-    return opm_graph
+    release_records('artifacts', file_artifacts.values())
+    release_records('artifacts', db_artifacts.values())
+    return accounts
 
 def add_module_descriptor_index(registry):
     registry.db_module_descriptors_id_index = {}
@@ -859,13 +982,109 @@ def create_opm_from_vistrail(vistrail, version, log, registry):
 
 def run(vistrail_xml, version, log_xml, registry_xml, output_fname):
     from vistrails.db.persistence import DAOList
+    from vistrails.db.versions import currentVersion
 
     vistrail = vistrails.db.services.io.open_vistrail_from_xml(vistrail_xml)
     log = vistrails.db.services.io.open_log_from_xml(log_xml)
     registry = vistrails.db.services.io.open_registry_from_xml(registry_xml)
-    opm_graph = create_opm_from_vistrail(vistrail, int(version), log, registry)
+    version = int(version)
+    workflow = materializeWorkflow(vistrail, version)
+    add_group_portSpecs_index(workflow)
+    add_module_descriptor_index(registry)
     dao_list = DAOList()
-    dao_list.save_to_xml(opm_graph, output_fname, {})
+    write_opm(workflow, version, log, registry, output_fname, dao_list,
+              {'version': currentVersion})
+
+import unittest
+
+class TestOpm(unittest.TestCase):
+    def create_objects(self):
+        from vistrails.db.domain import DBWorkflow, DBModule, DBLog, \
+            DBWorkflowExec, DBAnnotation, DBRegistry, DBPackage, \
+            DBModuleDescriptor
+
+        pkg_id = 'org.vistrails.vistrails.tests'
+        def module(id, functions=()):
+            params = [DBParameter(id=id*10+i, pos=0, type='String', val='x')
+                      for i in xrange(len(functions))]
+            return DBModule(id=id, name='Source', package=pkg_id,
+                            namespace='', version='1',
+                            functions=[DBFunction(id=id*10+i, name=f, pos=i,
+                                                  parameters=[params[i]])
+                                       for i, f in enumerate(functions)])
+        ports = [DBPort(id=1, type='source', moduleId=1,
+                        moduleName='Source', name='value'),
+                 DBPort(id=2, type='destination', moduleId=2,
+                        moduleName='Source', name='input')]
+        inner_workflow = DBWorkflow(id=1, modules=[module(10, ['a'])])
+        group = DBGroup(id=3, name='Group', namespace='', version='1',
+                        package=get_vistrails_basic_pkg_id(),
+                        workflow=inner_workflow)
+        modules = [module(1, ['a', 'b']), module(2), group]
+        workflow = DBWorkflow(id=0, modules=modules,
+                              connections=[DBConnection(id=1, ports=ports)])
+        descriptor = DBModuleDescriptor(id=1, name='Source', namespace='',
+                                        version='', portSpecs=[
+                DBPortSpec(id=1, name='value', type='output')])
+        registry = DBRegistry(id=0, root_descriptor_id=1, packages=[
+                DBPackage(id=1, identifier=pkg_id, version='1',
+                          module_descriptors=[descriptor])])
+
+        def module_exec(id, module_id, files):
+            annotation = DBAnnotation(id=id, key='used_files',
+                                      value=repr(files))
+            return DBModuleExec(id=id, module_id=module_id, completed=1,
+                                module_name='Source',
+                                annotations=[annotation])
+        execs = []
+        for i in xrange(3):
+            inner_exec = module_exec(i*10+4, 10, ['f'])
+            group_exec = DBGroupExec(id=i*10+3, module_id=3, completed=1,
+                                     group_name='Group',
+                                     item_execs=[inner_exec])
+            execs.append(DBWorkflowExec(id=i, parent_version=5, item_execs=[
+                        module_exec(i*10+1, 1, ['f']),
+                        module_exec(i*10+2, 2, ['f', 'g%d' % i]),
+                        group_exec]))
+        return workflow, DBLog(id=0, workflow_execs=execs), registry
+
+    def test_write_opm(self):
+        """write_opm writes the same graph as create_opm"""
+        import os
+        import shutil
+        import tempfile
+        from vistrails.db.persistence import DAOList
+
+        workflow, log, registry = self.create_objects()
+        dao_list = DAOList()
+        tmp_dir = tempfile.mkdtemp(prefix='vt_opm')
+        try:
+            fname = os.path.join(tmp_dir, 'graph.xml')
+            dao_list.save_to_xml(create_opm(workflow, 5, log, registry),
+                                 fname, {})
+            expected = ElementTree.parse(fname).getroot()
+            write_opm(workflow, 5, log, registry, fname, dao_list,
+                      {'version': expected.get('version')})
+            result = ElementTree.parse(fname).getroot()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # shared artifacts are written last, so only compare contents
+        def records(section):
+            for elem in section:
+                elem.tail = None
+            return sorted(ElementTree.tostring(elem) for elem in section)
+        self.assertEqual(expected.items(), result.items())
+        self.assertEqual([s.tag for s in expected], [s.tag for s in result])
+        for expected_section, section in zip(expected, result):
+            self.assertEqual(records(expected_section), records(section))
+        # the group process is in the coarser account only
+        accounts = dict((p.get('id'), [a.get('id') for a in
+                                       p.findall('account')])
+                        for p in result.find('processes'))
+        self.assertEqual(accounts['p0'], ['acct0', 'acct1'])
+        self.assertEqual(accounts['p2'], ['acct0'])
+        self.assertEqual(accounts['p3'], ['acct1'])
 
 if __name__ == '__main__':
     if len(sys.argv) < 5:
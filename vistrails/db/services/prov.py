@@ -38,16 +38,24 @@ from __future__ import division
 import copy
 import sys
 import os
+from vistrails.core.system import get_vistrails_basic_pkg_id
 import vistrails.db.services.io
+from vistrails.db.services.xml_stream import XMLSpool, XMLStreamWriter
 from vistrails.db.domain import DBProvDocument, DBProvEntity, DBProvActivity, \
     DBProvAgent, DBProvGeneration, DBProvUsage, DBProvAssociation, \
     DBVtConnection, DBRefProvEntity, DBRefProvPlan, DBRefProvActivity, \
     DBRefProvAgent, DBIsPartOf, IdScope, DBGroupExec, DBLoopExec, DBLoopIteration, \
-    DBModuleExec, DBWorkflowExec, DBFunction, DBParameter, DBGroup, DBAbstraction
+    DBModuleExec, DBWorkflowExec, DBFunction, DBParameter, DBGroup, DBAbstraction, \
+    DBPortSpec
 from vistrails.db.services.vistrail import materializeWorkflow
 
-def create_prov_document(entities, activities, agents, connections, usages,
-                         generations, associations):
+# the kinds of records in a PROV document, in the order they are written
+PROV_SECTIONS = ['entities', 'activities', 'agents', 'connections', 'usages',
+                 'generations', 'associations']
+
+def create_prov_document(entities=None, activities=None, agents=None,
+                         connections=None, usages=None, generations=None,
+                         associations=None):
     return DBProvDocument(prov_entitys=entities,
                           prov_activitys=activities,
                           prov_agents=agents,
@@ -289,15 +297,50 @@ def create_prov_generation(prov_entity, prov_activity):
                             prov_role=None)
 
 def create_prov(workflow, version, log):
+    records = dict((section, []) for section in PROV_SECTIONS)
+    def add_record(section, obj):
+        records[section].append(obj)
+    walk_prov(workflow, version, log, add_record)
+
+    # PROV Document
+    return create_prov_document(**records)
+
+def write_prov(workflow, version, log, filename, dao_list, tags):
+    """write_prov(workflow: DBWorkflow, version: int, log: DBLog,
+                  filename: str, dao_list: DAOList, tags: dict) -> None
+    Writes the PROV document to filename as its records are created,
+    instead of building it in memory first. tags are set on the root
+    element.
+
+    """
+    spools = dict((section, XMLSpool(dao_list, 1))
+                  for section in PROV_SECTIONS)
+    try:
+        def add_record(section, obj):
+            spools[section].add(create_prov_document(**{section: [obj]}))
+        walk_prov(workflow, version, log, add_record)
+
+        root = dao_list.write_xml_object(create_prov_document())
+        for k, v in tags.iteritems():
+            root.set(k, v)
+        writer = XMLStreamWriter(filename, root)
+        for section in PROV_SECTIONS:
+            writer.write_spool(spools[section])
+        writer.close()
+    finally:
+        for spool in spools.itervalues():
+            spool.close()
+
+def walk_prov(workflow, version, log, add_record):
+    """walk_prov(workflow: DBWorkflow, version: int, log: DBLog,
+                 add_record: callable) -> None
+    Creates the PROV records for the executions of version in log,
+    calling add_record(section, obj) for each of them in document order.
+    Entities for data are added only once, when first used.
+
+    """
     id_scope = IdScope()
-    entities = []
-    activities = []
-    agents = []
-    connections = []
-    usages = []
-    generations = []
-    associations = []
-    
+
     # mapping between VT ids and PROV objects
     entities_map = {}
     agents_map = {}
@@ -340,7 +383,7 @@ def create_prov(workflow, version, log):
                                                            group=module,
                                                            is_part_of=vt_part)
                 entities_map[module._db_id] = prov_group
-                entities.append(prov_group)
+                add_record('entities', prov_group)
                 get_modules_and_conn(prov_group, module.db_workflow)
             
             # abstraction (subworkflow)
@@ -350,7 +393,7 @@ def create_prov(workflow, version, log):
                                                                        abstraction=module,
                                                                        is_part_of=vt_part)
                 entities_map[module._db_id] = prov_abstraction
-                entities.append(prov_abstraction)
+                add_record('entities', prov_abstraction)
                 #get_modules_and_conn(prov_abstraction, module.db_workflow)
             
             # module
@@ -360,7 +403,7 @@ def create_prov(workflow, version, log):
                                                              module=module,
                                                              is_part_of=vt_part)
                 entities_map[module._db_id] = prov_module
-                entities.append(prov_module)
+                add_record('entities', prov_module)
 
             module_functions[module._db_id] = module._db_functions
             for function in module._db_functions:
@@ -384,7 +427,7 @@ def create_prov(workflow, version, log):
             prov_data_conn[conn.db_id] = [prov_data, False]
             
             vt_connection = create_vt_connection(id_scope, source, dest, entities_map)
-            connections.append(vt_connection)
+            add_record('connections', vt_connection)
             
         return True
     ############################################################################
@@ -402,7 +445,7 @@ def create_prov(workflow, version, log):
 #            prov_machine = machines[exec_.machine_id][0]
 #            machine_id = prov_machine._db_id
 #            if not machines[exec_.machine_id][1]:
-#                agents.append(prov_machine)
+#                add_record('agents', prov_machine)
 #                machines[exec_.machine_id][1] = True
             
             # PROV activity
@@ -412,7 +455,7 @@ def create_prov(workflow, version, log):
                                                            machine_id,
                                                            vt_part)
             
-            activities.append(prov_activity)
+            add_record('activities', prov_activity)
 
             if exec_.vtType != DBLoopIteration.vtType:
                 try:
@@ -424,18 +467,18 @@ def create_prov(workflow, version, log):
                     prov_data = prov_functions[function.db_id]
 
                     prov_usage = create_prov_usage(prov_activity, prov_data)
-                    usages.append(prov_usage)
+                    add_record('usages', prov_usage)
 
                 if dest_conn.has_key(exec_._db_module_id):
                     connections = dest_conn[exec_._db_module_id]
                     for connection in connections:
                         prov_input_data, inserted = prov_data_conn[connection.db_id]
                         if not inserted:
-                            entities.append(prov_input_data)
+                            add_record('entities', prov_input_data)
                             prov_data_conn[connection.db_id][1] = True
 
                         prov_usage = create_prov_usage(prov_activity, prov_input_data)
-                        usages.append(prov_usage)
+                        add_record('usages', prov_usage)
 
                 if (prov_activity._db_vt_error is None) or (prov_activity._db_vt_error == ''):
                     if source_conn.has_key(exec_._db_module_id):
@@ -443,16 +486,16 @@ def create_prov(workflow, version, log):
                         for connection in connections:
                             prov_output_data, inserted = prov_data_conn[connection.db_id]
                             if not inserted:
-                                entities.append(prov_output_data)
+                                add_record('entities', prov_output_data)
                                 prov_data_conn[connection.db_id][1] = True
 
                             prov_generation = create_prov_generation(prov_output_data, prov_activity)
-                            generations.append(prov_generation)
+                            add_record('generations', prov_generation)
 
                 # PROV entity associated
                 prov_module_entity = entities_map[exec_._db_module_id]
                 prov_association = create_prov_association(prov_activity, prov_agent, prov_module_entity)
-                associations.append(prov_association)
+                add_record('associations', prov_association)
             
             if exec_.vtType == DBModuleExec.vtType:
                 for loop_exec in exec_.loop_execs:
@@ -482,14 +525,14 @@ def create_prov(workflow, version, log):
     # workflow
     prov_workflow = create_prov_entity_from_workflow(id_scope, workflow)
     entities_map[workflow.db_id] = prov_workflow
-    entities.append(prov_workflow)
+    add_record('entities', prov_workflow)
     
     # getting modules and connections 
     get_modules_and_conn(prov_workflow, workflow)
     
     # storing input data
     for id in prov_functions:
-        entities.append(prov_functions[id])
+        add_record('entities', prov_functions[id])
 
     # executions
     for exec_ in log._db_workflow_execs:
@@ -499,7 +542,7 @@ def create_prov(workflow, version, log):
         if exec_._db_user not in agents_map:
             prov_agent = create_prov_agent_from_user(id_scope, exec_._db_user)
             agents_map[exec_._db_user] = prov_agent
-            agents.append(prov_agent)
+            add_record('agents', prov_agent)
         else:
             prov_agent = agents_map[exec_._db_user]
         
@@ -510,7 +553,7 @@ def create_prov(workflow, version, log):
 
         # creating PROV activity
         prov_activity = create_prov_activity_from_wf_exec(id_scope, exec_)
-        activities.append(prov_activity)
+        add_record('activities', prov_activity)
         
         # creating association with PROV entity
         prov_association = create_prov_association(prov_activity, prov_agent, prov_workflow)
@@ -518,15 +561,6 @@ def create_prov(workflow, version, log):
         for item in exec_._db_item_execs:
             get_execs(item, prov_activity, prov_agent)
     
-    # PROV Document
-    return create_prov_document(entities=entities,
-                                activities=activities,
-                                agents=agents,
-                                connections=connections,
-                                usages=usages,
-                                generations=generations,
-                                associations=associations)
-    
 def add_group_portSpecs_index(workflow):
     basic_pkg = get_vistrails_basic_pkg_id()
     def process_group(group):
@@ -568,19 +602,59 @@ def create_prov_from_vistrail(vistrail, version, log):
     
 def run(vistrail_xml, version, log_xml, output_fname):
     from vistrails.db.persistence import DAOList
+    from vistrails.db.versions import currentVersion
     from vistrails.core.vistrail.vistrail import Vistrail
     import vistrails.db.services.io
     
     vistrail = vistrails.db.services.io.open_vistrail_from_xml(vistrail_xml)
     log = vistrails.db.services.io.open_log_from_xml(log_xml, was_appended=True)
     version_id = vistrail.db_get_actionAnnotation_by_key((Vistrail.TAG_ANNOTATION, version)).db_action_id
-    prov_document = create_prov_from_vistrail(vistrail, int(version_id), log)
+    version_id = int(version_id)
+    workflow = materializeWorkflow(vistrail, version_id)
+    add_group_portSpecs_index(workflow)
     dao_list = DAOList()
     tags = {'xmlns:prov': 'http://www.w3.org/ns/prov#',
             'xmlns:dcterms': 'http://purl.org/dc/terms/',
             'xmlns:vt': 'http://www.vistrails.org/registry.xsd',
+            'version': currentVersion,
             }
-    dao_list.save_to_xml(prov_document, output_fname, tags)
+    write_prov(workflow, version_id, log, output_fname, dao_list, tags)
+
+import unittest
+
+class TestProv(unittest.TestCase):
+    def test_write_prov(self):
+        """write_prov writes the same document as create_prov"""
+        import shutil
+        import tempfile
+        from vistrails.core.log.log import Log
+        from vistrails.core.system import vistrails_root_directory
+        from vistrails.db.persistence import DAOList
+        from vistrails.db.versions import currentVersion
+
+        (save_bundle, vt_save_dir) = \
+            vistrails.db.services.io.open_vistrail_bundle_from_zip_xml(
+                os.path.join(vistrails_root_directory(),
+                             'tests/resources/spx_loop.vt'))
+        try:
+            log = vistrails.db.services.io.open_log_from_xml(
+                save_bundle.vistrail.db_log_filename, True)
+            Log.convert(log)
+            workflow = materializeWorkflow(save_bundle.vistrail, 35)
+            dao_list = DAOList()
+            tags = {'xmlns:prov': 'http://www.w3.org/ns/prov#'}
+            expected_fname = os.path.join(vt_save_dir, 'expected.xml')
+            dao_list.save_to_xml(create_prov(workflow, 35, log),
+                                 expected_fname, tags)
+            tags['version'] = currentVersion
+            fname = os.path.join(vt_save_dir, 'prov.xml')
+            write_prov(workflow, 35, log, fname, dao_list, tags)
+            with open(expected_fname, 'rb') as f:
+                expected = f.read()
+            with open(fname, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+        finally:
+            shutil.rmtree(vt_save_dir)
 
 if __name__ == '__main__':
     if len(sys.argv) < 4:
@@ -47,7 +47,7 @@ import getpass
 
 import unittest
 import vistrails.core.system
-from itertools import chain
+from itertools import chain, izip
 
 def update_id_scope(vistrail):
     if hasattr(vistrail, 'update_id_scope'):
@@ -196,6 +196,19 @@ def synchronize(old_vistrail, new_vistrail, current_action_id):
     old_vistrail.db_currentVersion = new_action_id
     return new_action_id
 
+def action_keys(actions):
+    """ action_keys(actions: list) -> iterator
+        Yields a key identifying each action across copies of a vistrail:
+        its user and date, and how many actions with the same user and date
+        came before it.
+        """
+    seen = {}
+    for action in actions:
+        key = (action._db_user, action._db_date)
+        copy_no = seen.get(key, 0)
+        seen[key] = copy_no + 1
+        yield key + (copy_no,)
+
 def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir = ''):
     """ def merge(sb: SaveBundle, next_sb: SaveBundle, app: str,
                   interactive: bool, tmp_dir: str, next_tmp_dir: str) -> None
@@ -231,34 +244,13 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
         checkinId = int(co._db_value)
     else:
         #print "calculating checkin id"
-        # create unique identifiers for all actions
-        actions = []
-        actionDict = {}
-        for action in vt.db_actions:
-            unique = action._db_user + str(action._db_date)
-            copy_no = 0
-            while (unique + str(copy_no)) in actionDict:
-                copy_no += 1
-            unique = unique + str(copy_no)
-            actions.append(unique)
-            actionDict[unique] = action
-        actionNexts = []
-        actionDictNext = {}
-        for action in next_vt.db_actions:
-            unique = action._db_user + str(action._db_date)
-            copy_no = 0
-            while (unique + str(copy_no)) in actionDictNext:
-                copy_no += 1
-            unique = unique + str(copy_no)
-            actionNexts.append(unique)
-            actionDictNext[unique] = action
-
         # find last checkin action (only works for centralized syncs)
-        while checkinId < len(actions) and checkinId < len(actionNexts) and \
-            actions[checkinId] == actionNexts[checkinId]:
-                checkinId += 1
-        if checkinId > 0:
-            checkinId = actionDict[actions[checkinId-1]].db_id
+        for action, next_action, key, next_key in izip(
+                vt.db_actions, next_vt.db_actions,
+                action_keys(vt.db_actions), action_keys(next_vt.db_actions)):
+            if key != next_key:
+                break
+            checkinId = action.db_id
     #print "checkinId:", checkinId
 
     # delete previous checkout annotations in vt
@@ -287,11 +279,11 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
     #print "merge actionannotations:", mergeActionAnnotations
 
     ################## merge actions ######################
-    for action in next_vt.db_actions:
-        # check for identical actions
-        if action._db_id > checkinId:
-            new_action = action.do_copy(True, vt.idScope, id_remap)
-            vt.db_add_action(new_action)
+    new_actions = [action.do_copy(True, vt.idScope, id_remap)
+                   for action in next_vt.db_actions
+                   if action._db_id > checkinId]
+    for new_action in new_actions:
+        vt.db_add_action(new_action)
 
     ################## merge annotations ##################
     if not mergeAnnotations:
@@ -397,7 +389,8 @@ def merge(sb, next_sb, app='', interactive = False, tmp_dir = '', next_tmp_dir =
                 annotation = new_annotation.do_copy(True, vt.idScope, id_remap)
                 vt.db_add_actionAnnotation(annotation)
             elif new_annotation.db_action_id <= checkinId and \
-                    new_annotation.db_key in oas[new_annotation.db_action_id]:
+                    new_annotation.db_key in oas.get(
+                            new_annotation.db_action_id, ()):
                 old_action = oas[new_annotation.db_action_id]
                 # we have a conflict
                 # tags should be merged (the user need to resolve)
@@ -1634,5 +1627,50 @@ class TestDBVistrailService(unittest.TestCase):
         # test parameter change inequality
         assert heuristicModuleMatch(module1, module5) == 0
 
+    def test_merge(self):
+        import datetime
+        from vistrails.core.db.action import create_action
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.vistrail import Vistrail
+        from vistrails.db.services.io import SaveBundle
+
+        date = datetime.datetime(2016, 1, 1)
+        def add_actions(vistrail, count, user):
+            parent = vistrail.get_latest_version()
+            for i in xrange(count):
+                module = Module(id=vistrail.idScope.getNewId(Module.vtType),
+                                name='Module', package='org.example',
+                                version='1.0')
+                action = create_action([('add', module)])
+                vistrail.add_action(action, parent)
+                # all at once, as scripted changes are
+                action.user = user
+                action.date = date
+                parent = action.id
+            return parent
+
+        base = Vistrail()
+        last = add_actions(base, 30, 'base')
+        mine = base.do_copy()
+        theirs = base.do_copy()
+        add_actions(mine, 3, 'me')
+        theirs_last = add_actions(theirs, 4, 'them')
+        theirs.set_notes(last, 'notes')
+        theirs.set_tag(theirs_last, 'their tag')
+
+        merge(SaveBundle(Vistrail.vtType, mine),
+              SaveBundle(Vistrail.vtType, theirs))
+        self.assertEqual(len(mine.actions), 37)
+        self.assertEqual(mine.get_notes(last), 'notes')
+        tagged = mine.get_tagMap().keys()
+        self.assertEqual(len(tagged), 1)
+        # their actions were appended after the common ones
+        version = tagged[0]
+        for i in xrange(4):
+            action = mine.actionMap[version]
+            self.assertEqual(action.user, 'them')
+            version = action.prevId
+        self.assertEqual(version, last)
+
 if __name__ == '__main__':
     unittest.main()
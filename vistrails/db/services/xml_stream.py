@@ -0,0 +1,205 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Writes XML documents one record at a time.
+
+The DAOs serialize a whole object tree at once, which needs the tree to
+fit in memory. XMLStreamWriter instead gets each record serialized on
+its own, as soon as it is created, and produces the same indented XML as
+DAOList.save_to_xml. Records that belong to a later part of the
+document wait in an XMLSpool, a temporary file, until that part is
+written.
+
+"""
+from __future__ import division
+
+import marshal
+import tempfile
+
+from vistrails.core.system import get_elementtree_library
+
+ElementTree = get_elementtree_library()
+
+def indent(elem, level=0):
+    """indent(elem: Element, level: int) -> None
+    Indents elem in place, as DAOList.write_xml_file does
+
+    """
+    i = "\n" + level*"  "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "  "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for elem in elem:
+            indent(elem, level+1)
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+def serialize(elem, level):
+    """serialize(elem: Element, level: int) -> str
+    Returns elem as indented XML, without the whitespace that follows it
+
+    """
+    indent(elem, level)
+    elem.tail = None
+    return ElementTree.tostring(elem)
+
+def split_tags(elem):
+    """split_tags(elem: Element) -> (str, str)
+    Returns the start and end tags of elem, ignoring its contents
+
+    """
+    marker = '\x00'
+    node = ElementTree.Element(elem.tag, dict(elem.items()))
+    node.text = marker
+    start, end = ElementTree.tostring(node).split(marker)
+    return start, end
+
+def replace_element(text, old, new):
+    """replace_element(text: str, old: str, new: list) -> str
+    Replaces the serialized element old in text by the serialized
+    elements in new, indenting them as old was
+
+    """
+    pos = text.index(old)
+    line = text.rindex('\n', 0, pos)
+    space = text[line:pos]
+    return ''.join([text[:line]] + [space + e for e in new] +
+                   [text[pos + len(old):]])
+
+class XMLSpool(object):
+    """Keeps serialized records in a temporary file until they can be
+    written, along with some data about each of them.
+
+    """
+    def __init__(self, dao_list, level):
+        """ XMLSpool(dao_list: DAOList, level: int) -> XMLSpool
+        Records will be indented for the given depth in the document
+
+        """
+        self.dao_list = dao_list
+        self.level = level
+        self.count = 0
+        self.file = tempfile.TemporaryFile()
+
+    def add(self, container, data=None):
+        """ add(container: DBObject, data) -> None
+        Stores the children of the serialized container, such as the
+        single record in a DBProvDocument, with data attached
+
+        """
+        node = self.dao_list.write_xml_object(container)
+        for child in node:
+            marshal.dump((serialize(child, self.level), data), self.file)
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ __iter__() -> iter((str, data))
+        Yields the stored records in order
+
+        """
+        self.file.seek(0)
+        for i in xrange(self.count):
+            yield marshal.load(self.file)
+
+    def close(self):
+        self.file.close()
+
+class XMLStreamWriter(object):
+    """Writes a document to a file, a child of its root at a time.
+
+    """
+    def __init__(self, filename, root):
+        """ XMLStreamWriter(filename: str, root: Element) -> XMLStreamWriter
+        root is the document element, with its attributes but no children
+
+        """
+        self.file = open(filename, 'wb')
+        self.start, self.end = split_tags(root)
+        self.empty = ElementTree.tostring(root)
+        self.started = False
+
+    def write_child(self, text, level=1):
+        if not self.started:
+            self.file.write(self.start)
+            self.started = True
+        self.file.write("\n" + level*"  ")
+        self.file.write(text)
+
+    def write_element(self, elem):
+        """ write_element(elem: Element) -> None
+        Writes a whole child of the root
+
+        """
+        self.write_child(serialize(elem, 1))
+
+    def write_spool(self, spool, transform=None):
+        """ write_spool(spool: XMLSpool, transform: callable) -> None
+        Writes the records in spool as children of the root, passing them
+        through transform(text, data) first if given
+
+        """
+        for text, data in spool:
+            if transform is not None:
+                text = transform(text, data)
+            self.write_child(text, spool.level)
+
+    def write_section(self, elem, spool, transform=None):
+        """ write_section(elem: Element, spool: XMLSpool,
+                          transform: callable) -> None
+        Writes elem as a child of the root, holding the records in spool
+
+        """
+        if not len(spool):
+            self.write_element(elem)
+            return
+        start, end = split_tags(elem)
+        self.write_child(start)
+        self.write_spool(spool, transform)
+        self.file.write("\n  " + end)
+
+    def close(self):
+        if self.started:
+            self.file.write("\n" + self.end + "\n")
+        else:
+            self.file.write(self.empty)
+        self.file.close()
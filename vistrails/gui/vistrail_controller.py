@@ -54,6 +54,7 @@ from vistrails.core.log.opm_graph import OpmGraph
 from vistrails.core.log.prov_document import ProvDocument
 from vistrails.core.modules.abstraction import identifier as abstraction_pkg
 from vistrails.core.modules.module_registry import get_module_registry
+from vistrails.core.modules.vistrails_module import ModuleError
 from vistrails.core.param_explore import ActionBasedParameterExploration
 from vistrails.core.query.version import TrueSearch
 from vistrails.core.query.visual import VisualQuery
@@ -189,6 +190,7 @@ class VistrailController(QtCore.QObject, BaseController):
 
         def width_f(text):
             return CurrentTheme.VERSION_FONT_METRIC.width(text)
+        self._version_font_metric = CurrentTheme.VERSION_FONT_METRIC
         self._current_graph_layout = \
             VistrailsTreeLayoutLW(width_f, 
                                   CurrentTheme.VERSION_FONT_METRIC.height(), 
@@ -688,10 +690,22 @@ class VistrailController(QtCore.QObject, BaseController):
             self.full_tree = full
             self.invalidate_version_tree(True)
 
+    def set_vistrail(self, *args, **kwargs):
+        BaseController.set_vistrail(self, *args, **kwargs)
+        # the previous layout is for other versions
+        self._current_graph_layout.reset()
+
     def recompute_terse_graph(self):
         BaseController.recompute_terse_graph(self)
-        self._current_graph_layout.layout_from(self.vistrail,
-                                               self._current_terse_graph)
+        layout = self._current_graph_layout
+        if CurrentTheme.VERSION_FONT_METRIC is not self._version_font_metric:
+            # the theme changed, the labels have to be measured again
+            self._version_font_metric = CurrentTheme.VERSION_FONT_METRIC
+            layout.text_height = self._version_font_metric.height()
+            (layout.text_horizontal_margin,
+             layout.text_vertical_margin) = CurrentTheme.VERSION_LABEL_MARGIN
+            layout.reset()
+        layout.layout_from(self.vistrail, self._current_terse_graph)
 
     def refine_graph(self, step=1.0):
         """ refine_graph(step: float in [0,1]) -> (Graph, Graph)        
@@ -742,7 +756,7 @@ class VistrailController(QtCore.QObject, BaseController):
                     not current_node_will_be_visible and not current == 0:
                 # we're going from one boring node to another,
                 # so just rename the node on the terse graph
-                self._current_terse_graph.rename_vertex(current, new_version)
+                self.rename_terse_vertex(current, new_version)
                 self.replace_unnamed_node_in_version_tree(current, new_version)
             else:
                 # bail, for now
@@ -1271,11 +1285,18 @@ class VistrailController(QtCore.QObject, BaseController):
         self.flush_delayed_actions()
         self.invalidate_version_tree()
         
-    def executeParameterExploration(self, pe, view=None, extra_info={}, showProgress=True):
+    def executeParameterExploration(self, pe, view=None, extra_info={},
+                                    showProgress=True, sampler=None,
+                                    objective=None):
         """ execute(pe: ParameterExploration, view: QVistrailView,
-            extra_info: dict, showProgress: bool) -> None
+            extra_info: dict, showProgress: bool, sampler: Sampler,
+            objective: (int, str)) -> None
         Perform the exploration by collecting a list of actions
         corresponding to each dimension
+
+        sampler chooses the combinations of steps to execute (all of them
+        by default). objective is the (module id, port name) of a scalar
+        output whose value is reported to the sampler after each execution.
         
         """
         reg = get_module_registry()
@@ -1291,29 +1312,28 @@ class VistrailController(QtCore.QObject, BaseController):
         if self.current_pipeline and actions:
             pe_log_id = uuid.uuid1()
             explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
-                self.current_pipeline, actions, pre_actions)
-            
+            # pipelines are built and positioned one at a time as they are
+            # executed, so that large explorations start right away and
+            # do not hold every pipeline in memory
+            explored = explorer.iter_explore(self.current_pipeline, actions,
+                                             pre_actions, sampler)
+            pipelineCount = explorer.count(actions, sampler)
+
             dim = [max(1, len(a)) for a in actions]
             if use_spreadsheet:
-                from vistrails.gui.paramexplore.virtual_cell import positionPipelines, assembleThumbnails
+                from vistrails.gui.paramexplore.virtual_cell import positionPipeline, assembleThumbnails
                 from vistrails.gui.paramexplore.pe_view import QParamExploreView
-                modifiedPipelines, pipelinePositions = positionPipelines(
-                    'PE#%d %s' % (QParamExploreView.explorationId, self.name),
-                    dim[2], dim[1], dim[0], pipelines, pe.layout, self)
+                sheetPrefix = 'PE#%d %s' % (QParamExploreView.explorationId,
+                                            self.name)
                 QParamExploreView.explorationId += 1
+                def position(pi, pipeline):
+                    return positionPipeline(sheetPrefix, dim[2], dim[1],
+                                            dim[0], pi, pipeline, pe.layout)
             else:
-                from vistrails.core.param_explore import _pipelinePositions
-                modifiedPipelines = pipelines
-                pipelinePositions = _pipelinePositions(
-                    dim[2], dim[1], dim[0], pipelines)
-
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount) == 0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
+                from vistrails.core.param_explore import _pipelinePosition
+                def position(pi, pipeline):
+                    return pipeline, _pipelinePosition(dim[2], dim[1],
+                                                       dim[0], pi)
 
             from vistrails.gui.job_monitor import QJobView
             jobView = QJobView.instance()
@@ -1326,8 +1346,11 @@ class VistrailController(QtCore.QObject, BaseController):
             try:
                 # Now execute the pipelines
 
+                totalProgress = 0
                 if showProgress:
-                    totalProgress = sum([len(p.modules) for p in modifiedPipelines])
+                    # estimated until the first pipeline is positioned
+                    totalProgress = (pipelineCount *
+                                     len(self.current_pipeline.modules))
                     self.progress = PEProgressDialog(self.vistrail_view, totalProgress)
                     self.progress.show()
 
@@ -1335,9 +1358,17 @@ class VistrailController(QtCore.QObject, BaseController):
 
                 images = {}
                 errors = []
-                for pi in xrange(len(modifiedPipelines)):
+                mCount = 0
+                for pi, (pipeline, performedActions) in enumerate(explored):
+                    modifiedPipeline, pipelinePosition = position(pi, pipeline)
                     if showProgress:
-                        self.progress.setValue(mCount[pi])
+                        if pi == 0:
+                            # exploring parameters doesn't change the
+                            # modules, so the first pipeline gives the total
+                            totalProgress = (pipelineCount *
+                                             len(modifiedPipeline.modules))
+                            self.progress.setMaximum(totalProgress)
+                        self.progress.setValue(mCount)
                         QtCore.QCoreApplication.processEvents()
                         if self.progress.wasCanceled():
                             break
@@ -1345,20 +1376,21 @@ class VistrailController(QtCore.QObject, BaseController):
                             if not self.progress.wasCanceled():
                                 self.progress.setValue(self.progress.value()+1)
                                 QtCore.QCoreApplication.processEvents()
+                    mCount += len(modifiedPipeline.modules)
                     if use_spreadsheet:
                         name = os.path.splitext(self.name)[0] + \
-                                             ("_%s_%s_%s" % pipelinePositions[pi])
+                                             ("_%s_%s_%s" % pipelinePosition)
                         extra_info['nameDumpCells'] = name
                         if 'pathDumpCells' in extra_info:
-                            images[pipelinePositions[pi]] = \
+                            images[pipelinePosition] = \
                                        os.path.join(extra_info['pathDumpCells'], name)
-                    pe_cell_id = (pe_log_id,) + pipelinePositions[pi]
+                    pe_cell_id = (pe_log_id,) + pipelinePosition
                     kwargs = {'locator': self.locator,
                               'job_monitor': self.jobMonitor,
                               'current_version': self.current_version,
                               'reason': 'Parameter Exploration %s %s_%s_%s' % pe_cell_id,
                               'logger': self.get_logger(),
-                              'actions': performedActions[pi],
+                              'actions': performedActions,
                               'extra_info': extra_info
                               }
                     if view:
@@ -1373,7 +1405,7 @@ class VistrailController(QtCore.QObject, BaseController):
 
                     # Create job
                     # check if a job exist for this workflow
-                    job_id = 'Parameter Exploration %s %s %s_%s_%s' % ((self.current_version, pe.id) + pipelinePositions[pi])
+                    job_id = 'Parameter Exploration %s %s %s_%s_%s' % ((self.current_version, pe.id) + pipelinePosition)
 
                     current_workflow = None
                     for wf in self.jobMonitor.workflows.itervalues():
@@ -1385,13 +1417,23 @@ class VistrailController(QtCore.QObject, BaseController):
                         current_workflow = JobWorkflow(job_id)
                         self.jobMonitor.startWorkflow(current_workflow)
                     try:
-                        result = interpreter.execute(modifiedPipelines[pi], **kwargs)
+                        result = interpreter.execute(modifiedPipeline, **kwargs)
                     finally:
                         self.jobMonitor.finishWorkflow()
 
+                    if sampler is not None and objective is not None:
+                        obj = result.objects.get(objective[0])
+                        if obj is not None and not result.errors:
+                            try:
+                                sampler.report(float(
+                                        obj.get_output(objective[1])))
+                            except (ModuleError, TypeError, ValueError), e:
+                                debug.warning("Couldn't get the objective "
+                                              "of the exploration", e)
+
                     for error in result.errors.itervalues():
                         if use_spreadsheet:
-                            pp = pipelinePositions[pi]
+                            pp = pipelinePosition
                             errors.append(((pp[1], pp[0], pp[2]), error))
                         else:
                             errors.append(((0,0,0), error))
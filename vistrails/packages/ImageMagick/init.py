@@ -37,6 +37,11 @@
 ##############################################################################
 # Changes
 #
+# 20261019
+#    Linear chains of Convert modules are executed as a single 'convert'
+#    invocation; intermediate files are only written if something else
+#    reads them
+#
 # 20130827 (by Remi)
 #    CombineRGBA can now also accept RGB
 #    Factored code common between Convert and CombineRGBA
@@ -62,9 +67,56 @@ from vistrails.core.modules.vistrails_module import Module, ModuleError, \
 from vistrails.core.system import list2cmdline
 
 import os
+import threading
 
 ################################################################################
 
+class ImageMagickFile(basic.PathObject):
+    """The output of a Convert module, which is only written when needed.
+
+    It records the input and the list of ImageMagick operators to apply to
+    it; a Convert module receiving it can append its own operators instead
+    of reading the file, so that a chain of operations runs a single
+    'convert' command. The file is written the first time its name is
+    requested.
+
+    """
+
+    def __init__(self, name, module, source, operators, fusable):
+        self._filename = name
+        self._written = False
+        self._lock = threading.Lock()
+        self.module = module
+        self.source = source
+        self.operators = operators
+        self.fusable = fusable
+        basic.PathObject.__init__(self, name)
+
+    def _get_name(self):
+        self.write()
+        return self._filename
+
+    def _set_name(self, name):
+        self._filename = name
+    name = property(_get_name, _set_name)
+
+    @property
+    def written(self):
+        return self._written
+
+    def write(self):
+        """write() -> None
+
+        Runs 'convert' to create the file, if it wasn't done already.
+
+        """
+        with self._lock:
+            if not self._written:
+                self.module.run(*([self.source] + self.operators +
+                                  [self._filename]))
+                self._written = True
+
+
 class ImageMagick(Module):
     """ImageMagick is the base Module for all Modules in the ImageMagick
     package. It simply defines some helper methods for subclasses.
@@ -128,10 +180,51 @@ package that transform a single input into a single output. Each subclass has
 a descriptive name of the operation it implements."""
 
     def compute(self):
+        self.convert()
+
+    def convert(self, *operators):
+        """convert(*operators) -> None
+
+        Sets the output to the input with the given ImageMagick operators
+        applied. If the input comes from another Convert module and wasn't
+        written, its operators are prepended to ours instead. The file is
+        written right away, unless it will only be read by a single Convert
+        module.
+
+        """
         o = self.create_output_file()
-        i = self.input_file_description()
-        self.run(i, o.name)
-        self.set_output("output", o)
+        i = self.get_input("input")
+        if (isinstance(i, ImageMagickFile) and i.fusable and
+                not i.written and not self.has_input('inputFormat')):
+            source = i.source
+            operators = i.operators + list(operators)
+        else:
+            source = self.input_file_description()
+            operators = list(operators)
+        output = ImageMagickFile(o.name, self, source, operators,
+                                 fusable=not self.has_input('outputFormat'))
+        if not self.output_is_converted():
+            output.write()
+        self.set_output("output", output)
+
+    def output_is_converted(self):
+        """output_is_converted() -> bool
+
+        Returns True if the output is only connected to a single Convert
+        module.
+
+        """
+        pipeline = self.moduleInfo['pipeline']
+        if pipeline is None:
+            return False
+        edges = pipeline.graph.edges_from(self.moduleInfo['moduleId'])
+        if len(edges) != 1:
+            return False
+        dest_id, conn_id = edges[0]
+        if pipeline.connections[conn_id].source.name != 'output':
+            return False
+        dest = pipeline.modules[dest_id]
+        return issubclass(dest.module_descriptor.module, Convert)
 
 
 class CombineRGBA(ImageMagick):
@@ -176,12 +269,7 @@ indicated by the appropriate ports (geometry or width and height)"""
             raise ModuleError(self, "Needs geometry or width/height")
 
     def compute(self):
-        o = self.create_output_file()
-        self.run(self.input_file_description(),
-                 "-scale",
-                 self.geometry_description(),
-                 o.name)
-        self.set_output("output", o)
+        self.convert("-scale", self.geometry_description())
 
 
 class GaussianBlur(Convert):
@@ -192,12 +280,7 @@ class GaussianBlur(Convert):
 
     def compute(self):
         (radius, sigma) = self.get_input('radiusSigma')
-        o = self.create_output_file()
-        self.run(self.input_file_description(),
-                 "-blur",
-                 "%sx%s" % (radius, sigma),
-                 o.name)
-        self.set_output("output", o)
+        self.convert("-blur", "%sx%s" % (radius, sigma))
 
 
 no_param_options = [("Negate", "-negate",
@@ -221,10 +304,7 @@ def no_param_options_method_dict(optionName):
     """
    
     def compute(self):
-        o = self.create_output_file()
-        i = self.input_file_description()
-        self.run(i, optionName, o.name)
-        self.set_output("output", o)
+        self.convert(optionName)
 
     return {'compute': compute}
 
@@ -242,11 +322,8 @@ def float_param_options_method_dict(optionName, portName):
     """
 
     def compute(self):
-        o = self.create_output_file()
         optionValue = self.get_input(portName)
-        i = self.input_file_description()
-        self.run(i, optionName, str(optionValue), o.name)
-        self.set_output("output", o)
+        self.convert(optionName, str(optionValue))
 
     return {'compute': compute}
 
@@ -298,3 +375,65 @@ def initialize():
 
 ################################################################################
 
+
+import unittest
+
+from vistrails.tests.utils import execute
+
+
+class TestConvertChains(unittest.TestCase):
+    identifier = 'org.vistrails.vistrails.imagemagick'
+
+    def setUp(self):
+        self.commands = []
+        def run(module, *args):
+            self.commands.append(list(args))
+            open(args[-1], 'w').close()
+        self.old_run = ImageMagick.run
+        ImageMagick.run = run
+
+    def tearDown(self):
+        ImageMagick.run = self.old_run
+
+    def test_chain(self):
+        """A linear chain runs a single command"""
+        self.assertFalse(execute([
+                ('Negate', self.identifier,
+                 [('input', [('File', '/tmp/in.png')])]),
+                ('Emboss', self.identifier,
+                 [('radius', [('Float', '2.0')])]),
+                ('Scale', self.identifier,
+                 [('geometry', [('String', '10x10')])]),
+            ],
+            [
+                (0, 'output', 1, 'input'),
+                (1, 'output', 2, 'input'),
+            ]))
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(self.commands[0][:-1],
+                         ['/tmp/in.png', '-negate', '-emboss', '2.0',
+                          '-scale', '10x10'])
+
+    def test_branch(self):
+        """An output read by several modules is written"""
+        self.assertFalse(execute([
+                ('Negate', self.identifier,
+                 [('input', [('File', '/tmp/in.png')])]),
+                ('VerticalFlip', self.identifier, []),
+                ('HorizontalFlip', self.identifier,
+                 [('outputFormat', [('String', 'jpg')])]),
+                ('Despeckle', self.identifier, []),
+            ],
+            [
+                (0, 'output', 1, 'input'),
+                (0, 'output', 2, 'input'),
+                (2, 'output', 3, 'input'),
+            ]))
+        commands = sorted(c[:-1] for c in self.commands)
+        negated = [c[-1] for c in self.commands if c[1] == '-negate'][0]
+        flopped = [c[-1] for c in self.commands if c[1] == '-flop'][0]
+        self.assertEqual(commands,
+                         sorted([['/tmp/in.png', '-negate'],
+                                 [negated, '-flip'],
+                                 [negated, '-flop'],
+                                 [flopped, '-despeckle']]))
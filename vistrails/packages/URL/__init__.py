@@ -41,9 +41,19 @@ without its associated data.
 
 This package uses a local cache, inside the per-user VisTrails directory. This
 way, files that haven't been changed do not need to be downloaded again. The
-check is performed efficiently using HTTP headers.
+check is performed efficiently using HTTP headers. Interrupted HTTP downloads
+are resumed, and the size of the cache can be limited with the
+'max_cache_size' option.
 """
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 from identifiers import *
+
+configuration = ConfigurationObject(
+        max_cache_size=(None, int),     # in MiB, unlimited if unset
+        connections=1,                  # per file, if the server allows it
+        segment_min_size=16*1024*1024,  # in bytes
+        directory_workers=4)
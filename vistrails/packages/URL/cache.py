@@ -0,0 +1,215 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Index of the files in the download cache.
+
+The index records the size and last use of each cached file so that the cache
+can be kept under a size limit without walking the directory on every
+download. It is persisted as a JSON file next to the cached files.
+"""
+
+from __future__ import division
+
+import json
+import os
+import threading
+import time
+
+from vistrails.core import debug
+
+
+INDEX_FILENAME = 'index.json'
+
+# Files kept next to a cached download, that go away with it
+AUXILIARY_SUFFIXES = ('.etag', '.part', '.part.etag')
+
+
+class CacheIndex(object):
+    """Keeps track of the files in a cache directory.
+
+    Entries map a file name (relative to the directory) to a ``(size,
+    last_used)`` pair. The total size is maintained as entries are added and
+    removed, and `evict()` deletes the least recently used files until the
+    cache fits in the given size.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = os.path.join(directory, INDEX_FILENAME)
+        self.entries = {}
+        self.total_size = 0
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Reads the index from disk, or rebuilds it from the directory.
+        """
+        with self._lock:
+            self.entries = {}
+            self.total_size = 0
+            try:
+                with open(self.filename, 'rb') as fp:
+                    entries = json.load(fp)
+            except (IOError, ValueError):
+                self.rebuild()
+                return
+            for name, (size, last_used) in entries.iteritems():
+                if os.path.isfile(os.path.join(self.directory, name)):
+                    self.entries[name] = (size, last_used)
+                    self.total_size += size
+
+    def rebuild(self):
+        """Scans the directory to recreate the index.
+        """
+        with self._lock:
+            self.entries = {}
+            self.total_size = 0
+            for name in os.listdir(self.directory):
+                if (name == INDEX_FILENAME or
+                        name.endswith(AUXILIARY_SUFFIXES)):
+                    continue
+                filename = os.path.join(self.directory, name)
+                if not os.path.isfile(filename):
+                    continue
+                stat = os.stat(filename)
+                self.entries[name] = (stat.st_size, stat.st_mtime)
+                self.total_size += stat.st_size
+            self.save()
+
+    def save(self):
+        with self._lock:
+            tmp = self.filename + '.tmp'
+            try:
+                with open(tmp, 'wb') as fp:
+                    json.dump(self.entries, fp)
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(tmp, self.filename)
+            except (IOError, OSError), e:
+                debug.warning("Couldn't save download cache index",
+                              e)
+
+    def touch(self, name, size=None):
+        """Records that a file was used, adding it to the index if needed.
+
+        If `size` is None, it is read from the file.
+        """
+        if size is None:
+            size = os.path.getsize(os.path.join(self.directory, name))
+        with self._lock:
+            old = self.entries.get(name)
+            if old is not None:
+                self.total_size -= old[0]
+            self.entries[name] = (size, time.time())
+            self.total_size += size
+            self.save()
+
+    def remove(self, name):
+        """Deletes a file and its auxiliary files from the cache.
+        """
+        with self._lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.total_size -= old[0]
+            for suffix in ('',) + AUXILIARY_SUFFIXES:
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except OSError:
+                    pass
+
+    def evict(self, max_size, keep=()):
+        """Removes least recently used files until the total fits max_size.
+
+        Files in `keep` are never removed. Returns the list of removed names.
+        """
+        removed = []
+        with self._lock:
+            if self.total_size <= max_size:
+                return removed
+            candidates = sorted((last_used, name)
+                                for name, (size, last_used)
+                                in self.entries.iteritems()
+                                if name not in keep)
+            for last_used, name in candidates:
+                if self.total_size <= max_size:
+                    break
+                self.remove(name)
+                removed.append(name)
+            self.save()
+        return removed
+
+
+###############################################################################
+
+import unittest
+
+
+class TestCacheIndex(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_test_urlcache_')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, size):
+        with open(os.path.join(self.directory, name), 'wb') as fp:
+            fp.write('x' * size)
+
+    def test_rebuild(self):
+        self.make_file('a', 10)
+        self.make_file('a.etag', 3)
+        self.make_file('b', 5)
+        index = CacheIndex(self.directory)
+        self.assertEqual(set(index.entries), set(['a', 'b']))
+        self.assertEqual(index.total_size, 15)
+        # Reloads from the saved index
+        index = CacheIndex(self.directory)
+        self.assertEqual(index.total_size, 15)
+
+    def test_evict(self):
+        index = CacheIndex(self.directory)
+        for i, name in enumerate(['a', 'b', 'c', 'd']):
+            self.make_file(name, 10)
+            index.touch(name)
+            index.entries[name] = (10, i)
+        self.make_file('a.etag', 3)
+        index.touch('b')
+        self.assertEqual(index.evict(25, keep=['c']), ['a', 'd'])
+        self.assertEqual(index.total_size, 20)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['b', 'c', INDEX_FILENAME])
+        self.assertEqual(index.evict(25), [])
@@ -40,7 +40,10 @@ from __future__ import division
 
 from HTMLParser import HTMLParser
 import os
+import Queue
 import re
+import sys
+import threading
 
 from .https_if_available import build_opener
 
@@ -92,24 +95,77 @@ class ListingParser(HTMLParser):
                     break
 
 
-def download_directory(url, target, insecure=False):
-    def mkdir():
-        if not mkdir.done:
-            try:
-                os.mkdir(target)
-            except OSError:
-                pass
-            mkdir.done = True
-    mkdir.done = False
+class DirectoryFetcher(object):
+    """Downloads a directory listing recursively.
 
-    opener = build_opener(insecure=insecure)
-    response = opener.open(url)
+    Listing pages and files are fetched by a bounded number of worker
+    threads; with a single worker, everything happens in the calling thread.
+    """
+    buffer_size = 4096
+
+    def __init__(self, insecure=False, workers=1):
+        self.opener = build_opener(insecure=insecure)
+        self.workers = max(1, workers)
+
+    def fetch(self, url, target):
+        if self.workers == 1:
+            pending = [(url, target)]
+            while pending:
+                pending.extend(self.fetch_one(*pending.pop()))
+            return
+
+        queue = Queue.Queue()
+        errors = []
+
+        def worker():
+            while True:
+                item = queue.get()
+                try:
+                    if item is None:
+                        return
+                    if not errors:
+                        for child in self.fetch_one(*item):
+                            queue.put(child)
+                except Exception:
+                    errors.append(sys.exc_info())
+                finally:
+                    queue.task_done()
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        queue.put((url, target))
+        queue.join()
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def fetch_one(self, url, target):
+        """Downloads a single URL to target.
+
+        Returns the list of (url, target) pairs found in it if it is a
+        listing, that still need to be downloaded.
+        """
+        response = self.opener.open(url)
+
+        if response.info().type != 'text/html':
+            with open(target, 'wb') as fp:
+                chunk = response.read(self.buffer_size)
+                while chunk:
+                    fp.write(chunk)
+                    chunk = response.read(self.buffer_size)
+            return []
 
-    if response.info().type == 'text/html':
         contents = response.read()
 
         parser = ListingParser(url)
         parser.feed(contents)
+        children = []
         for link in parser.links:
             link = resolve_link(link, url)
             if link[-1] == '/':
@@ -119,9 +175,13 @@ def download_directory(url, target, insecure=False):
             name = link.rsplit('/', 1)[1]
             if '?' in name:
                 continue
-            mkdir()
-            download_directory(link, os.path.join(target, name), insecure)
-        if not mkdir.done:
+            if not children:
+                try:
+                    os.mkdir(target)
+                except OSError:
+                    pass
+            children.append((link, os.path.join(target, name)))
+        if not children:
             # We didn't find anything to write inside this directory
             # Maybe it's a HTML file?
             if url[-1] != '/':
@@ -130,13 +190,11 @@ def download_directory(url, target, insecure=False):
                     target = target + '.html'
                 with open(target, 'wb') as fp:
                     fp.write(contents)
-    else:
-        buffer_size = 4096
-        with open(target, 'wb') as fp:
-            chunk = response.read(buffer_size)
-            while chunk:
-                fp.write(chunk)
-                chunk = response.read(buffer_size)
+        return children
+
+
+def download_directory(url, target, insecure=False, workers=1):
+    DirectoryFetcher(insecure, workers).fetch(url, target)
 
 
 ###############################################################################
@@ -48,8 +48,10 @@ from __future__ import division
 
 from datetime import datetime
 import email.utils
+import itertools
 import os
 import re
+import threading
 import urllib
 import urllib2
 
@@ -69,15 +71,19 @@ from vistrails.core.modules.vistrails_module import Module, ModuleError
 from vistrails.core.system import current_dot_vistrails, strptime
 from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
 
+from .cache import CacheIndex
 from .identifiers import identifier
 from .http_directory import download_directory
 from .https_if_available import build_opener
 
 
 package_directory = None
+cache_index = None
 
 MAX_CACHE_FILENAME = 100
 
+CHUNKSIZE = 4096
+
 
 ###############################################################################
 
@@ -91,9 +97,24 @@ def cache_filename(url):
         return url[:MAX_CACHE_FILENAME - 41] + "_" + hasher.hexdigest()
 
 
+_content_range = re.compile(r'^bytes ([0-9]+)-([0-9]+)/([0-9]+|\*)$')
+
+def content_range_start(response):
+    """Returns the first byte position from a Content-Range header, or None.
+    """
+    m = _content_range.match(response.headers.get('content-range', ''))
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
 ###############################################################################
 
 class Downloader(object):
+    # Whether a partial download is kept after an error, to be continued by
+    # the next attempt
+    resumable = False
+
     def __init__(self, url, module, insecure):
         self.url = url
         self.module = module
@@ -106,6 +127,8 @@ class Downloader(object):
         """
         self.local_filename = os.path.join(package_directory,
                                            cache_filename(self.url))
+        self.partial_filename = self.local_filename + '.part'
+        self.resume_from = 0
 
         # Before download
         self.pre_download()
@@ -149,31 +172,62 @@ class Downloader(object):
 
     def download(self, response):
         try:
-            dl_size = 0
-            CHUNKSIZE = 4096
-            f2 = open(self.local_filename, 'wb')
-            while True:
-                if self.size_header is not None:
-                    self.module.logging.update_progress(
-                            self.module,
-                            dl_size * 1.0/self.size_header)
-                chunk = response.read(CHUNKSIZE)
-                if not chunk:
-                    break
-                dl_size += len(chunk)
-                f2.write(chunk)
-            f2.close()
+            if self.resume_from:
+                f2 = open(self.partial_filename, 'ab')
+            else:
+                f2 = open(self.partial_filename, 'wb')
+            try:
+                dl_size = self.copy_stream(response, f2, self.resume_from)
+            finally:
+                f2.close()
             response.close()
-
+            if self.size_header is not None and dl_size < self.size_header:
+                raise IOError("Connection closed after %d of %d bytes" % (
+                              dl_size, self.size_header))
+            self.finish_partial()
         except Exception, e:
-            try:
-                os.unlink(self.local_filename)
-            except OSError:
-                pass
+            if not self.resumable:
+                self.discard_partial()
             raise ModuleError(
                     self.module,
                     "Error retrieving URL: %s" % debug.format_exception(e))
 
+    def copy_stream(self, response, fp, dl_size=0):
+        """Copies the response to fp, updating the module's progress.
+
+        Returns the total number of bytes in the file.
+        """
+        while True:
+            if self.size_header is not None:
+                self.module.logging.update_progress(
+                        self.module,
+                        dl_size * 1.0/self.size_header)
+            chunk = response.read(CHUNKSIZE)
+            if not chunk:
+                break
+            dl_size += len(chunk)
+            fp.write(chunk)
+        return dl_size
+
+    def finish_partial(self):
+        """Replaces the cached file with the completed partial download.
+        """
+        if os.path.exists(self.local_filename):
+            os.remove(self.local_filename)
+        os.rename(self.partial_filename, self.local_filename)
+        try:
+            os.remove(self.partial_filename + '.etag')
+        except OSError:
+            pass
+
+    def discard_partial(self):
+        for filename in (self.partial_filename,
+                         self.partial_filename + '.etag'):
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
     def post_download(self, response):
         pass
 
@@ -183,6 +237,14 @@ class Downloader(object):
 
 
 class HTTPDownloader(Downloader):
+    """Downloader for HTTP and HTTPS.
+
+    Interrupted downloads are continued using a Range request, provided the
+    remote file didn't change (If-Range). If the server accepts ranges, large
+    files can also be downloaded in segments over several connections.
+    """
+    resumable = True
+
     def pre_download(self):
         # Get ETag from disk
         try:
@@ -191,9 +253,34 @@ class HTTPDownloader(Downloader):
         except IOError:
             self.etag = None
 
+        # Check for a partial download left by a previous attempt
+        self.validator = None
+        try:
+            with open(self.partial_filename + '.etag') as validator_file:
+                self.validator = validator_file.read()
+            self.resume_from = os.path.getsize(self.partial_filename)
+        except (IOError, OSError):
+            self.resume_from = 0
+        if not self.validator:
+            self.resume_from = 0
+
     def send_request(self):
         try:
             request = urllib2.Request(self.url)
+            if self.resume_from:
+                request.add_header('Range', 'bytes=%d-' % self.resume_from)
+                request.add_header('If-Range', self.validator)
+                response = self.opener.open(request)
+                if response.getcode() == 206:
+                    if content_range_start(response) == self.resume_from:
+                        return response
+                    # Unexpected range, start over
+                    response.close()
+                    self.resume_from = 0
+                    return self.send_request()
+                # Remote file changed, this is the full new content
+                self.resume_from = 0
+                return response
             if self.etag is not None:
                 request.add_header(
                     'If-None-Match',
@@ -212,6 +299,11 @@ class HTTPDownloader(Downloader):
             if e.code == 304:
                 # Not modified
                 return None
+            elif e.code == 416 and self.resume_from:
+                # Range not satisfiable: the partial file is unusable
+                self.discard_partial()
+                self.resume_from = 0
+                return self.send_request()
             raise
 
     def read_headers(self, response):
@@ -220,12 +312,24 @@ class HTTPDownloader(Downloader):
         except KeyError:
             self.mod_header = None
         try:
-            size_header = response.headers['content-length']
+            if self.resume_from:
+                size_header = response.headers['content-range']
+                size_header = size_header.rsplit('/', 1)[1]
+            else:
+                size_header = response.headers['content-length']
             if not size_header:
                 raise ValueError
             self.size_header = int(size_header)
-        except (KeyError, ValueError):
+        except (KeyError, IndexError, ValueError):
             self.size_header = None
+        etag = response.headers.get('etag')
+        if etag and not etag.startswith('W/'):
+            self.validator = etag
+        elif self.mod_header:
+            self.validator = self.mod_header
+        else:
+            self.validator = None
+        self.accepts_ranges = response.headers.get('accept-ranges') == 'bytes'
         return True
 
     def _is_outdated(self):
@@ -246,9 +350,100 @@ class HTTPDownloader(Downloader):
         return remote_time > local_time
 
     def download(self, response):
-        if (not self.is_in_local_cache or
+        if (self.resume_from or not self.is_in_local_cache or
                 not self.mod_header or self._is_outdated()):
-            Downloader.download(self, response)
+            # Remember which version of the file we are getting, so that an
+            # interrupted download can be continued
+            if self.validator is not None:
+                with open(self.partial_filename + '.etag',
+                          'w') as validator_file:
+                    validator_file.write(self.validator)
+            else:
+                self.discard_partial()
+
+            connections = configuration.connections
+            if (connections > 1 and not self.resume_from and
+                    self.accepts_ranges and self.validator is not None and
+                    self.size_header is not None and
+                    self.size_header >= configuration.segment_min_size):
+                self.download_segmented(response, connections)
+            else:
+                Downloader.download(self, response)
+
+    def download_segmented(self, response, connections):
+        """Downloads the file in segments over several connections.
+
+        The first segment is read from the initial response, the others are
+        requested with Range headers. If something fails, the part of the
+        file that was received from the beginning is kept, so that the next
+        attempt can resume from there.
+        """
+        size = self.size_header
+        segment_size = -(-size // connections)
+        segments = [(start, min(start + segment_size, size))
+                    for start in xrange(0, size, segment_size)]
+        received = [0] * len(segments)
+        errors = []
+
+        def fetch(i, seg_response):
+            start, end = segments[i]
+            try:
+                if seg_response is None:
+                    request = urllib2.Request(self.url)
+                    request.add_header('Range',
+                                       'bytes=%d-%d' % (start, end - 1))
+                    request.add_header('If-Range', self.validator)
+                    seg_response = self.opener.open(request)
+                    if (seg_response.getcode() != 206 or
+                            content_range_start(seg_response) != start):
+                        raise IOError("Server didn't honor range request")
+                with open(self.partial_filename, 'r+b') as fp:
+                    fp.seek(start)
+                    while received[i] < end - start and not errors:
+                        chunk = seg_response.read(
+                                min(CHUNKSIZE, end - start - received[i]))
+                        if not chunk:
+                            raise IOError("Connection closed after %d of %d "
+                                          "bytes" % (received[i],
+                                                     end - start))
+                        fp.write(chunk)
+                        received[i] += len(chunk)
+                seg_response.close()
+            except Exception, e:
+                errors.append(e)
+
+        try:
+            with open(self.partial_filename, 'wb') as fp:
+                fp.truncate(size)
+            threads = [threading.Thread(target=fetch,
+                                        args=(i, response if i == 0 else None))
+                       for i in xrange(len(segments))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.2)
+                    self.module.logging.update_progress(
+                            self.module,
+                            sum(received) * 1.0/size)
+            if errors:
+                raise errors[0]
+            self.finish_partial()
+        except Exception, e:
+            # Keep the contiguous part received from the beginning
+            done = 0
+            for (start, end), length in itertools.izip(segments, received):
+                done = start + length
+                if length < end - start:
+                    break
+            try:
+                with open(self.partial_filename, 'r+b') as fp:
+                    fp.truncate(done)
+            except IOError:
+                self.discard_partial()
+            raise ModuleError(
+                    self.module,
+                    "Error retrieving URL: %s" % debug.format_exception(e))
 
     def post_download(self, response):
         try:
@@ -402,7 +597,24 @@ class DownloadFile(Module):
         """
         scheme = urllib2.splittype(url)[0]
         DL = downloaders.get(scheme, Downloader)
-        return DL(url, self, insecure).execute()
+        local_filename = DL(url, self, insecure).execute()
+        update_cache_index(local_filename)
+        return local_filename
+
+
+def update_cache_index(local_filename):
+    """Records the use of a cached file, and evicts old ones if needed.
+    """
+    if cache_index is None or not os.path.isfile(local_filename):
+        return
+    name = os.path.basename(local_filename)
+    cache_index.touch(name)
+    if configuration.check('max_cache_size'):
+        max_size = configuration.max_cache_size * 1024 * 1024
+        removed = cache_index.evict(max_size, keep=[name])
+        if removed:
+            debug.log("Removed %d files from the download cache" %
+                      len(removed))
 
 
 class HTTPDirectory(Module):
@@ -421,7 +633,8 @@ class HTTPDirectory(Module):
     def download(self, url, insecure):
         local_path = self.interpreter.filePool.create_directory(
                 prefix='vt_http').name
-        download_directory(url, local_path, insecure)
+        download_directory(url, local_path, insecure,
+                           workers=configuration.directory_workers)
         return local_path
 
 
@@ -532,6 +745,11 @@ def initialize(*args, **keywords):
     if renamed:
         debug.warning("Renamed %d downloaded cache files" % renamed)
 
+    global cache_index
+    cache_index = CacheIndex(package_directory)
+    if renamed:
+        cache_index.rebuild()
+
 
 def handle_module_upgrade_request(controller, module_id, pipeline):
     module_remap = {
@@ -584,6 +802,177 @@ class TestNaming(unittest.TestCase):
                          '_e1f69dccfec6f14cdb08f6041a2a43e63d21863d')
 
 
+class StandInHTTPServer(object):
+    """Local HTTP server serving a dict of files, for the tests.
+
+    It supports conditional and Range requests, listings of directories, and
+    can cut responses after a given byte position to simulate network errors.
+    """
+    def __init__(self, files):
+        import BaseHTTPServer
+        import SocketServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in.requests.append((self.path,
+                                          self.headers.get('Range')))
+                directory = self.path.rstrip('/') + '/'
+                if self.path in stand_in.files:
+                    self.send_file(stand_in.files[self.path])
+                elif any(f.startswith(directory) for f in stand_in.files):
+                    names = set(f[len(directory):].split('/', 1)[0] +
+                                ('/' if '/' in f[len(directory):] else '')
+                                for f in stand_in.files
+                                if f.startswith(directory))
+                    body = ''.join('<a href="%s">%s</a>\n' % (n, n)
+                                   for n in sorted(names))
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def send_file(self, data):
+                hasher = sha_hash()
+                hasher.update(data)
+                etag = '"%s"' % hasher.hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start, end = 0, len(data)
+                m = re.match(r'^bytes=([0-9]+)-([0-9]*)$',
+                             self.headers.get('Range', ''))
+                if m is not None and self.headers.get('If-Range',
+                                                      etag) == etag:
+                    start = int(m.group(1))
+                    if m.group(2):
+                        end = int(m.group(2)) + 1
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                                     start, end - 1, len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.end_headers()
+                if stand_in.cut_at is not None:
+                    end = max(start, min(end, stand_in.cut_at))
+                self.wfile.write(data[start:end])
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        stand_in = self
+        self.files = files
+        self.requests = []
+        self.cut_at = None
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class FakeModule(object):
+    class logging(object):
+        @staticmethod
+        def update_progress(module, progress):
+            pass
+
+
+class TestHTTPDownloader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from vistrails.core.packagemanager import get_package_manager
+        from vistrails.core.modules.module_registry import MissingPackage
+        pm = get_package_manager()
+        try:
+            pm.get_package('org.vistrails.vistrails.http')
+        except MissingPackage:
+            pm.late_enable_package('URL')
+
+    def setUp(self):
+        import tempfile
+        global package_directory
+        self.old_directory = package_directory
+        package_directory = tempfile.mkdtemp(prefix='vt_test_http_')
+        self.old_connections = configuration.connections
+        self.old_min_size = configuration.segment_min_size
+        self.data = ''.join(chr(i % 251) for i in xrange(100000))
+        self.server = StandInHTTPServer({'/file.bin': self.data})
+        self.url = self.server.url + '/file.bin'
+
+    def tearDown(self):
+        import shutil
+        global package_directory
+        self.server.close()
+        configuration.connections = self.old_connections
+        configuration.segment_min_size = self.old_min_size
+        shutil.rmtree(package_directory)
+        package_directory = self.old_directory
+
+    def download(self):
+        filename = HTTPDownloader(self.url, FakeModule(), False).execute()
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def test_download(self):
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.server.requests, [('/file.bin', None)] * 2)
+
+    def test_resume(self):
+        self.server.cut_at = 30000
+        self.assertRaises(ModuleError, self.download)
+        self.server.cut_at = None
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.server.requests,
+                         [('/file.bin', None), ('/file.bin', 'bytes=30000-')])
+
+    def test_resume_changed(self):
+        self.server.cut_at = 30000
+        self.assertRaises(ModuleError, self.download)
+        self.server.cut_at = None
+        self.data = self.data[::-1]
+        self.server.files['/file.bin'] = self.data
+        self.assertEqual(self.download(), self.data)
+
+    def test_segmented(self):
+        configuration.connections = 3
+        configuration.segment_min_size = 1000
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(sorted(self.server.requests),
+                         [('/file.bin', None),
+                          ('/file.bin', 'bytes=33334-66667'),
+                          ('/file.bin', 'bytes=66668-99999')])
+
+    def test_segmented_resume(self):
+        configuration.connections = 3
+        configuration.segment_min_size = 1000
+        self.server.cut_at = 50000
+        self.assertRaises(ModuleError, self.download)
+        self.server.cut_at = None
+        self.server.requests = []
+        self.assertEqual(self.download(), self.data)
+        # The first segment was complete, the second one might be partial
+        self.assertEqual(len(self.server.requests), 1)
+        m = re.match(r'^bytes=([0-9]+)-$', self.server.requests[0][1])
+        self.assertTrue(33334 <= int(m.group(1)) <= 50000)
+
+
 class TestDownloadFile(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -643,6 +1032,33 @@ class TestHTTPDirectory(unittest.TestCase):
         finally:
             shutil.rmtree(testdir)
 
+    def test_download_concurrent(self):
+        import shutil
+        import tempfile
+        server = StandInHTTPServer({'/test/a': 'aa\n',
+                                    '/test/bb': 'bb\n',
+                                    '/test/cc/d': 'dd\n',
+                                    '/test/cc/e/f': 'ff\n'})
+        testdir = tempfile.mkdtemp(prefix='vt_test_http_')
+        try:
+            download_directory(server.url + '/test/', testdir, workers=3)
+            files = {}
+            for dirpath, dirnames, filenames in os.walk(testdir):
+                for name in filenames:
+                    filename = os.path.join(dirpath, name)
+                    with open(filename, 'rb') as f:
+                        files[filename[len(testdir) + 1:]
+                              .replace(os.sep, '/')] = f.read()
+            self.assertEqual(files, {
+                    'a': 'aa\n',
+                    'bb': 'bb\n',
+                    'cc/d': 'dd\n',
+                    'cc/e/f': 'ff\n',
+                })
+        finally:
+            server.close()
+            shutil.rmtree(testdir)
+
 
 if __name__ == '__main__':
     unittest.main()
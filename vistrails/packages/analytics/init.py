@@ -35,9 +35,12 @@
 ###############################################################################
 from __future__ import division
 
+import datetime
+
 from vistrails.core.modules.vistrails_module import Module, ModuleError
 import vistrails.core.vistrail.vistrail
 import vistrails.core.log.log 
+from vistrails.core.log.store import ExecutionStore
 import vistrails.db.services.io
 
 
@@ -175,8 +178,62 @@ class TotalDays(Module):
         totals = self.calc_time(vistrail)
         self.set_output('completed', totals)
 
+class StoreLog(Module):
+    """Adds the executions in a log to an execution store.
+
+    Executions that are already in the store are skipped, so a log can
+    be added again after it grows.
+    """
+    _input_ports = [('log', '(Log)'),
+                    ('store', '(basic:File)'),
+                    ('vistrail', '(basic:String)', {'optional': True})]
+    _output_ports = [('store', '(basic:File)'),
+                     ('added', '(basic:Integer)')]
+
+    def compute(self):
+        log = self.get_input('log')
+        store_file = self.get_input('store')
+        store = ExecutionStore(store_file.name)
+        try:
+            added = store.add_log(log, self.force_get_input('vistrail'))
+        finally:
+            store.close()
+        self.set_output('store', store_file)
+        self.set_output('added', added)
+
+class ExecutionStats(Module):
+    """Computes the compute times and failure rates of each module from
+    an execution store.
+
+    Statistics can be limited to a vistrail, a version, a module name or
+    to the last days.
+    """
+    _input_ports = [('store', '(basic:File)'),
+                    ('vistrail', '(basic:String)', {'optional': True}),
+                    ('version', '(basic:Integer)', {'optional': True}),
+                    ('moduleName', '(basic:String)', {'optional': True}),
+                    ('days', '(basic:Integer)', {'optional': True})]
+    _output_ports = [('stats', '(basic:Dictionary)')]
+
+    def compute(self):
+        since = None
+        if self.has_input('days'):
+            since = (datetime.datetime.now() -
+                     datetime.timedelta(days=self.get_input('days')))
+        store = ExecutionStore(self.get_input('store').name)
+        try:
+            stats = store.module_stats(
+                    vistrail=self.force_get_input('vistrail'),
+                    version=self.force_get_input('version'),
+                    module_name=self.force_get_input('moduleName'),
+                    since=since)
+        finally:
+            store.close()
+        self.set_output('stats', dict((s['module_name'], s) for s in stats))
+
 #class TimevsTags(Module):
     #Compare a few workflows to see how long the project took vs. how many tags were made
  #   pass
 
-_modules = [Vistrail, Log, ReadVistrail, CountActions, CountExecutedWorkflows, TotalDays]
+_modules = [Vistrail, Log, ReadVistrail, CountActions, CountExecutedWorkflows, TotalDays,
+            StoreLog, ExecutionStats]
@@ -36,9 +36,14 @@
 from __future__ import division
 
 import copy
+from itertools import izip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
 
 from vistrails.core.modules.vistrails_module import Module, ModuleError, \
-    InvalidOutput, ModuleSuspended, ModuleWasSuspended
+    InvalidOutput, ModuleSuspended, ModuleWasSuspended, ExecutionContext
 
 ###############################################################################
 ## Fold Operator
@@ -50,9 +55,13 @@ class Fold(Module):
     aggregates its element one by one to get the final result, such as Sum.
 
     To use it, create a subclass and override the setInitialValue() and
-    operation() methods.
+    operation() methods. If operation() is associative, also define
+    combine(partialResult, chunkResult), which merges the results of two
+    consecutive parts of the list, each folded from the initial value.
     """
 
+    combine = None
+
     def __init__(self):
         Module.__init__(self)
 
@@ -83,12 +92,42 @@ class Fold(Module):
 
 ###############################################################################
 
+class _SerializedLogging(object):
+    """Forwards calls to a logger while holding a lock.
+
+    The log controllers are not thread-safe; the function modules updated
+    from worker threads log through this instead.
+    """
+    def __init__(self, logging, lock):
+        self._logging = logging
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._logging, name)
+        if not callable(attr):
+            if hasattr(attr, '__dict__'):
+                return _SerializedLogging(attr, self._lock)
+            return attr
+        def call(*args, **kwargs):
+            with self._lock:
+                result = attr(*args, **kwargs)
+            if hasattr(result, '__dict__'):
+                return _SerializedLogging(result, self._lock)
+            return result
+        return call
+
+
 class FoldWithModule(Fold):
     """Implementation of Fold that uses another module as its operation.
 
     This can be used to create structures like Map or Filter, where another
     module will be called with each element of the list to retrieve something
     that this module will use.
+
+    If 'Workers' is set to more than 1 (or less than 1, for the number of
+    processors), the elements are split into chunks of 'ChunkSize' that are
+    run from a pool of threads; this helps for function modules that release
+    the GIL, e.g. by running external commands or native code.
     """
 
     def update_upstream(self):
@@ -149,58 +188,181 @@ class FoldWithModule(Fold):
         else:
             element_is_iter = True
             inputList = rawInputList
-        suspended = []
-        loop = self.logging.begin_loop_execution(self, len(inputList))
-        ## Update everything for each value inside the list
-        for i, element in enumerate(inputList):
-            self.logging.update_progress(self, float(i)/len(inputList))
-            if element_is_iter:
-                self.element = element
-            else:
-                self.element = element[0]
-            do_operation = True
+        self.element_is_iter = element_is_iter
+
+        ## Type checking
+        if not self.upToDate and inputList: # pragma: no branch
             for connector in self.inputPorts.get('FunctionPort'):
-                module = copy.copy(connector.obj)
+                self.typeChecking(connector.obj, nameInput, inputList)
 
-                if not self.upToDate: # pragma: no branch
-                    ## Type checking
-                    if i == 0:
-                        self.typeChecking(module, nameInput, inputList)
+        workers = self.force_get_input('Workers', 1)
+        if workers < 1:
+            workers = multiprocessing.cpu_count()
+        loop = self.logging.begin_loop_execution(self, len(inputList))
+        if workers == 1 or len(inputList) <= 1:
+            suspended = self.runSequential(loop, nameInput, nameOutput,
+                                           inputList)
+        else:
+            suspended = self.runParallel(loop, nameInput, nameOutput,
+                                         inputList, workers)
 
-                    module.upToDate = False
-                    module.computed = False
+        if suspended:
+            raise ModuleSuspended(
+                    self,
+                    "function module suspended in %d/%d iterations" % (
+                            len(suspended), len(inputList)),
+                    children=suspended)
+        loop.end_loop_execution()
 
-                    self.setInputValues(module, nameInput, element, i)
+    def runIteration(self, loop, nameInput, nameOutput, inputList, i,
+                     logging=None):
+        """runIteration(loop, nameInput: list, nameOutput: str,
+                        inputList: list, i: int, logging) -> (object, list)
+        Updates a copy of the modules connected to FunctionPort for the
+        i-th element of the list. Returns the result and the list of
+        ModuleSuspended exceptions, which is empty if it succeeded.
+        """
+        suspended = []
+        elementResult = None
+        for connector in self.inputPorts.get('FunctionPort'):
+            module = copy.copy(connector.obj)
+            if logging is not None:
+                module.logging = logging
 
-                loop.begin_iteration(module, i)
+            if not self.upToDate: # pragma: no branch
+                module.upToDate = False
+                module.computed = False
 
-                try:
-                    module.update()
-                except ModuleSuspended, e:
-                    suspended.append(e)
-                    do_operation = False
-                    loop.end_iteration(module)
-                    continue
+                self.setInputValues(module, nameInput, inputList[i], i)
 
+            loop.begin_iteration(module, i)
+
+            try:
+                module.update()
+            except ModuleSuspended, e:
+                suspended.append(e)
                 loop.end_iteration(module)
+                continue
+
+            loop.end_iteration(module)
+
+            ## Getting the result from the output port
+            if nameOutput not in module.outputPorts:
+                raise ModuleError(module,
+                                  'Invalid output port: %s' % nameOutput)
+            elementResult = module.get_output(nameOutput)
+        return elementResult, suspended
 
-                ## Getting the result from the output port
-                if nameOutput not in module.outputPorts:
-                    raise ModuleError(module,
-                                      'Invalid output port: %s' % nameOutput)
-                self.elementResult = module.get_output(nameOutput)
-            if do_operation:
-                self.operation()
+    def applyIteration(self, element, elementResult):
+        """Calls operation() for an element of the list and its result."""
+
+        if self.element_is_iter:
+            self.element = element
+        else:
+            self.element = element[0]
+        self.elementResult = elementResult
+        self.operation()
+
+    def runSequential(self, loop, nameInput, nameOutput, inputList):
+        """Updates the function module for each value inside the list, in
+        order. Returns the ModuleSuspended exceptions."""
+
+        suspended = []
+        for i, element in enumerate(inputList):
+            self.logging.update_progress(self, float(i)/len(inputList))
+            elementResult, element_suspended = self.runIteration(
+                    loop, nameInput, nameOutput, inputList, i)
+            if element_suspended:
+                suspended.extend(element_suspended)
+            else:
+                self.applyIteration(element, elementResult)
 
             self.logging.update_progress(self, i * 1.0 / len(inputList))
+        return suspended
 
-        if suspended:
-            raise ModuleSuspended(
-                    self,
-                    "function module suspended in %d/%d iterations" % (
-                            len(suspended), len(inputList)),
-                    children=suspended)
-        loop.end_loop_execution()
+    def runParallel(self, loop, nameInput, nameOutput, inputList, workers):
+        """Updates the function module over chunks of the list from a pool
+        of worker threads. Returns the ModuleSuspended exceptions.
+
+        The results are given to operation() in the order of the list; if
+        the Fold can combine() results, each chunk is folded as soon as it
+        is done instead. The log is written to from one thread at a time.
+        """
+        count = len(inputList)
+        chunkSize = self.force_get_input('ChunkSize', 0)
+        if chunkSize < 1:
+            chunkSize = max(1, -(-count // (workers * 4)))
+        chunks = [xrange(start, min(start + chunkSize, count))
+                  for start in xrange(0, count, chunkSize)]
+
+        lock = threading.RLock()
+        logging = _SerializedLogging(self.logging, lock)
+        loop = _SerializedLogging(loop, lock)
+        stack = ExecutionContext.current_stack()
+        stop = []
+
+        def run_chunk(args):
+            c, chunk = args
+            results = []
+            with ExecutionContext.adopted(stack):
+                for i in chunk:
+                    if stop:
+                        break
+                    try:
+                        results.append(self.runIteration(
+                                loop, nameInput, nameOutput, inputList, i,
+                                logging))
+                    except Exception:
+                        stop.append(c)
+                        return c, results, sys.exc_info()
+            return c, results, None
+
+        def fold_chunk(c, results):
+            for i, (elementResult, element_suspended) in izip(chunks[c],
+                                                              results):
+                if element_suspended:
+                    suspended[c].extend(element_suspended)
+                else:
+                    self.applyIteration(inputList[i], elementResult)
+
+        suspended = [[] for chunk in chunks]
+        errors = {}
+        pending = {}
+        partials = {}
+        next_chunk = 0
+        done = 0
+        pool = ThreadPool(min(workers, len(chunks)))
+        try:
+            for c, results, error in pool.imap_unordered(run_chunk,
+                                                         enumerate(chunks)):
+                if error is not None:
+                    errors[c] = error
+                elif self.combine is not None:
+                    partialResult = self.partialResult
+                    self.setInitialValue()
+                    self.partialResult = self.initialValue
+                    fold_chunk(c, results)
+                    partials[c] = self.partialResult
+                    self.partialResult = partialResult
+                else:
+                    pending[c] = results
+                    while next_chunk in pending:
+                        fold_chunk(next_chunk, pending.pop(next_chunk))
+                        next_chunk += 1
+                done += len(chunks[c])
+                with lock:
+                    self.logging.update_progress(self, done * 1.0 / count)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if errors:
+            error = errors[min(errors)]
+            raise error[0], error[1], error[2]
+        for c in sorted(partials):
+            self.partialResult = self.combine(self.partialResult,
+                                              partials[c])
+        return [e for chunk_suspended in suspended for e in chunk_suspended]
 
     def compute(self):
         """The compute method for the Fold."""
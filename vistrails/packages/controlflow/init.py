@@ -89,6 +89,10 @@ def initialize(*args,**keywords):
     reg.add_input_port(FoldWithModule, 'FunctionPort', (Module, ""))
     reg.add_input_port(FoldWithModule, 'InputPort', (List, ""))
     reg.add_input_port(FoldWithModule, 'OutputPort', (String, ""))
+    reg.add_input_port(FoldWithModule, 'Workers', (Integer, ""),
+                       optional=True, defaults="['1']")
+    reg.add_input_port(FoldWithModule, 'ChunkSize', (Integer, ""),
+                       optional=True)
 
     reg.add_output_port(Map, 'Result', (List, ""))
 
@@ -55,6 +55,12 @@ class Map(FoldWithModule):
 
         self.partialResult.append(self.elementResult)
 
+    def combine(self, partialResult, chunkResult):
+        """Appending the results of a chunk..."""
+
+        partialResult.extend(chunkResult)
+        return partialResult
+
 
 class Filter(FoldWithModule):
     """A Filter module, that returns in a list only the results that satisfy a
@@ -75,6 +81,12 @@ list must return a boolean result.')
         if self.elementResult:
             self.partialResult.append(self.element)
 
+    def combine(self, partialResult, chunkResult):
+        """Appending the elements kept from a chunk..."""
+
+        partialResult.extend(chunkResult)
+        return partialResult
+
 
 class Sum(Fold):
     """A Sum module, that computes the sum of the elements in a list."""
@@ -89,6 +101,11 @@ class Sum(Fold):
 
         self.partialResult += self.element
 
+    def combine(self, partialResult, chunkResult):
+        """Adding the sum of a chunk..."""
+
+        return partialResult + chunkResult
+
 
 class And(Fold):
     """An And module, that computes the And result among the elements
@@ -104,6 +121,11 @@ class And(Fold):
 
         self.partialResult = self.partialResult and bool(self.element)
 
+    def combine(self, partialResult, chunkResult):
+        """Combining the result of a chunk..."""
+
+        return partialResult and chunkResult
+
 
 class Or(Fold):
     """An Or module, that computes the Or result among the elements
@@ -119,6 +141,11 @@ class Or(Fold):
 
         self.partialResult = self.partialResult or self.element
 
+    def combine(self, partialResult, chunkResult):
+        """Combining the result of a chunk..."""
+
+        return partialResult or chunkResult
+
 
 ###############################################################################
 
@@ -205,6 +232,58 @@ class TestMap(unittest.TestCase):
                 ]))
         self.assertEqual(results, [[3, 11, 1]])
 
+    def do_parallel(self, src, input_list, workers='4', chunk_size='3'):
+        src = urllib2.quote(src)
+        with intercept_result(Map, 'Result') as results:
+            errors = execute([
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', src)]),
+                    ]),
+                    ('Map', 'org.vistrails.vistrails.control_flow', [
+                        ('InputPort', [('List', "['i']")]),
+                        ('OutputPort', [('String', 'o')]),
+                        ('InputList', [('List', repr(input_list))]),
+                        ('Workers', [('Integer', workers)]),
+                        ('ChunkSize', [('Integer', chunk_size)]),
+                    ]),
+                ],
+                [
+                    (0, 'self', 1, 'FunctionPort'),
+                ],
+                add_port_specs=[
+                    (0, 'input', 'i',
+                     'org.vistrails.vistrails.basic:Integer'),
+                    (0, 'output', 'o',
+                     'org.vistrails.vistrails.basic:Integer'),
+                ])
+        return errors, results
+
+    def test_parallel(self):
+        """Chunks run in any order but results are kept in order"""
+        src = ('import time\n'
+               'time.sleep((i % 3) * 0.005)\n'
+               'o = i * 2')
+        combine = Map.__dict__['combine']
+        try:
+            for Map.combine in (combine, None):
+                errors, results = self.do_parallel(src, range(20))
+                self.assertFalse(errors)
+                self.assertEqual(results, [range(0, 40, 2)])
+        finally:
+            Map.combine = combine
+        errors, results = self.do_parallel(src, range(5), '0', '0')
+        self.assertFalse(errors)
+        self.assertEqual(results, [range(0, 10, 2)])
+
+    def test_parallel_error(self):
+        errors, results = self.do_parallel(
+                'if i == 7: raise ValueError("seven")\n'
+                'o = i',
+                range(20))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("seven", errors.values()[0].msg)
+        self.assertEqual(results, [])
+
 
 class TestUtils(unittest.TestCase):
     def test_filter(self):
@@ -42,8 +42,21 @@ VisTrails. We are going to use the 'Qt4Agg' backend of the library.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 from identifiers import *
 
+# Figures written to files are rendered off-screen, in-process unless
+# render_processes is set to a number of worker processes; figures that the
+# workers fail to draw are only reported later, when more figures are
+# submitted or the package is finalized. If cache_renderings is set, they
+# are copied from a cache of rendered images in ~/.vistrails/mpl_renderings
+# if the pipeline didn't change; cache_renderings_size is its maximum size
+# in megabytes (100 if unset).
+configuration = ConfigurationObject(render_processes=(None, int),
+                                    cache_renderings=(None, bool),
+                                    cache_renderings_size=(None, int))
+
 def package_dependencies():
     import vistrails.core.packagemanager
     manager = vistrails.core.packagemanager.get_package_manager()
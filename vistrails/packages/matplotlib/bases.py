@@ -39,8 +39,6 @@ from __future__ import division
 import pylab
 import urllib
 
-from matplotlib.backend_bases import FigureCanvasBase
-
 from vistrails.core.configuration import ConfigField
 from vistrails.core.modules.basic_modules import CodeRunnerMixin
 from vistrails.core.modules.config import ModuleSettings, IPort
@@ -48,6 +46,8 @@ from vistrails.core.modules.output_modules import ImageFileMode, \
     ImageFileModeConfig, OutputModule, IPythonModeConfig, IPythonMode
 from vistrails.core.modules.vistrails_module import Module, NotCacheable
 
+from render import get_renderer
+
 ################################################################################
 
 class MplProperties(Module):
@@ -125,6 +125,28 @@ class MplContourSet(Module):
 class MplQuadContourSet(MplContourSet):
     pass
 
+def upstream_cacheable(module):
+    """upstream_cacheable(module: Module) -> bool
+
+    Returns whether all the modules upstream of this one are cacheable, so
+    that its signature identifies its inputs.
+    """
+    seen = set()
+    stack = [connector.obj
+             for connectors in module.inputPorts.itervalues()
+             for connector in connectors]
+    while stack:
+        upstream = stack.pop()
+        if id(upstream) in seen:
+            continue
+        seen.add(id(upstream))
+        if not upstream.is_cacheable():
+            return False
+        stack.extend(connector.obj
+                     for connectors in upstream.inputPorts.itervalues()
+                     for connector in connectors)
+    return True
+
 class MplFigureToFile(ImageFileMode):
     config_cls = ImageFileModeConfig
     formats = ['pdf', 'png', 'jpg']
@@ -136,15 +158,13 @@ class MplFigureToFile(ImageFileMode):
         img_format = self.get_format(configuration)
         filename = self.get_filename(configuration, suffix='.%s' % img_format)
 
-        w_inches = w / 72.0
-        h_inches = h / 72.0
-
-        previous_size = tuple(figure.get_size_inches())
-        figure.set_size_inches(w_inches, h_inches)
-        canvas = FigureCanvasBase(figure)
-        canvas.print_figure(filename, dpi=72, format=img_format)
-        figure.set_size_inches(previous_size[0],previous_size[1])
-        canvas.draw()
+        renderer = get_renderer()
+        signature = None
+        if (renderer.cache_dir is not None and
+                upstream_cacheable(output_module)):
+            signature = output_module.signature
+        renderer.render(figure, filename, w, h, img_format,
+                        signature=signature)
 
 class MplIPythonModeConfig(IPythonModeConfig):
     mode_type = "ipython"
@@ -39,8 +39,11 @@ from __future__ import division
 import matplotlib
 matplotlib.use('Qt4Agg', warn=False)
 
+import os
+
 import vistrails.core.modules.module_registry
 import vistrails.core.db.action
+from vistrails.core.system import current_dot_vistrails
 from vistrails.core.vistrail.module import Module
 from vistrails.core.vistrail.operation import AddOp
 
@@ -48,6 +51,7 @@ from bases import _modules as _base_modules, MplFigureOutput
 from plots import _modules as _plot_modules
 from artists import _modules as _artist_modules
 from identifiers import identifier
+from render import FigureRenderer, set_renderer
 
 ################################################################################
 
@@ -62,6 +66,22 @@ def initialize(*args, **kwargs):
         _modules.append(MplFigureCell)
         MplFigureOutput.register_output_mode(MplFigureToSpreadsheet)
 
+    # failures of the worker processes are only reported later, so they
+    # are only used if asked for
+    processes = configuration.check('render_processes') or 0
+    cache_dir = None
+    if configuration.check('cache_renderings'):
+        cache_dir = os.path.join(current_dot_vistrails(), 'mpl_renderings')
+    if configuration.has('cache_renderings_size'):
+        cache_size = configuration.cache_renderings_size * 1024 * 1024
+        set_renderer(FigureRenderer(processes, cache_dir, cache_size))
+    else:
+        set_renderer(FigureRenderer(processes, cache_dir))
+
+def finalize():
+    # writes the figures still being rendered
+    set_renderer(FigureRenderer())
+
 def handle_module_upgrade_request(controller, module_id, pipeline):
     from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
     create_new_connection = UpgradeWorkflowHandler.create_new_connection
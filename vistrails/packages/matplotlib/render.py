@@ -0,0 +1,360 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Off-screen rendering of figures to image files.
+
+Figures are drawn with the Agg backend, either in the current process or by
+a pool of worker processes, to which they are sent pickled. Rendered images
+can be kept in a cache directory, keyed by the signature of the pipeline
+that created the figure and the output settings, so that an unchanged figure
+is only copied instead of being drawn again. The least recently used images
+are removed when the cache grows over its maximum size.
+"""
+
+from __future__ import division
+
+import cPickle
+import hashlib
+import multiprocessing
+import os
+import shutil
+import threading
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from vistrails.core import debug
+
+
+def draw_figure(figure, filename, width, height, img_format, dpi=72):
+    """draw_figure(figure: Figure, filename: str, width: int, height: int,
+                   img_format: str, dpi: int) -> None
+
+    Draws the figure to a file with Agg, at the given size in pixels.
+    """
+    previous_size = tuple(figure.get_size_inches())
+    previous_canvas = figure.canvas
+    figure.set_size_inches(width / dpi, height / dpi)
+    try:
+        canvas = FigureCanvasAgg(figure)
+        canvas.print_figure(filename, dpi=dpi, format=img_format)
+    finally:
+        figure.set_size_inches(previous_size[0], previous_size[1])
+        if previous_canvas is not None:
+            figure.set_canvas(previous_canvas)
+
+
+def dump_figure(figure):
+    """dump_figure(figure: Figure) -> str
+
+    Pickles a figure so that it can be loaded outside of pylab.
+    """
+    state = figure.__getstate__()
+    # don't try to register the figure with pylab in the worker
+    state['_restore_to_pylab'] = False
+    return cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_figure(data):
+    """load_figure(data: str) -> Figure
+
+    Loads a figure pickled by dump_figure().
+    """
+    figure = Figure.__new__(Figure)
+    figure.__setstate__(cPickle.loads(data))
+    return figure
+
+
+def store_file(filename, cache_filename):
+    """store_file(filename: str, cache_filename: str) -> None
+
+    Copies a rendered file to the cache, atomically.
+    """
+    temp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+    shutil.copyfile(filename, temp_filename)
+    os.rename(temp_filename, cache_filename)
+
+
+def render_job(data, filename, width, height, img_format,
+               cache_filename=None):
+    """Renders a pickled figure; this runs in the worker processes.
+    """
+    draw_figure(load_figure(data), filename, width, height, img_format)
+    if cache_filename is not None:
+        store_file(filename, cache_filename)
+
+
+class FigureRenderer(object):
+    """Renders figures to files, possibly in parallel and from a cache.
+
+    If processes is not 0, figures are rendered asynchronously by that many
+    worker processes; wait() blocks until all the files have been written.
+    If cache_dir is set, rendered files are copied there and used again for
+    figures with the same signature; the least recently used ones are
+    removed when the cache holds more than cache_size bytes.
+    """
+    def __init__(self, processes=0, cache_dir=None,
+                 cache_size=100 * 1024 * 1024):
+        self.processes = processes
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._cache_used = None
+        self._pool = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def cache_filename(self, signature, width, height, img_format):
+        """cache_filename(signature: str, width: int, height: int,
+                          img_format: str) -> str
+
+        Returns the file in the cache for a figure rendered with these
+        settings, or None if there is no cache.
+        """
+        if self.cache_dir is None or signature is None:
+            return None
+        key = hashlib.sha1(repr((signature, width, height, img_format)))
+        return os.path.join(self.cache_dir,
+                            '%s.%s' % (key.hexdigest(), img_format))
+
+    def render(self, figure, filename, width, height, img_format,
+               signature=None):
+        """render(figure: Figure, filename: str, width: int, height: int,
+                  img_format: str, signature: str) -> None
+
+        Renders the figure to a file, or copies it from the cache if a
+        figure with the same signature was already rendered.
+        """
+        cache_filename = self.cache_filename(signature, width, height,
+                                             img_format)
+        if cache_filename is not None and os.path.exists(cache_filename):
+            shutil.copyfile(cache_filename, filename)
+            # marks it as recently used
+            try:
+                os.utime(cache_filename, None)
+            except OSError:
+                pass
+            return
+
+        if self.processes:
+            try:
+                data = dump_figure(figure)
+            except Exception, e:
+                debug.log("Can't pickle figure, rendering it in-process",
+                          debug.format_exception(e))
+            else:
+                self._submit(filename, cache_filename,
+                             (data, filename, width, height, img_format,
+                              cache_filename))
+                return
+
+        draw_figure(figure, filename, width, height, img_format)
+        if cache_filename is not None:
+            store_file(filename, cache_filename)
+            with self._lock:
+                self._cache_stored(cache_filename)
+
+    def _cache_stored(self, cache_filename):
+        """Accounts for a new file in the cache, removing the least
+        recently used ones if it is over its maximum size.
+        """
+        if self._cache_used is not None:
+            try:
+                self._cache_used += os.path.getsize(cache_filename)
+            except OSError:
+                pass
+            if self._cache_used <= self.cache_size:
+                return
+
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        used = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if used <= self.cache_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+        self._cache_used = used
+
+    def _submit(self, filename, cache_filename, args):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            # don't let the queue of pickled figures grow without bounds
+            while len(self._pending) >= self.processes * 4:
+                self._collect(*self._pending.pop(0))
+            self._pending.append((filename, cache_filename,
+                                  self._pool.apply_async(render_job, args)))
+
+    def _collect(self, filename, cache_filename, result):
+        try:
+            result.get()
+        except Exception, e:
+            debug.critical("Couldn't render figure to %s" % filename,
+                           debug.format_exception(e))
+        else:
+            if cache_filename is not None:
+                self._cache_stored(cache_filename)
+
+    def wait(self):
+        """wait() -> None
+
+        Waits for all the figures being rendered by the worker processes.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            for filename, cache_filename, result in pending:
+                self._collect(filename, cache_filename, result)
+
+    def close(self):
+        """close() -> None
+
+        Waits for the pending figures, then stops the worker processes.
+        """
+        self.wait()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+_renderer = FigureRenderer()
+
+
+def get_renderer():
+    """get_renderer() -> FigureRenderer
+
+    Returns the renderer used by the file output of figures.
+    """
+    return _renderer
+
+
+def set_renderer(renderer):
+    """set_renderer(renderer: FigureRenderer) -> None
+
+    Replaces the renderer, stopping the previous one.
+    """
+    global _renderer
+    previous, _renderer = _renderer, renderer
+    previous.close()
+
+
+################################################################################
+
+import unittest
+
+
+class TestFigureRenderer(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_mpl_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_figure(self):
+        figure = Figure()
+        figure.gca().plot([1, 3, 2])
+        return figure
+
+    def test_cache(self):
+        """A figure with the same signature is copied from the cache"""
+        renderer = FigureRenderer(
+                cache_dir=os.path.join(self.directory, 'cache'))
+        first = os.path.join(self.directory, 'first.png')
+        renderer.render(self.make_figure(), first, 100, 80, 'png', 'abc')
+        self.assertTrue(os.path.exists(first))
+        self.assertEqual(len(os.listdir(renderer.cache_dir)), 1)
+
+        # an empty figure, would be different if it was drawn
+        second = os.path.join(self.directory, 'second.png')
+        renderer.render(Figure(), second, 100, 80, 'png', 'abc')
+        with open(first, 'rb') as fp1:
+            with open(second, 'rb') as fp2:
+                self.assertEqual(fp1.read(), fp2.read())
+
+        # different size
+        renderer.render(Figure(), second, 100, 90, 'png', 'abc')
+        self.assertEqual(len(os.listdir(renderer.cache_dir)), 2)
+
+    def test_cache_size(self):
+        """The least recently used files are removed from the cache"""
+        renderer = FigureRenderer(
+                cache_dir=os.path.join(self.directory, 'cache'))
+        filename = os.path.join(self.directory, 'figure.png')
+        renderer.render(self.make_figure(), filename, 100, 80, 'png', 'a')
+        renderer.cache_size = os.path.getsize(filename) * 2
+        a = renderer.cache_filename('a', 100, 80, 'png')
+        os.utime(a, (0, 0))
+        renderer.render(self.make_figure(), filename, 100, 80, 'png', 'b')
+        b = renderer.cache_filename('b', 100, 80, 'png')
+        os.utime(b, (0, 0))
+        # using 'a' makes it more recent than 'b'
+        renderer.render(Figure(), filename, 100, 80, 'png', 'a')
+        renderer.render(self.make_figure(), filename, 100, 80, 'png', 'c')
+        self.assertEqual(
+                sorted(os.listdir(renderer.cache_dir)),
+                sorted(os.path.basename(renderer.cache_filename(
+                        sig, 100, 80, 'png')) for sig in 'ac'))
+
+    def test_processes(self):
+        """Figures rendered by workers are the same as in-process"""
+        renderer = FigureRenderer(processes=2)
+        try:
+            for i in xrange(4):
+                renderer.render(self.make_figure(),
+                                os.path.join(self.directory, '%d.png' % i),
+                                100, 80, 'png')
+        finally:
+            renderer.close()
+        reference = os.path.join(self.directory, 'reference.png')
+        draw_figure(self.make_figure(), reference, 100, 80, 'png')
+        with open(reference, 'rb') as fp:
+            reference = fp.read()
+        for i in xrange(4):
+            with open(os.path.join(self.directory, '%d.png' % i), 'rb') as fp:
+                self.assertEqual(fp.read(), reference)
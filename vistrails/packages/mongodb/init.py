@@ -38,10 +38,47 @@ from __future__ import division
 
 import os
 from pymongo import MongoClient
+import threading
 
 from vistrails.core.modules.vistrails_module import Module
 
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, port=None):
+    """get_client(host: str, port: int) -> MongoClient
+
+    Returns the client connected to this server, creating it the first
+    time.
+
+    MongoClient is thread-safe and keeps its own connection pool, so a
+    single client is shared by all the executions using the same server.
+    """
+    key = (host, port)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kwargs = {'host': host}
+            if port is not None:
+                kwargs['port'] = port
+            client = _clients[key] = MongoClient(**kwargs)
+        return client
+
+
+def close_clients():
+    """close_clients() -> None
+
+    Closes all the clients created by get_client().
+    """
+    with _clients_lock:
+        clients = _clients.values()
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
 class MongoDatabase(Module):
     """Connects to MongoDB and selects a database.
     """
@@ -53,10 +90,10 @@ class MongoDatabase(Module):
     _output_ports = [('database', '(MongoDatabase)')]
 
     def compute(self):
-        kwargs = {'host': self.get_input('host')}
+        port = None
         if self.has_input('port'):
-            kwargs['port'] = self.get_input('port')
-        client = MongoClient(**kwargs)
+            port = self.get_input('port')
+        client = get_client(self.get_input('host'), port)
 
         database = client.get_database(self.get_input('database'))
 
@@ -116,16 +153,28 @@ _modules = [MongoDatabase, MongoCollection, DropCollection, RenameCollection]
 # Data operations
 
 class BaseCollectionOperation(Module):
+    """Base class for the operations on a collection.
+
+    If `collection_op_stream` is set, collection_operation() returns an
+    iterable (usually a cursor) whose elements are streamed on the output
+    port instead of being gathered in a list, in batches of `batch_size`
+    if that input is set.
+    """
     _input_ports = [('collection', MongoCollection)]
     _output_ports = [('collection', MongoCollection)]
 
     collection_op_out = None
+    collection_op_stream = False
 
     def compute(self):
         collection = self.get_input('collection')
 
         out = self.collection_operation(collection)
-        if self.collection_op_out is not None:
+        if self.collection_op_stream:
+            self.set_streaming_output(self.collection_op_out, iter(out),
+                                      chunk_size=self.force_get_input(
+                                              'batch_size', None))
+        elif self.collection_op_out is not None:
             self.set_output(self.collection_op_out, out)
 
         self.set_output('collection', collection)
@@ -137,13 +186,17 @@ class BaseCollectionOperation(Module):
 _modules.append(BaseCollectionOperation)
 
 
-def collection_op(input_ports, output=None):
+def collection_op(input_ports, output=None, stream=False):
     def wrapper(func):
         dct = {'_input_ports': input_ports,
                'collection_operation': func}
         if output:
             dct['_output_ports'] = [output]
             dct['collection_op_out'] = output[0]
+        if stream:
+            dct['_input_ports'] = input_ports + [
+                    ('batch_size', '(basic:Integer)', {'optional': True})]
+            dct['collection_op_stream'] = True
         _modules.append(type(func.func_name, (BaseCollectionOperation,), dct))
         return func
     return wrapper
@@ -154,6 +207,15 @@ def InsertOne(self, coll):
     coll.insert_one(self.get_input('document'))
 
 
+@collection_op([('documents', '(basic:List)'),
+                ('ordered', '(basic:Boolean)',
+                 {'optional': True, 'defaults': ['True']})],
+               output=('inserted_ids', '(basic:List)'))
+def InsertMany(self, coll):
+    return coll.insert_many(self.get_input('documents'),
+                            ordered=self.get_input('ordered')).inserted_ids
+
+
 @collection_op([('filter', '(basic:Dictionary)'),
                 ('document', '(basic:Dictionary)')])
 def ReplaceOne(self, coll):
@@ -193,6 +255,26 @@ def Find(self, coll):
                           limit=self.force_get_input('limit', 0)))
 
 
+@collection_op([('pipeline', '(basic:List)')],
+               output=('documents', '(basic:List)'), stream=True)
+def AggregateStream(self, coll):
+    kwargs = {}
+    if self.has_input('batch_size'):
+        kwargs['batchSize'] = self.get_input('batch_size')
+    return coll.aggregate(self.get_input('pipeline'), **kwargs)
+
+
+@collection_op([('filter', '(basic:Dictionary)'),
+                ('limit', '(basic:Integer)', {'optional': True})],
+               output=('documents', '(basic:List)'), stream=True)
+def FindStream(self, coll):
+    cursor = coll.find(self.get_input('filter'),
+                       limit=self.force_get_input('limit', 0))
+    if self.has_input('batch_size'):
+        cursor = cursor.batch_size(self.get_input('batch_size'))
+    return cursor
+
+
 @collection_op([('filter', '(basic:Dictionary)')],
                output=('document', '(basic:Dictionary)'))
 def FindOne(self, coll):
@@ -250,6 +332,10 @@ def MapReduce(self, coll):
                            self.get_input('out'))
 
 
+def finalize():
+    close_clients()
+
+
 ###############################################################################
 
 import unittest
@@ -289,3 +375,67 @@ class TestMongoDB(unittest.TestCase):
         from vistrails.tests.utils import run_file
 
         self.assertFalse(run_file('examples/mongodb.vt'))
+
+
+class TestOperations(unittest.TestCase):
+    """Runs operations against mongomock, an in-process stand-in for MongoDB.
+    """
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import mongomock
+        except ImportError:
+            raise unittest.SkipTest("mongomock is not installed")
+        global MongoClient
+        cls.orig_client = MongoClient
+        MongoClient = mongomock.MongoClient
+
+    @classmethod
+    def tearDownClass(cls):
+        global MongoClient
+        close_clients()
+        MongoClient = cls.orig_client
+
+    def setUp(self):
+        close_clients()
+
+    def test_client_reuse(self):
+        client = get_client('localhost', 27017)
+        self.assertIs(get_client('localhost', 27017), client)
+        self.assertIsNot(get_client('localhost'), client)
+        close_clients()
+        self.assertIsNot(get_client('localhost', 27017), client)
+
+    def test_insert_stream(self):
+        from vistrails.core.modules.basic_modules import List
+        from vistrails.tests.utils import execute, intercept_result
+
+        identifier = 'org.vistrails.vistrails.mongodb'
+        documents = [{'n': i} for i in xrange(10)]
+        for run in xrange(2):
+            with intercept_result(List, 'value') as results:
+                self.assertFalse(execute([
+                        ('MongoDatabase', identifier, [
+                            ('database', [('String', 'vt_test')]),
+                        ]),
+                        ('MongoCollection', identifier, [
+                            ('name', [('String', 'run%d' % run)]),
+                        ]),
+                        ('InsertMany', identifier, [
+                            ('documents', [('List', repr(documents))]),
+                        ]),
+                        ('FindStream', identifier, [
+                            ('filter', [('Dictionary', '{}')]),
+                            ('batch_size', [('Integer', '4')]),
+                        ]),
+                        ('List', 'org.vistrails.vistrails.basic', []),
+                    ],
+                    [
+                        (0, 'database', 1, 'database'),
+                        (1, 'collection', 2, 'collection'),
+                        (2, 'collection', 3, 'collection'),
+                        (3, 'documents', 4, 'value'),
+                    ]))
+            self.assertEqual(sorted(doc['n'] for doc in results[-1]),
+                             range(10))
+        self.assertEqual(len(_clients), 1)
@@ -34,12 +34,17 @@
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
 from vistrails.core.requirements import require_python_module
 
 identifier = 'org.vistrails.vistrails.sklearn'
 name = 'sklearn'
 version = '0.15.2'
 
+configuration = ConfigurationObject(
+        n_jobs=1,               # default parallelism, -1 uses all the cores
+        model_cache_size=16)    # number of fitted models kept, 0 disables
+
 
 def package_requirements():
     require_python_module('sklearn', {
@@ -34,11 +34,15 @@
 
 from __future__ import division
 
+from collections import OrderedDict
+import hashlib
+import threading
+
 from vistrails.core.modules.config import ModuleSettings
 from vistrails.core.modules.vistrails_module import Module
 
 import numpy as np
-from sklearn.base import ClassifierMixin
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn import datasets
 from sklearn.cross_validation import train_test_split, cross_val_score
 from sklearn.metrics import SCORERS, roc_curve
@@ -58,6 +62,116 @@ def try_convert(input_string):
     except ValueError:
         return input_string
 
+
+def as_array(data):
+    """as_array(data: list or ndarray) -> ndarray
+
+    Stacks a list of rows into a 2D array; arrays are passed through without
+    being copied.
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 2:
+        return data
+    return np.vstack(data)
+
+
+def get_n_jobs(module):
+    """get_n_jobs(module: Module) -> int
+
+    Returns the value of the 'n_jobs' port if set, else the package default.
+    """
+    if module.has_input("n_jobs"):
+        return try_convert(module.get_input("n_jobs"))
+    return configuration.n_jobs
+
+
+def get_estimator_params(module, exclude):
+    """get_estimator_params(module: Module, exclude: list) -> dict
+
+    Reads the hyper-parameters set on the ports of an estimator module,
+    trying to convert strings to float / int, and uses the package default
+    for 'n_jobs' if the estimator supports it.
+    """
+    params = dict([(p, try_convert(module.get_input(p)))
+                   for p in module.inputPorts if p not in exclude])
+    if 'n_jobs' not in params and 'n_jobs' in module._estimator_params:
+        params['n_jobs'] = configuration.n_jobs
+    return params
+
+
+def fingerprint(data):
+    """fingerprint(data: array-like) -> str
+
+    Returns a digest of the content, shape and type of an array.
+    """
+    if data is None:
+        return None
+    data = np.ascontiguousarray(data)
+    h = hashlib.sha1()
+    h.update(data.dtype.str)
+    h.update(repr(data.shape))
+    if data.dtype.hasobject:
+        h.update(repr(data.tolist()))
+    else:
+        h.update(data.data)
+    return h.hexdigest()
+
+
+def model_key(model, data, target=None):
+    """model_key(model: BaseEstimator, data: ndarray, target: array-like)
+      -> tuple
+
+    Returns the key of a fitted model in the cache. Parallelism doesn't
+    change the result, so 'n_jobs' is not part of the key.
+    """
+    params = []
+    for name, value in sorted(model.get_params(deep=True).iteritems()):
+        if name == 'n_jobs' or name.endswith('__n_jobs'):
+            continue
+        if isinstance(value, BaseEstimator):
+            # its parameters are listed separately
+            value = type(value).__name__
+        params.append((name, repr(value)))
+    return (type(model).__module__, type(model).__name__, tuple(params),
+            fingerprint(data), fingerprint(target))
+
+
+_model_cache = OrderedDict()
+_model_cache_lock = threading.Lock()
+
+
+def fit_cached(model, data, target=None):
+    """fit_cached(model: BaseEstimator, data: ndarray, target: array-like)
+      -> BaseEstimator
+
+    Fits the model, unless a model with the same hyper-parameters was
+    already fitted on the same data; returns the fitted model.
+
+    Cached models are shared, modules receiving them should clone them
+    before fitting them again.
+    """
+    size = configuration.model_cache_size
+    if not size:
+        if target is None:
+            model.fit(data)
+        else:
+            model.fit(data, target)
+        return model
+    key = model_key(model, data, target)
+    with _model_cache_lock:
+        fitted = _model_cache.pop(key, None)
+        if fitted is not None:
+            _model_cache[key] = fitted
+            return fitted
+    if target is None:
+        model.fit(data)
+    else:
+        model.fit(data, target)
+    with _model_cache_lock:
+        _model_cache[key] = model
+        while len(_model_cache) > size:
+            _model_cache.popitem(last=False)
+    return model
+
 # backport of odd estimators that we don't want to include
 dont_test = ['SparseCoder', 'EllipticEnvelope', 'DictVectorizer',
              'LabelBinarizer', 'LabelEncoder', 'MultiLabelBinarizer',
@@ -111,13 +225,13 @@ class SupervisedEstimator(Estimator):
 
     def compute(self):
         # get parameters, try to convert strings to float / int
-        params = dict([(p, try_convert(self.get_input(p))) for p in self.inputPorts
-                       if p not in ["training_data", "training_target"]])
+        params = get_estimator_params(self, ["training_data",
+                                             "training_target"])
         clf = self._estimator_class(**params)
         if "training_data" in self.inputPorts:
-            training_data = np.vstack(self.get_input("training_data"))
+            training_data = as_array(self.get_input("training_data"))
             training_target = self.get_input("training_target")
-            clf.fit(training_data, training_target)
+            clf = fit_cached(clf, training_data, training_target)
         self.set_output("model", clf)
 
 
@@ -126,12 +240,12 @@ class UnsupervisedEstimator(Estimator):
     _settings = ModuleSettings(abstract=True)
 
     def compute(self):
-        params = dict([(p, try_convert(self.get_input(p))) for p in self.inputPorts
-                       if p not in ["training_data", "training_target"]])
+        params = get_estimator_params(self, ["training_data",
+                                             "training_target"])
         trans = self._estimator_class(**params)
         if "training_data" in self.inputPorts:
-            training_data = np.vstack(self.get_input("training_data"))
-            trans.fit(training_data)
+            training_data = as_array(self.get_input("training_data"))
+            trans = fit_cached(trans, training_data)
         self.set_output("model", trans)
 
 
@@ -199,16 +313,18 @@ class CrossValScore(Module):
                     ("data", "basic:List", {'shape': 'circle'}),
                     ("target", "basic:List", {'shape': 'circle'}),
                     ("metric", "basic:String", {"defaults": ["accuracy"]}),
-                    ("folds", "basic:Integer", {"defaults": ["3"]})]
+                    ("folds", "basic:Integer", {"defaults": ["3"]}),
+                    ("n_jobs", "basic:Integer", {'optional': True})]
     _output_ports = [("scores", "basic:List")]
 
     def compute(self):
         model = self.get_input("model")
-        data = self.get_input("data")
+        data = as_array(self.get_input("data"))
         target = self.get_input("target")
         metric = self.get_input("metric")
         folds = self.get_input("folds")
-        scores = cross_val_score(model, data, target, scoring=metric, cv=folds)
+        scores = cross_val_score(model, data, target, scoring=metric, cv=folds,
+                                 n_jobs=get_n_jobs(self))
         self.set_output("scores", scores)
 
 ###############################################################################
@@ -222,7 +338,8 @@ class GridSearchCV(Estimator):
                     ("data", "basic:List", {'shape': 'circle'}),
                     ("target", "basic:List", {'shape': 'circle'}),
                     ("metric", "basic:String", {"defaults": ["accuracy"]}),
-                    ("folds", "basic:Integer", {"defaults": ["3"]})]
+                    ("folds", "basic:Integer", {"defaults": ["3"]}),
+                    ("n_jobs", "basic:Integer", {'optional': True})]
     _output_ports = [("scores", "basic:List"), ("model", "Estimator", {'shape': 'diamond'}),
                      ("best_parameters", "basic:Dictionary"),
                      ("best_score", "basic:Float")]
@@ -232,11 +349,12 @@ class GridSearchCV(Estimator):
         grid = _GridSearchCV(base_model,
                              param_grid=self.get_input("parameters"),
                              cv=self.get_input("folds"),
-                             scoring=self.get_input("metric"))
+                             scoring=self.get_input("metric"),
+                             n_jobs=get_n_jobs(self))
         if "data" in self.inputPorts:
-            data = np.vstack(self.get_input("data"))
+            data = as_array(self.get_input("data"))
             target = self.get_input("target")
-            grid.fit(data, target)
+            grid = fit_cached(grid, data, target)
             self.set_output("scores", grid.grid_scores_)
             self.set_output("best_parameters", grid.best_params_)
             self.set_output("best_score", grid.best_score_)
@@ -253,12 +371,14 @@ class Pipeline(Estimator):
 
     def compute(self):
         models = ["model%d" % d for d in range(1, 5)]
-        steps = [self.get_input(model) for model in models if model in self.inputPorts]
+        # the models might be shared with other modules, don't fit them
+        steps = [clone(self.get_input(model)) for model in models
+                 if model in self.inputPorts]
         pipeline = make_pipeline(*steps)
         if "training_data" in self.inputPorts:
-            training_data = np.vstack(self.get_input("training_data"))
+            training_data = as_array(self.get_input("training_data"))
             training_target = self.get_input("training_target")
-            pipeline.fit(training_data, training_target)
+            pipeline = fit_cached(pipeline, training_data, training_target)
         self.set_output("model", pipeline)
 
 ###############################################################################
@@ -309,8 +429,9 @@ def make_module(name, Estimator, namespace, supervised=False, Base=None):
     if supervised:
         input_ports.append(("training_target", "basic:List", {'shape': 'circle'}))
     est = Estimator()
+    estimator_params = est.get_params()
     input_ports.extend([(param, "basic:String", {'optional': True}) for param
-                        in est.get_params()])
+                        in estimator_params])
     _settings = ModuleSettings(namespace=namespace)
     if Base is None:
         if supervised:
@@ -319,7 +440,9 @@ def make_module(name, Estimator, namespace, supervised=False, Base=None):
             Base = UnsupervisedEstimator
     new_class = type(name, (Base,),
                      {'_input_ports': input_ports, '_settings': _settings,
-                      '_estimator_class': Estimator, '__doc__':
+                      '_estimator_class': Estimator,
+                      '_estimator_params': frozenset(estimator_params),
+                      '__doc__':
                       Estimator.__doc__})
     return new_class
 
@@ -390,10 +513,9 @@ class ManifoldLearner(Module):
     _output_ports = [("transformed_data", "basic:List", {'shape': 'circle'})]
 
     def compute(self):
-        params = dict([(p, try_convert(self.get_input(p))) for p in self.inputPorts
-                       if p not in ["training_data"]])
+        params = get_estimator_params(self, ["training_data"])
         trans = self._estimator_class(**params)
-        training_data = np.vstack(self.get_input("training_data"))
+        training_data = as_array(self.get_input("training_data"))
         transformed_data = trans.fit_transform(training_data)
         self.set_output("transformed_data", transformed_data)
 
@@ -41,10 +41,12 @@ from vistrails.tests.utils import execute, intercept_results
 from vistrails.packages.sklearn.init import (Digits, Iris, TrainTestSplit,
                                              Predict, Score, Transform,
                                              CrossValScore, _modules,
-                                             GridSearchCV)
+                                             GridSearchCV, fit_cached)
 from vistrails.packages.sklearn import identifier
 
+from sklearn import datasets
 from sklearn.metrics import f1_score
+from sklearn.svm import LinearSVC
 
 
 def class_by_name(name):
@@ -298,3 +300,36 @@ class TestSklearn(unittest.TestCase):
             ))
         self.assertEqual(len(scores[0]), 3)
         self.assertTrue(np.mean(scores[0]) > .8)
+
+    def test_parallel_cross_validation(self):
+        with intercept_results(CrossValScore, 'scores') as (scores, ):
+            self.assertFalse(execute(
+                [
+                    ('datasets|Iris', identifier, []),
+                    ('classifiers|DecisionTreeClassifier', identifier, []),
+                    ('GridSearchCV', identifier,
+                     [('parameters', [('Dictionary', "{'max_depth': [1, 2, 3, 4]}")]),
+                      ('n_jobs', [('Integer', '2')])]),
+                    ('cross-validation|CrossValScore', identifier,
+                     [('n_jobs', [('Integer', '2')])])
+                ],
+                [
+                    (0, 'data', 3, 'data'),
+                    (0, 'target', 3, 'target'),
+                    (1, 'model', 2, 'model'),
+                    (2, 'model', 3, 'model')
+                ]
+            ))
+        self.assertEqual(len(scores[0]), 3)
+        self.assertTrue(np.mean(scores[0]) > .8)
+
+    def test_model_cache(self):
+        # check that models are only refitted if the data or the
+        # hyper-parameters change
+        iris = datasets.load_iris()
+        data, target = iris.data, iris.target
+        model = fit_cached(LinearSVC(C=2.), data, target)
+        self.assertIs(fit_cached(LinearSVC(C=2.), data.copy(), target), model)
+        self.assertIsNot(fit_cached(LinearSVC(C=3.), data, target), model)
+        self.assertIsNot(fit_cached(LinearSVC(C=2.), data[:100], target[:100]),
+                         model)
@@ -36,15 +36,22 @@
 
 from __future__ import division
 
+from collections import OrderedDict
+import cPickle
+import hashlib
 import itertools
+import Queue
+import sys
 import tensorflow
+import threading
+import weakref
 
 from vistrails.core.modules.config import ModuleSettings
 from vistrails.core.modules.vistrails_module import Module, ModuleError
 
 
 class Op(object):
-    def __init__(self, op, args):
+    def __init__(self, op, args, module=None, values=()):
         """Constructor from a function and its arguments.
 
         This is the type actually passed on TFOperation ports. It represents a
@@ -52,10 +59,58 @@ class Op(object):
         the Run module, allowing multiple graphs to be used (and the same
         VisTrails-defined graph to be used from multiple Run modules).
 
+        If the module creating the operation is given, the operation gets a
+        signature from the module's, the other values it uses and the
+        signatures of its arguments. Operations with the same signature are
+        equal, which allows a graph built during a previous execution to be
+        used again.
+
         :type args: dict | collections.Iterable
+        :type module: vistrails.core.modules.vistrails_module.Module
+        :type values: dict | collections.Iterable
         """
         self.op = op
         self.args = args
+        self.signature = None
+        if module is not None:
+            self.signature = self._make_signature(module, args, values)
+
+    @staticmethod
+    def _make_signature(module, args, values):
+        if module.signature is None:
+            return None
+        h = hashlib.sha1(module.signature)
+        if isinstance(args, dict):
+            args = sorted(args.iteritems())
+        else:
+            args = enumerate(args)
+        for name, arg in args:
+            h.update(repr(name))
+            for op in (arg if isinstance(arg, list) else [arg]):
+                if op.signature is None:
+                    return None
+                h.update(op.signature)
+        if isinstance(values, dict):
+            values = sorted(values.iteritems())
+        try:
+            h.update(cPickle.dumps(list(values), cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return None
+        return h.hexdigest()
+
+    def __hash__(self):
+        if self.signature is None:
+            return object.__hash__(self)
+        return hash(self.signature)
+
+    def __eq__(self, other):
+        if self.signature is None:
+            return self is other
+        return (isinstance(other, Op) and
+                self.signature == other.signature)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def build(self, operation_map):
         """Builds the graph, by instanciating the operations recursively.
@@ -100,7 +155,8 @@ class constant(TFOperation):
 
     def compute(self):
         value = self.get_input('value')
-        self.set_output('output', Op(lambda: tensorflow.constant(value), []))
+        self.set_output('output', Op(lambda: tensorflow.constant(value), [],
+                                     self, [value]))
 
 
 class cast(TFOperation):
@@ -113,7 +169,8 @@ class cast(TFOperation):
         value = self.get_input('value')
         type_ = self.get_input('type')
         self.set_output('output',
-                        Op(lambda x: tensorflow.cast(x, type_), [value]))
+                        Op(lambda x: tensorflow.cast(x, type_), [value],
+                           self, [type_]))
 
 
 class Variable(TFOperation):
@@ -125,7 +182,8 @@ class Variable(TFOperation):
 
     def compute(self):
         initial_value = self.get_input('initial_value')
-        self.set_output('output', Op(tensorflow.Variable, [initial_value]))
+        self.set_output('output', Op(tensorflow.Variable, [initial_value],
+                                     self))
 
 
 class Optimizer(Module):
@@ -172,15 +230,153 @@ class minimize(TFOperation):
             kwargs['global_step'] = self.get_input('global_step')
         if self.has_input('var_list'):
             kwargs['var_list'] = self.get_input('var_list')
-        self.set_output('output', Op(output, kwargs))
+        self.set_output('output', Op(output, kwargs,
+                                     self, [gate_gradients, name]))
 
 
 class RunResult(object):
-    def __init__(self, graph, session, operation_map, fetch_map):
+    def __init__(self, graph, session, operation_map, fetch_map, lock=None):
         self.graph = graph
         self.session = session
         self.operation_map = operation_map
         self.fetch_map = fetch_map
+        if lock is None:
+            lock = threading.RLock()
+        self.lock = lock
+
+
+class CachedGraph(object):
+    """A graph built by a run module, kept to be used by later executions.
+    """
+    def __init__(self):
+        self.graph = tensorflow.Graph()
+        self.operation_map = {}
+        self.lock = threading.RLock()
+        self._initializer = None
+        self._nb_variables = None
+        self._session = None
+        self._owner = None
+
+    def initializer(self):
+        """Returns the operation initializing all the variables of the graph.
+
+        Must be called from within the graph, holding the lock.
+        """
+        nb_variables = len(tensorflow.all_variables())
+        if self._initializer is None or self._nb_variables != nb_variables:
+            self._initializer = tensorflow.initialize_all_variables()
+            self._nb_variables = nb_variables
+        return self._initializer
+
+    def take_session(self):
+        """Returns a session on this graph that isn't used anymore.
+
+        The session of a previous execution is reused, unless its result is
+        still around, since another run module might be chained after it
+        and expect its variables not to change. Must be called holding the
+        lock.
+        """
+        if self._session is None or (self._owner is not None and
+                                     self._owner() is not None):
+            self._session = tensorflow.Session(graph=self.graph)
+        self._owner = lambda: True
+        return self._session
+
+    def release_session(self, session, result):
+        """Marks the session as owned by the given result.
+        """
+        with self.lock:
+            if session is self._session:
+                self._owner = weakref.ref(result)
+
+
+class GraphCache(object):
+    """Keeps the most recently used graphs, by the signatures of their outputs.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the graph for this key, creating it if needed.
+        """
+        if key is None:
+            return CachedGraph()
+        with self._lock:
+            cached_graph = self._graphs.pop(key, None)
+            if cached_graph is None:
+                cached_graph = CachedGraph()
+            self._graphs[key] = cached_graph
+            while len(self._graphs) > self.max_size:
+                self._graphs.popitem(last=False)
+            return cached_graph
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
+
+
+graph_cache = GraphCache(8)
+
+
+class Prefetcher(object):
+    """Iterates on feeds, preparing the next ones on a background thread.
+
+    Up to `size` items are computed ahead of time, while the consumer uses
+    the current one. Exceptions raised by the iterator are raised again by
+    next().
+    """
+    def __init__(self, iterator, size, prepare=None):
+        self._queue = Queue.Queue(size)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(iterator, prepare))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self, iterator, prepare):
+        try:
+            for item in iterator:
+                if prepare is not None:
+                    item = prepare(item)
+                if not self._put((True, item)):
+                    return
+        except Exception:
+            self._put((False, sys.exc_info()))
+        else:
+            self._put((False, None))
+
+    def _put(self, item):
+        while not self._stop.isSet():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except Queue.Full:
+                pass
+            else:
+                return True
+        return False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        ok, item = self._queue.get()
+        if ok:
+            return item
+        self._done = True
+        if item is not None:
+            raise item[0], item[1], item[2]
+        raise StopIteration
+
+    def close(self):
+        """Stops the background thread.
+        """
+        self._done = True
+        self._stop.set()
 
 
 class FeedGenerator(Module):
@@ -189,56 +385,88 @@ class FeedGenerator(Module):
 
 class run(Module):
     """Instanciate and run a TensorFlow graph to make the results available.
+
+    The graph built for the same operations is kept across executions, and
+    its session is reused if no other run module can be chained after it
+    anymore; the variables are still initialized on each execution.
+
+    If 'prefetch' is set, that number of feeds are prepared ahead of time on
+    a background thread while the graph runs.
     """
     _input_ports = [('output', TFOperation, {'depth': 1}),
                     ('iterations', '(basic:Integer)',
                      {'optional': True, 'defaults': '["1"]'}),
                     ('after', '(org.vistrails.vistrails.tensorflow:run)'),
-                    ('feed_generator', FeedGenerator)]
+                    ('feed_generator', FeedGenerator),
+                    ('prefetch', '(basic:Integer)',
+                     {'optional': True, 'defaults': '["0"]'})]
     _output_ports = [('result', '(org.vistrails.vistrails.tensorflow:run)')]
 
     def compute(self):
         outputs = self.get_input('output')
         iterations = self.get_input('iterations')
-        if self.has_input('feed_generator'):
-            feeds = self.get_input('feed_generator')()
-        else:
-            feeds = None
+        prefetch = self.get_input('prefetch')
 
+        cached_graph = None
         if self.has_input('after'):
             after = self.get_input('after')
             graph = after.graph
             session = after.session
             operation_map = after.operation_map
+            lock = after.lock
         else:
-            graph = tensorflow.Graph()
-            session = tensorflow.Session(graph=graph)
-            operation_map = {}
+            key = tuple(op.signature for op in outputs)
+            if None in key:
+                key = None
+            cached_graph = graph_cache.get(key)
+            graph = cached_graph.graph
+            operation_map = cached_graph.operation_map
+            lock = cached_graph.lock
 
         fetches = []
-        with graph.as_default():
-            for op in outputs:
-                fetches.append(op.build(operation_map))
-
-            if not self.has_input('after'):
-                session.run(tensorflow.initialize_all_variables())
-
-        for i in xrange(iterations):
-            feed_dict = None
-            if feeds is not None:
-                try:
-                    feed_dict = next(feeds)
-                except StopIteration:
-                    feeds = None
-                else:
-                    feed_dict = dict((operation_map[op], value)
-                                     for op, value in feed_dict.iteritems())
-            out = session.run(fetches, feed_dict=feed_dict)
+        with lock:
+            with graph.as_default():
+                for op in outputs:
+                    fetches.append(op.build(operation_map))
+
+                if cached_graph is not None:
+                    initializer = cached_graph.initializer()
+                    session = cached_graph.take_session()
+        if cached_graph is not None:
+            session.run(initializer)
+
+        def prepare(feed_dict):
+            return dict((operation_map[op], value)
+                        for op, value in feed_dict.iteritems())
+
+        if self.has_input('feed_generator'):
+            feeds = self.get_input('feed_generator')()
+            if prefetch > 0:
+                feeds = Prefetcher(feeds, prefetch, prepare)
+            else:
+                feeds = itertools.imap(prepare, feeds)
+        else:
+            feeds = None
+
+        try:
+            for i in xrange(iterations):
+                feed_dict = None
+                if feeds is not None:
+                    try:
+                        feed_dict = next(feeds)
+                    except StopIteration:
+                        feeds = None
+                out = session.run(fetches, feed_dict=feed_dict)
+        finally:
+            if isinstance(feeds, Prefetcher):
+                feeds.close()
 
         fetch_map = dict(itertools.izip(outputs, out))
 
-        self.set_output('result', RunResult(graph, session, operation_map,
-                                            fetch_map))
+        result = RunResult(graph, session, operation_map, fetch_map, lock)
+        if cached_graph is not None:
+            cached_graph.release_session(session, result)
+        self.set_output('result', result)
 
 
 class fetch(Module):
@@ -45,7 +45,7 @@ from vistrails.core import debug
 from vistrails.core.modules.config import ModuleSettings
 from vistrails.core.modules.module_registry import get_module_registry
 
-from .base import Op, TFOperation, Variable, Optimizer, \
+from .base import Op, TFOperation, Variable, Optimizer, Prefetcher, \
     _modules as base_modules, wrapped
 
 
@@ -161,7 +161,7 @@ class AutoOperation(TFOperation):
                     immediate[name] = value
 
         f = apply_kw(self.op[0], immediate)
-        self.set_output('output', Op(f, stored))
+        self.set_output('output', Op(f, stored, self, immediate))
 
 
 def register_operations(reg, pkg, namespace, exclude=set()):
@@ -210,7 +210,7 @@ class AutoOptimizer(Optimizer):
                     immediate[name] = value
 
         f = apply_kw(self.class_[0], immediate)
-        self.set_output('optimizer', Op(f, stored))
+        self.set_output('optimizer', Op(f, stored, self, immediate))
 
 
 def register_optimizers(reg):
@@ -291,3 +291,55 @@ Does a thing.
         self.assertEqual(list(read_args(doc + '\n')), expected)
         self.assertEqual(list(read_args(doc)), expected)
         self.assertEqual(list(read_args(doc + '\n  Returns:\n')), expected)
+
+
+class TestOp(unittest.TestCase):
+    class FakeModule(object):
+        def __init__(self, signature):
+            self.signature = signature
+
+    def test_signature(self):
+        """Operations built by the same modules from the same values are equal.
+        """
+        def make(value, signature='a1'):
+            const = Op(None, [], self.FakeModule(signature), [value])
+            return Op(None, {'x': const, 'y': [const]},
+                      self.FakeModule('b2'), {'name': 'add'})
+
+        self.assertEqual(make(1), make(1))
+        self.assertEqual(hash(make(1)), hash(make(1)))
+        self.assertNotEqual(make(1), make(2))
+        self.assertNotEqual(make(1), make(1, 'c3'))
+        # no signature, only equal to itself
+        op = make(1, None)
+        self.assertIsNone(op.signature)
+        self.assertNotEqual(op, make(1, None))
+        self.assertEqual(op, op)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(Prefetcher(iter(xrange(10)), 3,
+                                         lambda x: x * 2)),
+                         range(0, 20, 2))
+
+    def test_error(self):
+        def gen():
+            yield 1
+            raise ValueError
+        feeds = Prefetcher(gen(), 2)
+        self.assertEqual(next(feeds), 1)
+        self.assertRaises(ValueError, next, feeds)
+        self.assertRaises(StopIteration, next, feeds)
+
+    def test_close(self):
+        def gen():
+            i = 0
+            while True:
+                yield i
+                i += 1
+        feeds = Prefetcher(gen(), 2)
+        self.assertEqual(next(feeds), 0)
+        feeds.close()
+        feeds._thread.join(5)
+        self.assertFalse(feeds._thread.isAlive())